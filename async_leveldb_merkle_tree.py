@@ -0,0 +1,259 @@
+"""Non-blocking front-end for LeveldbMerkleTree.
+
+Every call returns a Future immediately. Reads and leaf hashing run on a
+bounded pool of worker threads (LevelDB reads and hashing of large leaves
+release the GIL), concurrent identical reads share a single computation, and
+all writes are funnelled through one writer thread which commits whatever is
+queued as a single extend.
+
+Event-loop code can bridge a Future into its own loop with
+add_done_callback(), e.g. by scheduling the loop's thread-safe callback.
+"""
+
+import logging
+import Queue
+import sys
+import threading
+
+
+class Future(object):
+    """The result of an asynchronous call."""
+
+    def __init__(self):
+        self.__condition = threading.Condition()
+        self.__done = False
+        self.__result = None
+        self.__exc_info = None
+        self.__callbacks = []
+
+    def done(self):
+        with self.__condition:
+            return self.__done
+
+    def __wait(self, timeout):
+        with self.__condition:
+            if not self.__done:
+                self.__condition.wait(timeout)
+            if not self.__done:
+                raise RuntimeError("Timed out waiting for result")
+
+    def result(self, timeout=None):
+        """Waits for the call to complete and returns (or raises) its result.
+
+        Raises:
+            RuntimeError: the call did not complete within |timeout| seconds.
+        """
+        self.__wait(timeout)
+        if self.__exc_info is not None:
+            raise self.__exc_info[0], self.__exc_info[1], self.__exc_info[2]
+        return self.__result
+
+    def exception(self, timeout=None):
+        """Waits for the call and returns its exception, or None."""
+        self.__wait(timeout)
+        return self.__exc_info[1] if self.__exc_info else None
+
+    def add_done_callback(self, fn):
+        """Calls fn(future) once done, from whichever thread completes it."""
+        with self.__condition:
+            if not self.__done:
+                self.__callbacks.append(fn)
+                return
+        fn(self)
+
+    def set_result(self, result):
+        self.__finish(result, None)
+
+    def set_exc_info(self, exc_info):
+        self.__finish(None, exc_info)
+
+    def __finish(self, result, exc_info):
+        with self.__condition:
+            self.__result = result
+            self.__exc_info = exc_info
+            self.__done = True
+            callbacks, self.__callbacks = self.__callbacks, []
+            self.__condition.notify_all()
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                logging.exception("Future callback raised")
+
+
+def _run(future, fn, args):
+    try:
+        future.set_result(fn(*args))
+    except Exception:
+        future.set_exc_info(sys.exc_info())
+
+
+class _Executor(object):
+    """A fixed-size pool of daemon worker threads."""
+
+    def __init__(self, num_workers, name):
+        self.__queue = Queue.Queue()
+        self.__threads = []
+        for i in range(num_workers):
+            t = threading.Thread(target=self.__work, name="%s-%d" % (name, i))
+            t.daemon = True
+            t.start()
+            self.__threads.append(t)
+
+    def __work(self):
+        while True:
+            item = self.__queue.get()
+            if item is None:
+                return
+            _run(*item)
+
+    def submit(self, fn, *args):
+        future = Future()
+        self.__queue.put((future, fn, args))
+        return future
+
+    def shutdown(self, wait=True):
+        for _ in self.__threads:
+            self.__queue.put(None)
+        if wait:
+            for t in self.__threads:
+                t.join()
+
+
+# Queued to stop the writer thread.
+_SHUTDOWN = object()
+
+
+class AsyncLeveldbMerkleTree(object):
+    """Wraps a LeveldbMerkleTree so that no call blocks the caller.
+
+    Does not own the wrapped tree: shutdown() stops the worker threads but
+    leaves closing the tree to the caller.
+    """
+
+    def __init__(self, tree, max_workers=4, max_write_batch=256):
+        self.__tree = tree
+        self.__hasher = tree.hasher
+        self.__max_write_batch = max_write_batch
+        self.__executor = _Executor(max_workers, "merkle-reader")
+        self.__inflight = {}
+        self.__inflight_lock = threading.Lock()
+        self.__write_queue = Queue.Queue()
+        self.__writer = threading.Thread(target=self.__write_loop,
+                                         name="merkle-writer")
+        self.__writer.daemon = True
+        self.__writer.start()
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.__tree)
+
+    @property
+    def tree(self):
+        return self.__tree
+
+    def _coalesced(self, key, fn, *args):
+        """Runs fn(*args) on the pool, sharing in-flight calls with |key|."""
+        with self.__inflight_lock:
+            future = self.__inflight.get(key)
+            if future is not None and not future.done():
+                return future
+            future = self.__executor.submit(fn, *args)
+            self.__inflight[key] = future
+        future.add_done_callback(lambda f: self.__forget(key, f))
+        return future
+
+    def __forget(self, key, future):
+        with self.__inflight_lock:
+            if self.__inflight.get(key) is future:
+                del self.__inflight[key]
+
+    def get_root_hash(self, tree_size=None):
+        return self._coalesced(("get_root_hash", tree_size),
+                               self.__tree.get_root_hash, tree_size)
+
+    def get_inclusion_proof(self, leaf_index, tree_size=None):
+        return self._coalesced(
+                ("get_inclusion_proof", leaf_index, tree_size),
+                self.__tree.get_inclusion_proof, leaf_index, tree_size)
+
+    def get_consistency_proof(self, tree_size_1, tree_size_2=None):
+        return self._coalesced(
+                ("get_consistency_proof", tree_size_1, tree_size_2),
+                self.__tree.get_consistency_proof, tree_size_1, tree_size_2)
+
+    def add_leaf(self, leaf):
+        """Returns a Future for the index of the added leaf."""
+        return self._write([leaf], dedupe=False, single=True)
+
+    def extend(self, new_leaves, dedupe=False):
+        """Returns a Future for the result of LeveldbMerkleTree.extend()."""
+        return self._write(list(new_leaves), dedupe=dedupe, single=False)
+
+    def _write(self, leaves, dedupe, single):
+        # Writes are queued in submission order; the writer waits for each
+        # batch's hashes, which are computed concurrently on the pool.
+        future = Future()
+        hashed = self.__executor.submit(
+                lambda: [self.__hasher.hash_leaf(l) for l in leaves])
+        self.__write_queue.put((hashed, dedupe, single, future))
+        return future
+
+    def __write_loop(self):
+        pending = None
+        while True:
+            item = pending or self.__write_queue.get()
+            pending = None
+            if item is _SHUTDOWN:
+                return
+            # Group-commit whatever is queued behind this write in the same
+            # dedupe mode.
+            batch = [item]
+            while len(batch) < self.__max_write_batch:
+                try:
+                    item = self.__write_queue.get_nowait()
+                except Queue.Empty:
+                    break
+                if item is _SHUTDOWN or item[1] != batch[0][1]:
+                    pending = item
+                    break
+                batch.append(item)
+            self.__commit(batch)
+
+    def __commit(self, batch):
+        dedupe = batch[0][1]
+        ready = []
+        leaf_hashes = []
+        for hashed, _, single, future in batch:
+            try:
+                hashes = hashed.result()
+            except Exception:
+                future.set_exc_info(sys.exc_info())
+                continue
+            ready.append((hashes, single, future))
+            leaf_hashes.extend(hashes)
+        if not ready:
+            return
+        try:
+            start = self.__tree.tree_size
+            results = self.__tree.extend_hashes(leaf_hashes, dedupe=dedupe)
+        except Exception:
+            exc_info = sys.exc_info()
+            for _, _, future in ready:
+                future.set_exc_info(exc_info)
+            return
+        offset = 0
+        for hashes, single, future in ready:
+            if dedupe:
+                future.set_result(results[offset:offset + len(hashes)])
+            elif single:
+                future.set_result(start + offset)
+            else:
+                future.set_result(None)
+            offset += len(hashes)
+
+    def shutdown(self, wait=True):
+        """Stops the worker threads once queued writes have been committed."""
+        self.__write_queue.put(_SHUTDOWN)
+        if wait:
+            self.__writer.join()
+        self.__executor.shutdown(wait)
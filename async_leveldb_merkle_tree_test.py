@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+"""Tests for AsyncLeveldbMerkleTree."""
+
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+import async_leveldb_merkle_tree
+import leveldb_merkle_tree
+import merkle
+
+
+class FutureTest(unittest.TestCase):
+    """Tests for Future."""
+
+    def test_result_and_callbacks(self):
+        future = async_leveldb_merkle_tree.Future()
+        seen = []
+        future.add_done_callback(lambda f: seen.append(f.result()))
+        self.assertFalse(future.done())
+        self.assertRaises(RuntimeError, future.result, 0.01)
+        future.set_result(42)
+        self.assertTrue(future.done())
+        self.assertEqual(future.result(), 42)
+        self.assertEqual(future.exception(), None)
+        future.add_done_callback(lambda f: seen.append(f.result() + 1))
+        self.assertEqual(seen, [42, 43])
+
+    def test_exception(self):
+        future = async_leveldb_merkle_tree.Future()
+        try:
+            raise ValueError("boom")
+        except ValueError:
+            future.set_exc_info(sys.exc_info())
+        self.assertRaises(ValueError, future.result)
+        self.assertTrue(isinstance(future.exception(), ValueError))
+
+
+class AsyncLeveldbMerkleTreeTest(unittest.TestCase):
+    """Tests for AsyncLeveldbMerkleTree."""
+
+    def setUp(self):
+        self.db = tempfile.mkdtemp()
+        self.tree = leveldb_merkle_tree.LeveldbMerkleTree(db=self.db)
+        self.async_tree = async_leveldb_merkle_tree.AsyncLeveldbMerkleTree(
+                self.tree, max_workers=3)
+
+    def tearDown(self):
+        self.async_tree.shutdown()
+        self.tree.close()
+        shutil.rmtree(self.db)
+
+    def test_writes_are_ordered(self):
+        leaves = [str(i) for i in range(50)]
+        futures = [self.async_tree.add_leaf(l) for l in leaves[:20]]
+        futures.append(self.async_tree.extend(leaves[20:40]))
+        futures.extend(self.async_tree.add_leaf(l) for l in leaves[40:])
+        self.assertEqual([f.result(5) for f in futures[:20]], range(20))
+        self.assertEqual(futures[20].result(5), None)
+        self.assertEqual([f.result(5) for f in futures[21:]], range(40, 50))
+        self.assertEqual(self.async_tree.get_root_hash().result(5),
+                         merkle.TreeHasher().hash_full_tree(leaves))
+
+    def test_extend_dedupe(self):
+        self.async_tree.extend(["a", "b"]).result(5)
+        results = self.async_tree.extend(["b", "c"], dedupe=True).result(5)
+        self.assertEqual(results, [(1, False), (2, True)])
+
+    def test_proofs(self):
+        leaves = [str(i) for i in range(10)]
+        self.async_tree.extend(leaves).result(5)
+        verifier = merkle.MerkleVerifier()
+        root = self.async_tree.get_root_hash().result(5)
+        old_root = self.async_tree.get_root_hash(4).result(5)
+        proof = self.async_tree.get_consistency_proof(4).result(5)
+        verifier.verify_tree_consistency(4, 10, old_root, root, proof)
+        proof = self.async_tree.get_inclusion_proof(3).result(5)
+        self.assertEqual(proof, self.tree.get_inclusion_proof(3))
+
+    def test_write_errors_propagate(self):
+        future = self.async_tree.add_leaf(None)
+        self.assertRaises(TypeError, future.result, 5)
+        # The writer keeps going after a failed batch.
+        self.assertEqual(self.async_tree.add_leaf("a").result(5), 0)
+
+    def test_identical_reads_are_coalesced(self):
+        calls = []
+        release = threading.Event()
+        def slow_root(tree_size):
+            calls.append(tree_size)
+            release.wait(5)
+            return tree_size
+        first = self.async_tree._coalesced(("root", 3), slow_root, 3)
+        second = self.async_tree._coalesced(("root", 3), slow_root, 3)
+        other = self.async_tree._coalesced(("root", 4), slow_root, 4)
+        self.assertTrue(first is second)
+        self.assertFalse(first is other)
+        release.set()
+        self.assertEqual(first.result(5), 3)
+        self.assertEqual(other.result(5), 4)
+        self.assertEqual(sorted(calls), [3, 4])
+        third = self.async_tree._coalesced(("root", 3), slow_root, 3)
+        self.assertFalse(third is first)
+        third.result(5)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,264 @@
+#!/usr/bin/env python2
+
+"""Benchmarks for hashing, tree building, root and proof generation and proof
+verification.
+
+Run as a module and get JSON on stdout (or in --output):
+
+    python -m benchmark --min-log-size 10 --max-log-size 24
+
+Every result records the operation, the tree size, the number of timed
+calls and operations, throughput in ops/s, p50/p99 per-operation latency in
+microseconds and the peak RSS of the process so far in kilobytes. Slow
+operations are sampled until --samples operations or --time-budget seconds,
+whichever comes first, are used up. Building the trees is always timed in
+full, whatever the budget, so that the trees hold every leaf.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import timeit
+
+import in_memory_merkle_tree
+import leveldb_merkle_tree
+import merkle
+import tree_head
+
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = int(round(fraction * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def _peak_rss_kb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on OS X.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        peak //= 1024
+    return peak
+
+
+def time_calls(fn, args_list, time_budget=None):
+    """Times fn(*args) for each args in args_list, within time_budget seconds.
+
+    At least one call is always made. Without a time_budget, every call is.
+
+    Returns:
+        A list of per-call latencies in seconds.
+    """
+    timer = timeit.default_timer
+    latencies = []
+    deadline = None if time_budget is None else timer() + time_budget
+    for args in args_list:
+        start = timer()
+        fn(*args)
+        end = timer()
+        latencies.append(end - start)
+        if deadline is not None and end > deadline:
+            break
+    return latencies
+
+
+def make_result(name, tree_size, latencies, ops_per_call=1):
+    """Summarises latencies of |ops_per_call| operations per timed call."""
+    latencies = sorted(latencies)
+    total = sum(latencies)
+    ops = len(latencies) * ops_per_call
+    per_op = [l / ops_per_call for l in latencies]
+    return {
+        "name": name,
+        "tree_size": tree_size,
+        "calls": len(latencies),
+        "ops": ops,
+        "seconds": total,
+        "ops_per_sec": ops / total if total else None,
+        "p50_us": _percentile(per_op, 0.5) * 1e6,
+        "p99_us": _percentile(per_op, 0.99) * 1e6,
+        "peak_rss_kb": _peak_rss_kb(),
+    }
+
+
+class _Benchmarks(object):
+    """Runs the benchmarks for one tree size."""
+
+    def __init__(self, leaves, samples, time_budget, rng):
+        self.leaves = leaves
+        self.tree_size = len(leaves)
+        self.samples = samples
+        self.time_budget = time_budget
+        self.rng = rng
+        self.hasher = merkle.TreeHasher()
+        self.verifier = merkle.MerkleVerifier()
+        self.results = []
+
+    def _random_indices(self):
+        return [self.rng.randrange(self.tree_size)
+                for _ in xrange(self.samples)]
+
+    def _random_size_pairs(self):
+        pairs = []
+        for _ in xrange(self.samples):
+            old = self.rng.randrange(1, self.tree_size + 1)
+            pairs.append((old, self.rng.randrange(old, self.tree_size + 1)))
+        return pairs
+
+    def _record(self, name, fn, args_list, ops_per_call=1, populate=False):
+        """Times fn over args_list; populating calls ignore the budget."""
+        latencies = time_calls(fn, args_list,
+                               None if populate else self.time_budget)
+        self.results.append(
+                make_result(name, self.tree_size, latencies, ops_per_call))
+
+    def hashing(self):
+        self._record("hash_full_tree", self.hasher.hash_full_tree,
+                     [(self.leaves,)] * self.samples, self.tree_size)
+        level = "".join(self.hasher.hash_leaf(l) for l in self.leaves)
+        self._record("hash_level", self.hasher.hash_level,
+                     [(level,)] * self.samples, self.tree_size // 2 or 1)
+
+    def compact_tree(self):
+        tree = merkle.CompactMerkleTree()
+        self._record("CompactMerkleTree.append", tree.append,
+                     [(l,) for l in self.leaves], populate=True)
+        tree = merkle.CompactMerkleTree()
+        batch = 1024
+        self._record("CompactMerkleTree.extend", tree.extend,
+                     [(self.leaves[i:i + batch],)
+                      for i in xrange(0, self.tree_size, batch)],
+                     min(batch, self.tree_size), populate=True)
+
+    def _tree_reads(self, prefix, tree, tree_size_arg):
+        self._record(prefix + ".get_root_hash", tree.get_root_hash,
+                     [(tree_size_arg,)] * self.samples)
+        self._record(prefix + ".get_inclusion_proof", tree.get_inclusion_proof,
+                     [(i, tree_size_arg) for i in self._random_indices()])
+        self._record(prefix + ".get_consistency_proof",
+                     tree.get_consistency_proof, self._random_size_pairs())
+
+    def in_memory_tree(self):
+        tree = in_memory_merkle_tree.InMemoryMerkleTree(self.leaves)
+        self._tree_reads("InMemoryMerkleTree", tree, self.tree_size)
+
+    def leveldb_tree(self):
+        db = tempfile.mkdtemp()
+        try:
+            tree = leveldb_merkle_tree.LeveldbMerkleTree(db=db)
+            batch = 4096
+            self._record("LeveldbMerkleTree.extend", tree.extend,
+                         [(self.leaves[i:i + batch],)
+                          for i in xrange(0, self.tree_size, batch)],
+                         min(batch, self.tree_size), populate=True)
+            self._tree_reads("LeveldbMerkleTree", tree, None)
+            tree.close()
+        finally:
+            shutil.rmtree(db)
+
+    def verification(self):
+        leaf_hashes = [self.hasher.hash_leaf(l) for l in self.leaves]
+        tree = in_memory_merkle_tree.InMemoryMerkleTree(self.leaves)
+        sth = tree_head.TreeHead(
+                self.tree_size, 0, tree.get_root_hash())
+        indices = self._random_indices()[:min(self.samples, 4)]
+        proofs = [(leaf_hashes[i], i,
+                   tree.get_inclusion_proof(i, self.tree_size), sth)
+                  for i in indices]
+        self._record("MerkleVerifier.verify_leaf_hash_inclusion",
+                     self.verifier.verify_leaf_hash_inclusion,
+                     proofs * (self.samples // len(proofs) + 1))
+        cached = merkle.MerkleVerifier(cache_size=self.samples * 64)
+        for args in proofs:
+            cached.verify_leaf_hash_inclusion(*args)
+        self._record("MerkleVerifier.verify_leaf_hash_inclusion.warm_cache",
+                     cached.verify_leaf_hash_inclusion,
+                     proofs * (self.samples // len(proofs) + 1))
+        pairs = self._random_size_pairs()[:min(self.samples, 4)]
+        proofs = [(old, new, tree.get_root_hash(old), tree.get_root_hash(new),
+                   tree.get_consistency_proof(old, new))
+                  for old, new in pairs]
+        self._record("MerkleVerifier.verify_tree_consistency",
+                     self.verifier.verify_tree_consistency,
+                     proofs * (self.samples // len(proofs) + 1))
+
+
+BENCHMARKS = ["hashing", "compact_tree", "in_memory_tree", "leveldb_tree",
+              "verification"]
+
+
+def run_benchmarks(log_sizes, leaf_size=64, samples=100, time_budget=10.0,
+                   benchmarks=BENCHMARKS, seed=0):
+    """Runs the named benchmarks for trees of 2^k leaves, k in log_sizes.
+
+    Returns:
+        A JSON-serialisable dict with the environment and a list of results.
+    """
+    rng = random.Random(seed)
+    hasher = merkle.TreeHasher()
+    leaf = os.urandom(leaf_size)
+    results = [make_result(
+            "hash_leaf", None,
+            time_calls(hasher.hash_leaf, [(leaf,)] * (samples * 100),
+                       time_budget))]
+    for log_size in log_sizes:
+        leaves = [os.urandom(leaf_size) for _ in xrange(2**log_size)]
+        runner = _Benchmarks(leaves, samples, time_budget, rng)
+        for name in benchmarks:
+            getattr(runner, name)()
+        results.extend(runner.results)
+        del leaves, runner
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "leaf_size": leaf_size,
+        "samples": samples,
+        "time_budget": time_budget,
+        "results": results,
+    }
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--min-log-size", type=int, default=10)
+    parser.add_argument("--max-log-size", type=int, default=24)
+    parser.add_argument("--log-size-step", type=int, default=2)
+    parser.add_argument("--leaf-size", type=int, default=64,
+                        help="bytes per random leaf")
+    parser.add_argument("--samples", type=int, default=100,
+                        help="maximum timed calls per operation")
+    parser.add_argument("--time-budget", type=float, default=10.0,
+                        help="seconds to spend sampling each operation")
+    parser.add_argument("--benchmarks", default=",".join(BENCHMARKS),
+                        help="comma-separated subset of %s" %
+                        ", ".join(BENCHMARKS))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="file to write JSON to")
+    args = parser.parse_args(argv)
+
+    benchmarks = [b for b in args.benchmarks.split(",") if b]
+    unknown = set(benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error("unknown benchmarks: %s" % ", ".join(sorted(unknown)))
+    report = run_benchmarks(
+            range(args.min_log_size, args.max_log_size + 1,
+                  args.log_size_step),
+            leaf_size=args.leaf_size, samples=args.samples,
+            time_budget=args.time_budget, benchmarks=benchmarks,
+            seed=args.seed)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+
+"""Tests for the benchmark harness."""
+
+import json
+import unittest
+
+import benchmark
+
+
+class BenchmarkTest(unittest.TestCase):
+    """Smoke tests for the benchmark harness."""
+
+    def test_run_benchmarks(self):
+        report = benchmark.run_benchmarks([3, 4], samples=3, time_budget=1.0)
+        json.dumps(report)
+        names = set(r["name"] for r in report["results"])
+        for name in ["hash_leaf", "hash_full_tree", "hash_level",
+                     "CompactMerkleTree.append", "CompactMerkleTree.extend",
+                     "InMemoryMerkleTree.get_inclusion_proof",
+                     "LeveldbMerkleTree.get_consistency_proof",
+                     "MerkleVerifier.verify_leaf_hash_inclusion",
+                     "MerkleVerifier.verify_tree_consistency"]:
+            self.assertTrue(name in names, name)
+        for result in report["results"]:
+            self.assertTrue(result["ops"] > 0)
+            self.assertTrue(result["p50_us"] <= result["p99_us"])
+            self.assertTrue(result["peak_rss_kb"] > 0)
+
+    def test_subset(self):
+        report = benchmark.run_benchmarks([2], samples=2, time_budget=1.0,
+                                          benchmarks=["compact_tree"])
+        self.assertEqual(
+                sorted(set(r["name"] for r in report["results"])),
+                ["CompactMerkleTree.append", "CompactMerkleTree.extend",
+                 "hash_leaf"])
+
+    def test_tiny_budget_still_builds_full_trees(self):
+        report = benchmark.run_benchmarks(
+                [12], samples=5, time_budget=0.0,
+                benchmarks=["compact_tree", "leveldb_tree"])
+        results = dict((r["name"], r) for r in report["results"])
+        self.assertEqual(results["CompactMerkleTree.append"]["ops"], 4096)
+        self.assertEqual(results["CompactMerkleTree.extend"]["calls"], 4)
+        self.assertEqual(results["LeveldbMerkleTree.extend"]["ops"], 4096)
+        self.assertEqual(
+                results["LeveldbMerkleTree.get_inclusion_proof"]["calls"], 1)
+
+    def test_percentile(self):
+        values = range(101)
+        self.assertEqual(benchmark._percentile(values, 0.5), 50)
+        self.assertEqual(benchmark._percentile(values, 0.99), 99)
+        self.assertEqual(benchmark._percentile([], 0.5), 0.0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,108 @@
+"""Bloom filter over digests.
+
+Answers "definitely not present" for membership queries without touching the
+backing store. Items are expected to be cryptographic digests (e.g. leaf
+hashes), so their bytes are used directly to derive the filter positions.
+"""
+
+from collections import namedtuple
+import hashlib
+import math
+import struct
+
+
+BloomFilterStats = namedtuple("BloomFilterStats", [
+    "items", "capacity", "false_positive_rate", "lookups", "definite_misses",
+    "maybe_hits", "false_positives"])
+
+
+class BloomFilter(object):
+    """A fixed-size Bloom filter using double hashing.
+
+    Attributes:
+        capacity: Number of items the filter was sized for.
+        false_positive_rate: Expected false-positive rate at capacity.
+        num_bits: Size of the bit array.
+        num_hashes: Number of bit positions set per item.
+    """
+
+    def __init__(self, capacity, false_positive_rate=0.01):
+        if capacity <= 0:
+            raise ValueError("Capacity must be positive: %d" % capacity)
+        if not 0 < false_positive_rate < 1:
+            raise ValueError("False positive rate must be in (0, 1): %r" %
+                             false_positive_rate)
+        self.capacity = capacity
+        self.false_positive_rate = false_positive_rate
+        ln2 = math.log(2)
+        self.num_bits = max(8, int(math.ceil(
+                -capacity * math.log(false_positive_rate) / (ln2 * ln2))))
+        self.num_hashes = max(1, int(round(
+                float(self.num_bits) / capacity * ln2)))
+        self.__bits = bytearray((self.num_bits + 7) // 8)
+        self.__items = 0
+        self.reset_stats()
+
+    def __repr__(self):
+        return "%s(%r, %r)" % (self.__class__.__name__, self.capacity,
+                               self.false_positive_rate)
+
+    def __len__(self):
+        """Returns the number of items added (duplicates included)."""
+        return self.__items
+
+    def _positions(self, item):
+        if len(item) < 16:
+            item = hashlib.sha256(item).digest()
+        h1, h2 = struct.unpack(">QQ", item[:16])
+        h2 |= 1
+        m = self.num_bits
+        return [(h1 + i * h2) % m for i in xrange(self.num_hashes)]
+
+    def add(self, item):
+        """Adds |item| to the filter."""
+        bits = self.__bits
+        for pos in self._positions(item):
+            bits[pos >> 3] |= 1 << (pos & 7)
+        self.__items += 1
+
+    def update(self, items):
+        """Adds every item in |items| to the filter."""
+        for item in items:
+            self.add(item)
+
+    def __contains__(self, item):
+        bits = self.__bits
+        for pos in self._positions(item):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def might_contain(self, item):
+        """Like |item in filter|, but also records lookup statistics."""
+        self.__lookups += 1
+        if item in self:
+            self.__maybe_hits += 1
+            return True
+        self.__definite_misses += 1
+        return False
+
+    def record_false_positive(self):
+        """Records that a positive answer was not confirmed by the store."""
+        self.__false_positives += 1
+
+    def reset_stats(self):
+        self.__lookups = 0
+        self.__definite_misses = 0
+        self.__maybe_hits = 0
+        self.__false_positives = 0
+
+    @property
+    def stats(self):
+        return BloomFilterStats(
+                items=self.__items, capacity=self.capacity,
+                false_positive_rate=self.false_positive_rate,
+                lookups=self.__lookups,
+                definite_misses=self.__definite_misses,
+                maybe_hits=self.__maybe_hits,
+                false_positives=self.__false_positives)
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+"""Tests for BloomFilter."""
+
+import hashlib
+import unittest
+
+import bloom_filter
+
+
+def digests(start, stop):
+    return [hashlib.sha256(str(i)).digest() for i in xrange(start, stop)]
+
+
+class BloomFilterTest(unittest.TestCase):
+    """Tests for BloomFilter."""
+
+    def test_no_false_negatives(self):
+        bloom = bloom_filter.BloomFilter(1000, 0.01)
+        items = digests(0, 1000)
+        bloom.update(items)
+        self.assertEqual(len(bloom), 1000)
+        for item in items:
+            self.assertTrue(item in bloom)
+
+    def test_false_positive_rate(self):
+        bloom = bloom_filter.BloomFilter(1000, 0.01)
+        bloom.update(digests(0, 1000))
+        false_positives = sum(1 for d in digests(1000, 11000) if d in bloom)
+        # Expected around 100; allow generous slack.
+        self.assertLess(false_positives, 300)
+
+    def test_short_items(self):
+        bloom = bloom_filter.BloomFilter(10, 0.01)
+        bloom.add("abc")
+        self.assertTrue("abc" in bloom)
+
+    def test_stats(self):
+        bloom = bloom_filter.BloomFilter(100, 0.01)
+        present = digests(0, 10)
+        bloom.update(present)
+        for item in present:
+            self.assertTrue(bloom.might_contain(item))
+        absent = [d for d in digests(10, 100) if d not in bloom]
+        for item in absent:
+            self.assertFalse(bloom.might_contain(item))
+        bloom.record_false_positive()
+        stats = bloom.stats
+        self.assertEqual(stats.items, 10)
+        self.assertEqual(stats.lookups, 10 + len(absent))
+        self.assertEqual(stats.maybe_hits, 10)
+        self.assertEqual(stats.definite_misses, len(absent))
+        self.assertEqual(stats.false_positives, 1)
+        bloom.reset_stats()
+        self.assertEqual(bloom.stats.lookups, 0)
+
+    def test_bad_parameters(self):
+        self.assertRaises(ValueError, bloom_filter.BloomFilter, 0)
+        self.assertRaises(ValueError, bloom_filter.BloomFilter, 10, 0)
+        self.assertRaises(ValueError, bloom_filter.BloomFilter, 10, 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python2
+
+"""Bulk loading of a LeveldbMerkleTree from a leaf dump.
+
+A dump is a sequence of leaves, each a 4-byte big-endian length followed by
+that many bytes. Leaves are streamed from the dump, hashed on a pool of worker
+processes and appended in large write batches, so memory use is bounded by
+the batch size (plus the tree's Bloom filter, if enabled) rather than by the
+number of leaves. Once loaded, a tree head is published as a checkpoint.
+
+    python -m bulk_load --db ./merkle_db leaves.dump
+    producer | python -m bulk_load --db ./merkle_db -
+"""
+
+import argparse
+import collections
+import itertools
+import logging
+import multiprocessing
+import struct
+import sys
+
+import leveldb_merkle_tree
+import merkle
+
+
+_LENGTH_FORMAT = ">I"
+_LENGTH_SIZE = struct.calcsize(_LENGTH_FORMAT)
+
+
+def read_leaves(fileobj):
+    """Yields the leaves of a dump read from |fileobj|.
+
+    Raises:
+        ValueError: the dump is truncated.
+    """
+    while True:
+        header = fileobj.read(_LENGTH_SIZE)
+        if not header:
+            return
+        if len(header) != _LENGTH_SIZE:
+            raise ValueError("Truncated leaf length")
+        length, = struct.unpack(_LENGTH_FORMAT, header)
+        leaf = fileobj.read(length)
+        if len(leaf) != length:
+            raise ValueError("Truncated leaf: expected %d bytes, got %d" %
+                             (length, len(leaf)))
+        yield leaf
+
+
+def write_leaves(fileobj, leaves):
+    """Writes |leaves| to |fileobj| as a dump."""
+    for leaf in leaves:
+        fileobj.write(struct.pack(_LENGTH_FORMAT, len(leaf)))
+        fileobj.write(leaf)
+
+
+def _batches(iterable, batch_size):
+    it = iter(iterable)
+    while True:
+        batch = list(itertools.islice(it, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def _hash_batch(args):
+    hash_algorithm, leaves = args
+    hash_leaf = merkle.TreeHasher(hash_algorithm).hash_leaf
+    return [hash_leaf(l) for l in leaves]
+
+
+def _hashed_batches(batches, hash_algorithm, processes):
+    """Yields the leaf hashes of each batch, in order.
+
+    At most 2 * |processes| batches are in flight at any time.
+    """
+    if not processes:
+        for batch in batches:
+            yield _hash_batch((hash_algorithm, batch))
+        return
+    pool = multiprocessing.Pool(processes)
+    try:
+        pending = collections.deque()
+        for batch in batches:
+            pending.append(pool.apply_async(_hash_batch,
+                                            ((hash_algorithm, batch),)))
+            if len(pending) >= 2 * processes:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def bulk_load(tree, leaves, batch_size=65536, processes=None,
+              timestamp=None):
+    """Appends |leaves| to |tree| and publishes a tree head.
+
+    Args:
+        tree: a LeveldbMerkleTree.
+        leaves: an iterable of leaves, e.g. read_leaves(fileobj).
+        batch_size: leaves hashed and written per write batch.
+        processes: number of hashing processes; defaults to the number of
+            CPUs, and 0 hashes in this process.
+        timestamp: timestamp of the published tree head, in milliseconds.
+
+    Returns:
+        The published TreeHead.
+    """
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    loaded = 0
+    for leaf_hashes in _hashed_batches(_batches(leaves, batch_size),
+                                       tree.hash_algorithm, processes):
+        tree.extend_hashes(leaf_hashes)
+        loaded += len(leaf_hashes)
+        logging.info("Loaded %d leaves", loaded)
+    return tree.publish_tree_head(timestamp=timestamp)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("dump", help="leaf dump file, or - for stdin")
+    parser.add_argument("--db", default="./merkle_db")
+    parser.add_argument("--batch-size", type=int, default=65536)
+    parser.add_argument("--processes", type=int, default=None,
+                        help="hashing processes (default: one per CPU)")
+    parser.add_argument("--hash-algorithm", default=None,
+                        help="for new databases (default: sha256)")
+    parser.add_argument("--no-bloom-filter", action="store_true",
+                        help="do not keep a Bloom filter over leaf hashes")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    tree = leveldb_merkle_tree.LeveldbMerkleTree(
+            db=args.db, hash_algorithm=args.hash_algorithm,
+            bloom_false_positive_rate=None if args.no_bloom_filter else 0.01)
+    try:
+        if args.dump == "-":
+            head = bulk_load(tree, read_leaves(sys.stdin), args.batch_size,
+                             args.processes)
+        else:
+            with open(args.dump, "rb") as f:
+                head = bulk_load(tree, read_leaves(f), args.batch_size,
+                                 args.processes)
+    finally:
+        tree.close()
+    print "tree_size: %d" % head.tree_size
+    print "timestamp: %d" % head.timestamp
+    print "root_hash: %s" % head.root_hash.encode("hex")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+
+"""Tests for bulk_load."""
+
+import shutil
+import StringIO
+import tempfile
+import unittest
+
+import bulk_load
+import leveldb_merkle_tree
+import merkle
+
+
+class BulkLoadTest(unittest.TestCase):
+    """Tests for bulk_load."""
+
+    def setUp(self):
+        self.db = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.db)
+
+    def test_read_write_leaves(self):
+        leaves = ["", "a", "b" * 300]
+        dump = StringIO.StringIO()
+        bulk_load.write_leaves(dump, leaves)
+        dump.seek(0)
+        self.assertEqual(list(bulk_load.read_leaves(dump)), leaves)
+
+    def test_truncated_dump(self):
+        dump = StringIO.StringIO()
+        bulk_load.write_leaves(dump, ["abc"])
+        for truncated in (dump.getvalue()[:2], dump.getvalue()[:-1]):
+            self.assertRaises(ValueError, list, bulk_load.read_leaves(
+                    StringIO.StringIO(truncated)))
+
+    def _load(self, leaves, **kwargs):
+        dump = StringIO.StringIO()
+        bulk_load.write_leaves(dump, leaves)
+        dump.seek(0)
+        tree = leveldb_merkle_tree.LeveldbMerkleTree(db=self.db)
+        head = bulk_load.bulk_load(tree, bulk_load.read_leaves(dump),
+                                   timestamp=1, **kwargs)
+        return tree, head
+
+    def test_bulk_load(self):
+        leaves = [str(i) for i in range(100)]
+        tree, head = self._load(leaves, batch_size=7, processes=0)
+        root = merkle.TreeHasher().hash_full_tree(leaves)
+        self.assertEqual(head.tree_size, 100)
+        self.assertEqual(head.root_hash, root)
+        self.assertEqual(tree.get_root_hash(), root)
+        self.assertEqual(tree.get_latest_tree_head(), head)
+        self.assertEqual(tree.get_leaf_index(
+                merkle.TreeHasher().hash_leaf("42")), 42)
+        tree.close()
+
+    def test_bulk_load_in_processes(self):
+        leaves = [str(i) for i in range(100)]
+        tree, head = self._load(leaves, batch_size=8, processes=2)
+        self.assertEqual(head.root_hash,
+                         merkle.TreeHasher().hash_full_tree(leaves))
+        tree.close()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,46 @@
+"""Locating the first leaf at which two trees differ.
+
+find_divergence() binary-searches the trees' node hashes, so finding where a
+replica went wrong takes O(log n) hash comparisons rather than a pass over
+the leaves. Each tree is anything with get_subtree_hash(start, end) and a
+tree size: LeveldbMerkleTree, InMemoryMerkleTree or, for a remote log,
+TileClient or any other fetcher of node hashes.
+
+>>> index = divergence.find_divergence(replica, tile_client.TileClient(src))
+>>> if index is not None:
+...     repair(replica, index)
+"""
+
+
+def tree_size_of(tree):
+    """Returns the size of |tree|, whose tree_size is a property or method."""
+    tree_size = tree.tree_size
+    return tree_size() if callable(tree_size) else tree_size
+
+
+def find_divergence(tree, other, tree_size=None):
+    """Returns the index of the first leaf at which two trees differ.
+
+    Only the first |tree_size| leaves are compared, by default as many as
+    the smaller tree has.
+
+    Returns:
+        The index of the first differing leaf, or None if the trees agree on
+        all compared leaves, i.e. one extends the other.
+    """
+    if tree_size is None:
+        tree_size = min(tree_size_of(tree), tree_size_of(other))
+    start, end = 0, tree_size
+    if start == end or (tree.get_subtree_hash(start, end) ==
+                        other.get_subtree_hash(start, end)):
+        return None
+    # [start, end) is a node of the tree whose hashes differ; one of its
+    # children differs too.
+    while end - start > 1:
+        mid = start + (1 << ((end - start - 1).bit_length() - 1))
+        if (tree.get_subtree_hash(start, mid) !=
+            other.get_subtree_hash(start, mid)):
+            end = mid
+        else:
+            start = mid
+    return start
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+"""Tests for divergence."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import divergence
+import in_memory_merkle_tree
+import leveldb_merkle_tree
+import tile_client
+import tile_export
+
+
+class _CountingTree(object):
+    """Counts the subtree hashes read from a tree."""
+
+    def __init__(self, tree):
+        self.tree = tree
+        self.reads = 0
+
+    def tree_size(self):
+        return self.tree.tree_size()
+
+    def get_subtree_hash(self, start, end):
+        self.reads += 1
+        return self.tree.get_subtree_hash(start, end)
+
+
+class FindDivergenceTest(unittest.TestCase):
+    """Tests for find_divergence()."""
+
+    def _tree(self, leaves):
+        return in_memory_merkle_tree.InMemoryMerkleTree(leaves)
+
+    def test_finds_first_difference(self):
+        leaves = [str(i) for i in range(1000)]
+        for index in (0, 1, 255, 256, 511, 700, 999):
+            changed = leaves[:index] + ["x"] + leaves[index + 1:]
+            changed[900] = "y"
+            tree = _CountingTree(self._tree(changed))
+            self.assertEqual(divergence.find_divergence(
+                    self._tree(leaves), tree), min(index, 900))
+            self.assertTrue(tree.reads <= 11)
+
+    def test_prefixes_do_not_diverge(self):
+        leaves = [str(i) for i in range(50)]
+        self.assertEqual(divergence.find_divergence(
+                self._tree(leaves), self._tree(leaves[:30])), None)
+        self.assertEqual(divergence.find_divergence(
+                self._tree(leaves), self._tree([])), None)
+        self.assertEqual(divergence.find_divergence(
+                self._tree(leaves), self._tree(leaves[:30] + ["x"])), 30)
+        self.assertEqual(divergence.find_divergence(
+                self._tree(leaves), self._tree(leaves[:30] + ["x"]),
+                tree_size=30), None)
+
+    def test_leveldb_against_tiles(self):
+        directory = tempfile.mkdtemp()
+        try:
+            primary = leveldb_merkle_tree.LeveldbMerkleTree(
+                    db=os.path.join(directory, "primary"))
+            replica = leveldb_merkle_tree.LeveldbMerkleTree(
+                    db=os.path.join(directory, "replica"))
+            leaves = [str(i) for i in range(600)]
+            primary.extend(leaves)
+            exporter = tile_export.TileExporter(
+                    primary, os.path.join(directory, "tiles"))
+            exporter.export(primary.publish_tree_head(timestamp=1))
+            client = tile_client.TileClient(tile_client.DirectoryTileSource(
+                    os.path.join(directory, "tiles")))
+            replica.extend(leaves[:400] + ["x"] + leaves[401:])
+            self.assertEqual(divergence.find_divergence(replica, client), 400)
+            self.assertEqual(divergence.find_divergence(primary, client),
+                             None)
+            primary.close()
+            replica.close()
+        finally:
+            shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -7,6 +7,7 @@ Not particularly efficient.
 import math
 
 import merkle
+import tree_export
 
 
 def _down_to_power_of_two(n):
@@ -29,6 +30,10 @@ class InMemoryMerkleTree(object):
         self.__leaves = list(leaves)
         self.__hasher = merkle.TreeHasher()
 
+    @property
+    def hasher(self):
+        return self.__hasher
+
     def _hashed_leaves(self):
         """Returns an array of hashed leaves."""
         return [self.__hasher.hash_leaf(t) for t in self.__leaves]
@@ -50,6 +55,33 @@ class InMemoryMerkleTree(object):
             raise ValueError("Specified size beyond known tree: %d" % tree_size)
         return self.__hasher.hash_full_tree(self.__leaves[:tree_size])
 
+    def get_subtree_hash(self, start, end):
+        """Returns MTH(D[start:end]), the tree hash of the leaves [start, end).
+        """
+        if not 0 <= start <= end <= self.tree_size():
+            raise ValueError("Bad range [%d, %d) for tree size %d" %
+                             (start, end, self.tree_size()))
+        return self.__hasher.hash_full_tree(self.__leaves[start:end])
+
+    def export_snapshot(self, tree_size, fileobj):
+        """Writes the tree at |tree_size| to |fileobj| (see tree_export).
+
+        The export can be imported by LeveldbMerkleTree.import_snapshot().
+        There is no InMemoryMerkleTree.import_snapshot(): this tree keeps the
+        leaves themselves, and an export only holds their hashes.
+        """
+        if tree_size is None:
+            tree_size = self.tree_size()
+        if tree_size < 0 or tree_size > self.tree_size():
+            raise ValueError("Specified tree size is beyond known tree: %d" %
+                             tree_size)
+        frontier = merkle.CompactMerkleTree(self.__hasher)
+        frontier.extend(self.__leaves[:tree_size])
+        tree_export.write_export(fileobj, self.__hasher.algorithm, tree_size,
+                                 self.__hasher.digest_size,
+                                 [self._hashed_leaves()[:tree_size]],
+                                 frontier.hashes, frontier.root_hash())
+
     def get_leaf_index(self, leaf_hash):
         """Returns the index of the leaf hash, or -1 if not present."""
         try:
@@ -125,3 +157,30 @@ class InMemoryMerkleTree(object):
         return self._calculate_inclusion_proof(
                 self.__leaves[:tree_size], leaf_index)
 
+    def get_range_proof(self, start, end, tree_size=None):
+        """Returns a proof for the leaves [start, end), see
+        merkle.calculate_range_proof()."""
+        if tree_size is None:
+            tree_size = self.tree_size()
+        if tree_size > self.tree_size():
+            raise ValueError("Specified tree size is beyond known tree: %d" %
+                    tree_size)
+        return merkle.calculate_range_proof(
+                start, end, tree_size,
+                self.get_subtree_hash)
+
+    def get_inclusion_proof_upgrade(self, leaf_index, old_size,
+                                    tree_size=None):
+        """Returns the nodes upgrading an inclusion proof to |tree_size|.
+
+        |tree_size| defaults to the current size. See
+        merkle.calculate_inclusion_proof_upgrade().
+        """
+        if tree_size is None:
+            tree_size = self.tree_size()
+        if tree_size > self.tree_size():
+            raise ValueError("Specified tree size is beyond known tree: %d" %
+                    tree_size)
+        return merkle.calculate_inclusion_proof_upgrade(
+                leaf_index, old_size, tree_size,
+                self.get_subtree_hash)
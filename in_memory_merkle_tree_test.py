@@ -4,10 +4,12 @@
 
 from collections import namedtuple
 
+import StringIO
 import unittest
 
 import in_memory_merkle_tree
 import merkle
+import tree_export
 
 PathTestVector = namedtuple("PathTestVector",
     ["leaf", "tree_size_snapshot", "path_length", "path"])
@@ -217,5 +219,31 @@ class InMemoryMerkleTreeTest(unittest.TestCase):
         self.assertRaises(ValueError,
                           tree.get_consistency_proof, n - 1, n - 3)
 
+    def test_tree_export_snapshot(self):
+        """Test that an export holds the leaf hashes, frontier and root."""
+        tree = in_memory_merkle_tree.InMemoryMerkleTree(TEST_VECTOR_DATA)
+        out = StringIO.StringIO()
+        tree.export_snapshot(7, out)
+        reader = tree_export.ExportReader(StringIO.StringIO(out.getvalue()))
+        self.assertEqual(reader.tree_size, 7)
+        self.assertEqual(sum(reader.leaf_hash_chunks(), []),
+                         tree._hashed_leaves()[:7])
+        node_hashes, root_hash = reader.finish()
+        self.assertEqual(len(node_hashes), 3)
+        self.assertEqual(root_hash, tree.get_root_hash(7))
+        self.assertRaises(ValueError, tree.export_snapshot, 9,
+                          StringIO.StringIO())
+
+    def test_tree_inclusion_proof_upgrade(self):
+        """Test that upgraded proofs match proofs at the new size."""
+        tree = in_memory_merkle_tree.InMemoryMerkleTree(
+                [str(i) for i in range(11)])
+        old_proof = tree.get_inclusion_proof(2, 5)
+        upgrade = tree.get_inclusion_proof_upgrade(2, 5, 11)
+        self.assertEqual(merkle.upgrade_inclusion_proof(
+                2, 5, old_proof, 11, upgrade),
+                         tree.get_inclusion_proof(2, 11))
+        self.assertEqual(tree.get_inclusion_proof_upgrade(2, 5), upgrade)
+
 if __name__ == "__main__":
     unittest.main()
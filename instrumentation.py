@@ -0,0 +1,283 @@
+"""Opt-in instrumentation for hashers, trees and verifiers.
+
+Nothing here costs anything until an object is instrumented: the instrument_*
+functions shadow the object's methods with counting and timing wrappers on
+that instance only, and uninstrument() removes them again.
+
+>>> stats = instrumentation.Stats()
+>>> instrumentation.instrument_tree(tree, stats)
+>>> stats.add_timing_callback(lambda name, seconds: log(name, seconds))
+>>> tree.get_inclusion_proof(5)
+>>> stats.snapshot().counters["db.reads"]
+"""
+
+from collections import namedtuple
+import collections
+import functools
+import threading
+import timeit
+
+
+StatsSnapshot = namedtuple("StatsSnapshot", ["counters", "timings"])
+
+Timing = namedtuple("Timing", ["calls", "total_seconds", "max_seconds"])
+
+
+class Stats(object):
+    """Thread-safe counters and timings, fed by instrumented objects."""
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__counters = {}
+        self.__timings = {}
+        self.__sources = {}
+        self.__timing_callbacks = []
+
+    def increment(self, name, amount=1):
+        with self.__lock:
+            self.__counters[name] = self.__counters.get(name, 0) + amount
+
+    def record_timing(self, name, seconds):
+        """Records a timed call and passes it on to the timing callbacks."""
+        with self.__lock:
+            calls, total, longest = self.__timings.get(name, (0, 0.0, 0.0))
+            self.__timings[name] = Timing(calls + 1, total + seconds,
+                                          max(longest, seconds))
+            callbacks = list(self.__timing_callbacks)
+        for callback in callbacks:
+            callback(name, seconds)
+
+    def add_timing_callback(self, callback):
+        """Calls callback(name, seconds) after every timed call."""
+        with self.__lock:
+            self.__timing_callbacks.append(callback)
+
+    def remove_timing_callback(self, callback):
+        with self.__lock:
+            self.__timing_callbacks.remove(callback)
+
+    def add_source(self, prefix, source):
+        """Merges the counters returned by source() into every snapshot.
+
+        source() must return a dict (or namedtuple) of numbers; its keys are
+        reported as prefix + "." + key.
+        """
+        with self.__lock:
+            self.__sources[prefix] = source
+
+    def remove_source(self, prefix):
+        with self.__lock:
+            self.__sources.pop(prefix, None)
+
+    def snapshot(self):
+        """Returns a StatsSnapshot copy of the current counters and timings."""
+        with self.__lock:
+            counters = dict(self.__counters)
+            timings = dict(self.__timings)
+            sources = dict(self.__sources)
+        for prefix, source in sources.items():
+            values = source()
+            if values is None:
+                continue
+            if hasattr(values, "_asdict"):
+                values = values._asdict()
+            for key, value in values.items():
+                counters["%s.%s" % (prefix, key)] = value
+        return StatsSnapshot(counters, timings)
+
+    def reset(self):
+        with self.__lock:
+            self.__counters.clear()
+            self.__timings.clear()
+
+
+# Marks a shadowed name that was not an instance attribute.
+_MISSING = object()
+
+
+def _shadow(obj, name, make_wrapper):
+    """Shadows obj.name with make_wrapper(original) on the instance.
+
+    The instance's own value of the name, if any, is kept for uninstrument().
+    """
+    original = getattr(obj, name)
+    wrapper = make_wrapper(original)
+    if callable(original):
+        wrapper = functools.wraps(original)(wrapper)
+    shadowed = obj.__dict__.setdefault("_instrumented",
+                                       collections.OrderedDict())
+    if name not in shadowed:
+        shadowed[name] = obj.__dict__.get(name, _MISSING)
+    setattr(obj, name, wrapper)
+
+
+def _on_uninstrument(obj, hook):
+    """Calls hook() when obj is uninstrumented."""
+    obj.__dict__.setdefault("_uninstrument_hooks", []).append(hook)
+
+
+def _timed(obj, name, stats, timing_name):
+    timer = timeit.default_timer
+    def make_wrapper(original):
+        def wrapper(*args, **kwargs):
+            start = timer()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                stats.record_timing(timing_name, timer() - start)
+        return wrapper
+    _shadow(obj, name, make_wrapper)
+
+
+def uninstrument(obj):
+    """Removes all instrumentation from obj.
+
+    Shadowed instance attributes get their original values back, and for a
+    tree the hasher and the Bloom filter source are unhooked too.
+    """
+    for hook in obj.__dict__.pop("_uninstrument_hooks", []):
+        hook()
+    for name, original in obj.__dict__.pop("_instrumented", {}).items():
+        if original is _MISSING:
+            delattr(obj, name)
+        else:
+            setattr(obj, name, original)
+
+
+def instrument_hasher(hasher, stats, prefix="hasher"):
+    """Counts hash calls and bytes hashed by a TreeHasher."""
+    def leaf(original):
+        def hash_leaf(data):
+            stats.increment(prefix + ".hash_leaf")
+            stats.increment(prefix + ".bytes_hashed", len(data) + 1)
+            return original(data)
+        return hash_leaf
+    def children(original):
+        def hash_children(left, right):
+            stats.increment(prefix + ".hash_children")
+            stats.increment(prefix + ".bytes_hashed",
+                            len(left) + len(right) + 1)
+            return original(left, right)
+        return hash_children
+    _shadow(hasher, "hash_leaf", leaf)
+    _shadow(hasher, "hash_children", children)
+
+
+class _CountingIterator(object):
+    def __init__(self, it, stats, prefix):
+        self.__it = it
+        self.__stats = stats
+        self.__prefix = prefix
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        item = next(self.__it)
+        self.__stats.increment(self.__prefix + ".keys_scanned")
+        return item
+
+    def seek(self, target):
+        self.__stats.increment(self.__prefix + ".seeks")
+        self.__it.seek(target)
+
+    def __getattr__(self, name):
+        return getattr(self.__it, name)
+
+
+class _CountingKeyspace(object):
+    """Counts reads through a keyspace (a PrefixedDB or a snapshot view)."""
+
+    def __init__(self, keyspace, stats, prefix):
+        self.__keyspace = keyspace
+        self.__stats = stats
+        self.__prefix = prefix
+
+    def get(self, *args, **kwargs):
+        self.__stats.increment(self.__prefix + ".reads")
+        return self.__keyspace.get(*args, **kwargs)
+
+    def iterator(self, *args, **kwargs):
+        self.__stats.increment(self.__prefix + ".scans")
+        return _CountingIterator(self.__keyspace.iterator(*args, **kwargs),
+                                 self.__stats, self.__prefix)
+
+    def __getattr__(self, name):
+        return getattr(self.__keyspace, name)
+
+
+_KEYSPACES = ["_leaves_db", "_index_db", "_stats_db", "_sth_db", "_tiles_db"]
+
+_TIMED_TREE_METHODS = ["get_root_hash", "get_inclusion_proof",
+                       "get_consistency_proof", "get_leaf_index",
+                       "get_leaf_indices", "extend", "extend_hashes",
+                       "add_leaf"]
+
+
+def _count_keyspaces(reader, stats, prefix):
+    for name in _KEYSPACES:
+        keyspace = getattr(reader, name, None)
+        if keyspace is not None and name not in reader.__dict__.get(
+                "_instrumented", []):
+            _shadow(reader, name, lambda original: _CountingKeyspace(
+                    original, stats, prefix))
+
+
+def instrument_tree(tree, stats, prefix=None):
+    """Instruments a tree class instance and its hasher.
+
+    Public read and write methods are timed (as prefix.method). For
+    LeveldbMerkleTree, database reads, keys scanned and write batch sizes are
+    counted too (as db.*), including for views returned by snapshot(), and the
+    Bloom filter statistics are included in snapshots (as bloom.*).
+    """
+    if prefix is None:
+        prefix = tree.__class__.__name__
+    hasher = tree.hasher
+    instrument_hasher(hasher, stats)
+    _on_uninstrument(tree, lambda: uninstrument(hasher))
+    for name in _TIMED_TREE_METHODS:
+        if hasattr(tree, name):
+            _timed(tree, name, stats, "%s.%s" % (prefix, name))
+    if not hasattr(tree, "snapshot"):
+        return
+    _count_keyspaces(tree, stats, "db")
+    def snapshot(original):
+        def counted_snapshot():
+            view = original()
+            _count_keyspaces(view, stats, "db")
+            return view
+        return counted_snapshot
+    _shadow(tree, "snapshot", snapshot)
+    def extend_hashes(original):
+        def counted_extend_hashes(leaf_hashes, *args, **kwargs):
+            stats.increment("db.write_batches")
+            stats.increment("db.leaves_written", len(leaf_hashes))
+            return original(leaf_hashes, *args, **kwargs)
+        return counted_extend_hashes
+    _shadow(tree, "extend_hashes", extend_hashes)
+    stats.add_source("bloom", lambda: tree.bloom_filter and
+                     tree.bloom_filter.stats)
+    _on_uninstrument(tree, lambda: stats.remove_source("bloom"))
+
+
+def instrument_verifier(verifier, stats, prefix="verifier"):
+    """Counts proofs checked by a MerkleVerifier and failures by type.
+
+    The verifier's hasher is not instrumented, since verifiers constructed
+    with the default hasher share it; use instrument_hasher() for that.
+    """
+    def counted(kind):
+        def make_wrapper(original):
+            def wrapper(*args, **kwargs):
+                stats.increment("%s.%s_checked" % (prefix, kind))
+                try:
+                    return original(*args, **kwargs)
+                except Exception as e:
+                    stats.increment("%s.failures.%s" % (
+                            prefix, e.__class__.__name__))
+                    raise
+            return wrapper
+        return make_wrapper
+    _shadow(verifier, "verify_tree_consistency", counted("consistency"))
+    _shadow(verifier, "verify_leaf_hash_inclusion", counted("inclusion"))
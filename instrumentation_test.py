@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+"""Tests for instrumentation."""
+
+import shutil
+import tempfile
+import unittest
+
+import error
+import in_memory_merkle_tree
+import instrumentation
+import leveldb_merkle_tree
+import merkle
+
+
+class InstrumentationTest(unittest.TestCase):
+    """Tests for the instrument_* functions."""
+
+    def setUp(self):
+        self.stats = instrumentation.Stats()
+
+    def test_hasher_counts(self):
+        hasher = merkle.TreeHasher()
+        instrumentation.instrument_hasher(hasher, self.stats)
+        root = hasher.hash_full_tree(["a", "b", "c"])
+        self.assertEqual(root, merkle.TreeHasher().hash_full_tree(
+                ["a", "b", "c"]))
+        counters = self.stats.snapshot().counters
+        self.assertEqual(counters["hasher.hash_leaf"], 3)
+        # Two from hashing the tree, one from hash_full_tree's self-check.
+        self.assertEqual(counters["hasher.hash_children"], 3)
+        self.assertEqual(counters["hasher.bytes_hashed"], 3 * 2 + 3 * 65)
+
+    def test_uninstrument(self):
+        hasher = merkle.TreeHasher()
+        instrumentation.instrument_hasher(hasher, self.stats)
+        instrumentation.uninstrument(hasher)
+        hasher.hash_leaf("a")
+        self.assertEqual(self.stats.snapshot().counters, {})
+        self.assertFalse("hash_leaf" in vars(hasher))
+
+    def test_in_memory_tree_timings(self):
+        tree = in_memory_merkle_tree.InMemoryMerkleTree(["a", "b", "c"])
+        instrumentation.instrument_tree(tree, self.stats)
+        seen = []
+        self.stats.add_timing_callback(lambda name, secs: seen.append(name))
+        tree.get_inclusion_proof(1, 3)
+        tree.get_inclusion_proof(2, 3)
+        timing = self.stats.snapshot().timings[
+                "InMemoryMerkleTree.get_inclusion_proof"]
+        self.assertEqual(timing.calls, 2)
+        self.assertTrue(timing.total_seconds >= timing.max_seconds >= 0)
+        self.assertEqual(seen, ["InMemoryMerkleTree.get_inclusion_proof"] * 2)
+        self.assertTrue(self.stats.snapshot().counters["hasher.hash_leaf"] > 0)
+
+    def test_leveldb_tree_counts(self):
+        db = tempfile.mkdtemp()
+        try:
+            tree = leveldb_merkle_tree.LeveldbMerkleTree(db=db)
+            instrumentation.instrument_tree(tree, self.stats)
+            tree.extend([str(i) for i in range(10)])
+            tree.add_leaf("10")
+            counters = self.stats.snapshot().counters
+            self.assertEqual(counters["db.write_batches"], 2)
+            self.assertEqual(counters["db.leaves_written"], 11)
+
+            self.stats.reset()
+            tree.get_inclusion_proof(3, 7)
+            snapshot = self.stats.snapshot()
+            # All nodes come from the single (partial) tile of leaves.
+            self.assertEqual(snapshot.counters["db.scans"], 1)
+            self.assertEqual(snapshot.counters["db.keys_scanned"], 11)
+            self.assertEqual(snapshot.timings[
+                    "LeveldbMerkleTree.get_inclusion_proof"].calls, 1)
+
+            self.assertEqual(tree.get_leaf_index(merkle.TreeHasher().hash_leaf(
+                    "nope")), -1)
+            counters = self.stats.snapshot().counters
+            self.assertEqual(counters["bloom.lookups"], 1)
+
+            instrumentation.uninstrument(tree)
+            self.stats.reset()
+            tree.get_inclusion_proof(3, 7)
+            self.assertFalse("db.reads" in self.stats.snapshot().counters)
+            tree.close()
+        finally:
+            shutil.rmtree(db)
+
+    def test_leveldb_tree_counts_tile_reads(self):
+        db = tempfile.mkdtemp()
+        try:
+            tree = leveldb_merkle_tree.LeveldbMerkleTree(
+                    leaves=[str(i) for i in range(70000)], db=db)
+            instrumentation.instrument_tree(tree, self.stats)
+            tree.get_inclusion_proof(12345)
+            counters = self.stats.snapshot().counters
+            # The leaf's tile and the partial leaf tile at the right edge are
+            # scanned; the nodes above them come from two tile reads.
+            self.assertEqual(counters["db.scans"], 2)
+            self.assertEqual(counters["db.keys_scanned"], 256 + 112)
+            self.assertEqual(counters["db.reads"], 2)
+            instrumentation.uninstrument(tree)
+            tree.close()
+        finally:
+            shutil.rmtree(db)
+
+    def test_uninstrument_tree_restores_keyspaces(self):
+        db = tempfile.mkdtemp()
+        try:
+            tree = leveldb_merkle_tree.LeveldbMerkleTree(db=db)
+            instrumentation.instrument_tree(tree, self.stats)
+            tree.extend(["a", "b"])
+            instrumentation.uninstrument(tree)
+            self.stats.reset()
+            self.assertEqual(tree.tree_size, 2)
+            tree.extend(["c"])
+            head = tree.publish_tree_head(timestamp=1)
+            self.assertEqual(head.tree_size, 3)
+            self.assertEqual(tree.get_latest_tree_head(), head)
+            self.assertEqual(self.stats.snapshot(), ({}, {}))
+            self.assertFalse("_instrumented" in vars(tree.hasher))
+            tree.close()
+        finally:
+            shutil.rmtree(db)
+
+    def test_verifier_counts(self):
+        tree = in_memory_merkle_tree.InMemoryMerkleTree(["a", "b", "c"])
+        verifier = merkle.MerkleVerifier()
+        instrumentation.instrument_verifier(verifier, self.stats)
+        root_2, root_3 = tree.get_root_hash(2), tree.get_root_hash(3)
+        proof = tree.get_consistency_proof(2, 3)
+        verifier.verify_tree_consistency(2, 3, root_2, root_3, proof)
+        self.assertRaises(error.ProofError,
+                          verifier.verify_tree_consistency,
+                          2, 3, root_3, root_3, proof)
+        counters = self.stats.snapshot().counters
+        self.assertEqual(counters["verifier.consistency_checked"], 2)
+        self.assertEqual(counters["verifier.failures.ProofError"], 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -3,11 +3,22 @@
 Operates (and owns) a LevelDB database of leaves which can be updated.
 """
 
+from collections import namedtuple
+import itertools
+import logging
 import plyvel
 import math
+import os
 import struct
+import sys
 
+import bloom_filter
+import error
+import lru_cache
 import merkle
+import tree_export
+import tree_head
+import tree_segment
 
 def _down_to_power_of_two(n):
     """Returns the power-of-2 closest to n."""
@@ -20,99 +31,351 @@ def _down_to_power_of_two(n):
         p -= 1
     return 2**p
 
+# Lower bound on the Bloom filter size, so that small trees do not rebuild the
+# filter on every append.
+_MIN_BLOOM_CAPACITY = 1024
+
 def encode_int(n):
     """Encode an integer into a big-endian bytestring."""
     return struct.pack(">I", n)
 
 def decode_int(n):
     """Decode a big-endian bytestring into an integer."""
-    return stuct.unpack(">I", n)[0]
+    return struct.unpack(">I", n)[0]
 
-class LeveldbMerkleTree(object):
-    """LevelDB Merkle Tree representation."""
+# Interior nodes are stored in tiles: tile (L, N) holds the hashes of nodes
+# N * TILE_WIDTH ... N * TILE_WIDTH + TILE_WIDTH - 1 at level L * TILE_HEIGHT,
+# from which the TILE_HEIGHT levels above them are recomputed. Only complete
+# nodes are stored, so the tiles at the right edge hold fewer hashes. The tiles
+# at level 0 are the leaf hashes themselves, read from the leaves keyspace.
+TILE_HEIGHT = 8
+TILE_WIDTH = 1 << TILE_HEIGHT
 
-    def __init__(self, leaves=None, db="./merkle_db", leaves_db_prefix='leaves-', index_db_prefix='index-', stats_db_prefix='stats-'):
-        """Start with the LevelDB database of leaves provided."""
-        self.__hasher = IncrementalTreeHasher()
-        self.__db = plyvel.DB(db, create_if_missing=True)
-        self.__leaves_db_prefix = leaves_db_prefix
-        self.__index_db_prefix = index_db_prefix
-        self.__stats_db_prefix = stats_db_prefix
-        self.__leaves_db = self.__db.prefixed_db(leaves_db_prefix)
-        self.__index_db = self.__db.prefixed_db(index_db_prefix)
-        self.__stats_db = self.__db.prefixed_db(stats_db_prefix)
-        if leaves is not None:
-            self.extend(leaves)
+# Number of tiles a snapshot keeps in memory: enough for every tile on the
+# paths a proof walks, but bounded so long-lived snapshots do not grow.
+_SNAPSHOT_TILE_CACHE_SIZE = 64
+
+def _tile_key(level, index):
+    return chr(level) + encode_int(index)
+
+class LeafReceipt(namedtuple("LeafReceipt", ["leaf_index", "tree_size",
+                                              "audit_path", "was_new"])):
+    """Proof that a leaf was integrated, emitted when a batch is appended.
+
+    audit_path is the inclusion proof of the leaf at tree_size, the size of
+    the tree right after the batch. was_new is False for leaves that were
+    already in the tree (see LeveldbMerkleTree.extend_hashes()).
+    """
+    __slots__ = ()
+
+def _encode_timestamp(timestamp):
+    return struct.pack(">Q", timestamp)
+
+def _prefix_upper_bound(prefix):
+    """Returns the smallest key greater than all keys starting with prefix."""
+    prefix = prefix.rstrip('\xff')
+    if not prefix:
+        return None
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+class _PrefixedSnapshotIterator(object):
+    """Iterator over one keyspace of a snapshot, like PrefixedDB.iterator()."""
+
+    def __init__(self, snapshot, prefix, start, stop, include_key,
+                 include_value, reverse):
+        self.__it = snapshot.raw_iterator()
+        self.__prefix = prefix
+        self.__start = prefix + (start or '')
+        self.__stop = (prefix + stop if stop is not None else
+                       _prefix_upper_bound(prefix))
+        self.__include_key = include_key
+        self.__include_value = include_value
+        self.__reverse = reverse
+        if not reverse:
+            self.seek(start or '')
+        else:
+            self.__seek_before(self.__stop)
+
+    def __seek_before(self, key):
+        """Moves to the last key before |key|, or the last key if None."""
+        if key is not None:
+            self.__it.seek(key)
+            if self.__it.valid():
+                self.__it.prev()
+                return
+        self.__it.seek_to_last()
+
+    def __iter__(self):
+        return self
+
+    def seek(self, target):
+        """Moves to |target|, like plyvel's Iterator.seek().
+
+        A forward iterator continues from the first key >= target, a reverse
+        one from the last key < target, within the iterator's range.
+        """
+        key = self.__prefix + target
+        if not self.__reverse:
+            self.__it.seek(max(key, self.__start))
+        elif self.__stop is not None and key > self.__stop:
+            self.__seek_before(self.__stop)
+        else:
+            self.__seek_before(key)
+
+    def next(self):
+        it = self.__it
+        if not it.valid():
+            raise StopIteration
+        key = it.key()
+        if self.__stop is not None and key >= self.__stop:
+            raise StopIteration
+        if key < self.__start:
+            raise StopIteration
+        key = key[len(self.__prefix):]
+        value = it.value() if self.__include_value else None
+        if self.__reverse:
+            it.prev()
+        else:
+            it.next()
+        if not self.__include_value:
+            return key
+        if not self.__include_key:
+            return value
+        return key, value
 
     def close(self):
-        self.__db.close()
+        self.__it.close()
+
+class _PrefixedSnapshot(object):
+    """Read-only view of one keyspace of a snapshot, like a PrefixedDB.
+
+    plyvel cannot derive prefixed views from a snapshot, and taking one
+    snapshot per keyspace would not be atomic across keyspaces.
+    """
+
+    def __init__(self, snapshot, prefix):
+        self.__snapshot = snapshot
+        self.__prefix = prefix
+
+    def get(self, key, default=None):
+        return self.__snapshot.get(self.__prefix + key, default)
+
+    def iterator(self, start=None, stop=None, include_key=True,
+                 include_value=True, reverse=False):
+        return _PrefixedSnapshotIterator(self.__snapshot, self.__prefix, start,
+                                         stop, include_key, include_value,
+                                         reverse)
+
+class _LeveldbMerkleTreeReader(object):
+    """Read operations shared by LeveldbMerkleTree and its snapshots.
+
+    Subclasses set _hasher, _bloom, _segments, _segment_height and the
+    _leaves_db, _index_db, _stats_db, _sth_db and _tiles_db keyspaces, which
+    only need to support get() and iterator().
+    """
 
     @property
     def tree_size(self):
-        return int(self.__stats_db.get('tree_size', default='0'))
+        return int(self._stats_db.get('tree_size', default='0'))
 
     @property
     def sha256_root_hash(self):
         return self.get_root_hash()
 
     @property
-    def leaves_db_prefix(self):
-        return self.__leaves_db_prefix
+    def root_hash(self):
+        return self.get_root_hash()
 
     @property
-    def index_db_prefix(self):
-        return self.__index_db_prefix
+    def hash_algorithm(self):
+        return self._hasher.algorithm
 
     @property
-    def stats_db_prefix(self):
-        return self.__stats_db_prefix
+    def hasher(self):
+        return self._hasher
+
+    @property
+    def _segmented_size(self):
+        """The number of leaves rolled over into segments."""
+        if not self._segments:
+            return 0
+        return (int(self._stats_db.get('segments', default='0')) <<
+                self._segment_height)
 
     def get_leaf(self, leaf_index):
         """Get the leaf at leaf_index."""
-        return self.__leaves_db.get(encode_int(leaf_index))
+        if leaf_index < self._segmented_size:
+            segment = self._segments[leaf_index >> self._segment_height]
+            return segment.node(0, leaf_index & (segment.size - 1))
+        return self._leaves_db.get(encode_int(leaf_index))
 
     def get_leaves(self, start=0, stop=None):
         """Get leaves from the range [start, stop)."""
         if stop is None:
             stop = self.tree_size
-        return [l for l in self.__leaves_db.iterator(start=encode_int(start), stop=encode_int(stop), include_key=False)]
-
-    def add_leaf(self, leaf):
-        """Adds |leaf| to the tree, returning the index of the entry."""
-        cur_tree_size = self.tree_size
-        leaf_hash = self.__hasher.hash_leaf(leaf)
-        with self.__db.write_batch() as wb:
-            wb.put(self.__leaves_db_prefix + encode_int(cur_tree_size), leaf_hash)
-            wb.put(self.__index_db_prefix + leaf_hash, encode_int(cur_tree_size))
-            wb.put(self.__stats_db_prefix + 'tree_size', str(cur_tree_size + 1))
-        return cur_tree_size
-
-    def extend(self, new_leaves):
-        """Extend this tree with new_leaves on the end."""
-        cur_tree_size = self.tree_size
-        leaf_hashes = [self.__hasher.hash_leaf(l) for l in new_leaves]
-        with self.__db.write_batch() as wb:
-            for lf in leaf_hashes:
-                wb.put(self.__leaves_db_prefix + encode_int(cur_tree_size), lf)
-                wb.put(self.__index_db_prefix + lf, encode_int(cur_tree_size))
-                cur_tree_size += 1
-            wb.put(self.__stats_db_prefix + 'tree_size', str(cur_tree_size))
+        leaves = []
+        segmented = min(self._segmented_size, stop)
+        while start < segmented:
+            segment = self._segments[start >> self._segment_height]
+            offset = start & ~(segment.size - 1)
+            end = min(offset + segment.size, segmented)
+            leaves.extend(segment.leaves(start - offset, end - offset))
+            start = end
+        if start < stop:
+            leaves.extend(self._leaves_db.iterator(
+                    start=encode_int(start), stop=encode_int(stop),
+                    include_key=False))
+        return leaves
 
     def get_leaf_index(self, leaf_hash):
         """Returns the index of the leaf hash, or -1 if not present."""
-        raw_index = self.__index_db.get(leaf_hash)
+        if self._bloom is not None and not self._bloom.might_contain(
+                leaf_hash):
+            return -1
+        raw_index = self._index_db.get(leaf_hash)
         if raw_index:
             return decode_int(raw_index)
-        else:
-            return -1
+        if self._bloom is not None:
+            self._bloom.record_false_positive()
+        return -1
+
+    def get_leaf_indices(self, leaf_hashes):
+        """Returns the indices of the leaf hashes, -1 for those not present.
+
+        Hashes rejected by the Bloom filter are answered without a read; the
+        rest are looked up in sorted key order through a single iterator so
+        that consecutive reads hit neighbouring blocks.
+        """
+        indices = [-1] * len(leaf_hashes)
+        candidates = {}
+        for i, leaf_hash in enumerate(leaf_hashes):
+            if (self._bloom is None or
+                self._bloom.might_contain(leaf_hash)):
+                candidates.setdefault(leaf_hash, []).append(i)
+        if not candidates:
+            return indices
+        it = self._index_db.iterator()
+        try:
+            for leaf_hash in sorted(candidates):
+                it.seek(leaf_hash)
+                try:
+                    key, raw_index = next(it)
+                except StopIteration:
+                    key = None
+                if key == leaf_hash:
+                    index = decode_int(raw_index)
+                    for i in candidates[leaf_hash]:
+                        indices[i] = index
+                elif self._bloom is not None:
+                    self._bloom.record_false_positive()
+        finally:
+            it.close()
+        return indices
+
+    def _frontier(self):
+        """Returns a CompactMerkleTree holding the current perfect subtrees."""
+        raw = self._stats_db.get('frontier', default='')
+        digest_size = self._hasher.digest_size
+        hashes = [raw[i:i + digest_size]
+                  for i in xrange(0, len(raw), digest_size)]
+        return merkle.CompactMerkleTree(self._hasher, self.tree_size, hashes)
+
+    def _read_tile(self, level, index):
+        """Returns the concatenated hashes of tile (|level|, |index|)."""
+        if level == 0:
+            start = index << TILE_HEIGHT
+            return "".join(self.get_leaves(
+                    start, min(start + TILE_WIDTH, self.tree_size)))
+        return self._tiles_db.get(_tile_key(level, index), default='')
+
+    def get_tile(self, level, index):
+        """Returns the hashes in tile (|level|, |index|), see TILE_HEIGHT.
+
+        Tiles at the right edge of the tree hold fewer than TILE_WIDTH hashes.
+        """
+        raw = self._read_tile(level, index)
+        digest_size = self._hasher.digest_size
+        return [raw[i:i + digest_size]
+                for i in xrange(0, len(raw), digest_size)]
+
+    def _perfect_subtree_hash(self, start, size):
+        """Returns the hash of the perfect subtree of |size| leaves at |start|.
+
+        Nodes within segments are read from them; others are recomputed from
+        the single tile below them.
+        """
+        level = size.bit_length() - 1
+        if start < self._segmented_size and level <= self._segment_height:
+            index = start >> self._segment_height
+            return self._segments[index].node(
+                    level, (start & ((1 << self._segment_height) - 1)) >> level)
+        tile_level, height = divmod(level, TILE_HEIGHT)
+        index = start >> (tile_level * TILE_HEIGHT)
+        digest_size = self._hasher.digest_size
+        offset = (index & (TILE_WIDTH - 1)) * digest_size
+        hashes = self._read_tile(tile_level, index >> TILE_HEIGHT)[
+                offset:offset + (digest_size << height)]
+        for _ in range(height):
+            hashes = self._hasher.hash_level(hashes)
+        return hashes
+
+    def get_subtree_hash(self, start, end):
+        """Returns MTH(D[start:end]), the tree hash of the leaves [start, end).
+
+        Ranges that are nodes of the tree, as used by proofs, take one tile or
+        segment read per perfect subtree; see merkle.calculate_subtree_hash()
+        for other ranges.
+        """
+        if not 0 <= start <= end <= self.tree_size:
+            raise ValueError("Bad range [%d, %d) for tree size %d" %
+                             (start, end, self.tree_size))
+        return merkle.calculate_subtree_hash(start, end, self._hasher,
+                                             self._perfect_subtree_hash)
 
     def get_root_hash(self, tree_size=None):
-        """Returns the root hash of the tree denoted by |tree_size|."""
+        """Returns the root hash of the tree denoted by |tree_size|.
+
+        The current root and roots of published tree heads take O(log n)
+        work; other sizes are computed from segment nodes and the leaves
+        after them.
+        """
         if tree_size is None:
             tree_size = self.tree_size
         if tree_size > self.tree_size:
             raise ValueError("Specified size beyond known tree: %d" % tree_size)
-        return self.__hasher.hash_full_tree(self.get_leaves(stop=tree_size))
+        if tree_size == self.tree_size:
+            return self._frontier().root_hash()
+        head = self.get_tree_head(tree_size)
+        if head is not None:
+            return head.sha256_root_hash
+        return self.get_subtree_hash(0, tree_size)
+
+    def get_tree_head(self, tree_size):
+        """Returns the TreeHead published at |tree_size|, or None."""
+        raw = self._sth_db.get('size-' + encode_int(tree_size))
+        if raw is None:
+            return None
+        return tree_head.decode_tree_head(raw)
+
+    def get_latest_tree_head(self):
+        """Returns the most recently published TreeHead, or None."""
+        raw_size = self._sth_db.get('latest')
+        if raw_size is None:
+            return None
+        return self.get_tree_head(decode_int(raw_size))
+
+    def get_tree_head_at(self, timestamp):
+        """Returns the last TreeHead published at or before |timestamp|."""
+        it = self._sth_db.iterator(
+                start='time-', stop='time-' + _encode_timestamp(timestamp + 1),
+                include_value=False, reverse=True)
+        try:
+            key = next(it, None)
+        finally:
+            it.close()
+        if key is None:
+            return None
+        return self.get_tree_head(decode_int(key[-4:]))
 
     def _calculate_subproof(self, m, leaves, complete_subtree):
         """SUBPROOF, see RFC6962 section 2.1.2."""
@@ -121,15 +384,15 @@ class LeveldbMerkleTree(object):
             if complete_subtree:
                 return []
             else:
-                return [self.__hasher.hash_full_tree(leaves)]
+                return [self._hasher.hash_full_tree(leaves)]
 
         k = _down_to_power_of_two(n)
         if m <= k:
-            node = self.__hasher.hash_full_tree(leaves[k:n])
+            node = self._hasher.hash_full_tree(leaves[k:n])
             res = self._calculate_subproof(m, leaves[0:k], complete_subtree)
         else:
             # m > k
-            node = self.__hasher.hash_full_tree(leaves[0:k])
+            node = self._hasher.hash_full_tree(leaves[0:k])
             res = self._calculate_subproof(m - k, leaves[k:n], False)
         res.append(node)
         return res
@@ -149,8 +412,35 @@ class LeveldbMerkleTree(object):
         if tree_size_1 == tree_size_2 or tree_size_1 == 0:
             return []
 
-        return self._calculate_subproof(
-                tree_size_1, self.get_leaves(stop=tree_size_2), True)
+        proof = self._get_stored_consistency_proof(tree_size_1, tree_size_2)
+        if proof is not None:
+            return proof
+        return merkle.calculate_consistency_proof(tree_size_1, tree_size_2,
+                                                  self.get_subtree_hash)
+
+    def _get_stored_consistency_proof(self, tree_size_1, tree_size_2):
+        """Returns a proof stored when tree heads were published, or None."""
+        raw = self._sth_db.get(
+                'proof-' + encode_int(tree_size_1) + encode_int(tree_size_2))
+        if raw is None:
+            return None
+        digest_size = self._hasher.digest_size
+        return [raw[i:i + digest_size]
+                for i in xrange(0, len(raw), digest_size)]
+
+    def _get_earlier_tree_heads(self, tree_size, count):
+        """Returns the last |count| heads published below |tree_size|.
+
+        The newest head comes first.
+        """
+        it = self._sth_db.iterator(start='size-',
+                                   stop='size-' + encode_int(tree_size),
+                                   reverse=True)
+        try:
+            return [tree_head.decode_tree_head(raw)
+                    for _, raw in itertools.islice(it, count)]
+        finally:
+            it.close()
 
     def _calculate_inclusion_proof(self, leaves, leaf_index):
         """Merkle audit path, RFC6962 Section 2.1.1."""
@@ -161,11 +451,11 @@ class LeveldbMerkleTree(object):
         k = _down_to_power_of_two(n)
         m = leaf_index
         if m < k:
-            mth_k_to_n = self.__hasher.hash_full_tree(leaves[k:n])
+            mth_k_to_n = self._hasher.hash_full_tree(leaves[k:n])
             path = self._calculate_inclusion_proof(leaves[0:k], m)
             path.append(mth_k_to_n)
         else:
-            mth_0_to_k = self.__hasher.hash_full_tree(leaves[0:k])
+            mth_0_to_k = self._hasher.hash_full_tree(leaves[0:k])
             path = self._calculate_inclusion_proof(leaves[k:n], m - k)
             path.append(mth_0_to_k)
         return path
@@ -181,13 +471,690 @@ class LeveldbMerkleTree(object):
             raise ValueError("Requested proof for leaf beyond tree size: %d" %
                     leaf_index)
 
-        return self._calculate_inclusion_proof(
-                self.get_leaves(stop=tree_size), leaf_index)
+        return merkle.calculate_inclusion_proof(leaf_index, tree_size,
+                                                self.get_subtree_hash)
+
+    def get_range_proof(self, start, end, tree_size=None):
+        """Returns a proof for the leaves [start, end), see
+        merkle.calculate_range_proof()."""
+        if tree_size is None:
+            tree_size = self.tree_size
+        if tree_size > self.tree_size:
+            raise ValueError("Specified tree size is beyond known tree: %d" %
+                    tree_size)
+        return merkle.calculate_range_proof(start, end, tree_size,
+                                            self.get_subtree_hash)
+
+    def get_inclusion_proof_upgrade(self, leaf_index, old_size,
+                                    tree_size=None):
+        """Returns the nodes upgrading an inclusion proof to |tree_size|.
+
+        Only the nodes that differ from the proof at |old_size| are read, see
+        merkle.calculate_inclusion_proof_upgrade().
+        """
+        if tree_size is None:
+            tree_size = self.tree_size
+        if tree_size > self.tree_size:
+            raise ValueError("Specified tree size is beyond known tree: %d" %
+                    tree_size)
+        return merkle.calculate_inclusion_proof_upgrade(
+                leaf_index, old_size, tree_size, self.get_subtree_hash)
+
+    def _leaf_hash_chunks(self, stop, chunk_size=65536):
+        """Yields the leaf hashes below |stop| in lists of up to |chunk_size|."""
+        for start in xrange(0, stop, chunk_size):
+            yield self.get_leaves(start, min(start + chunk_size, stop))
+
+    def export_snapshot(self, tree_size, fileobj):
+        """Writes the tree at |tree_size| to |fileobj| (see tree_export).
+
+        Exports at the current size (or None) use the stored frontier; smaller
+        sizes rebuild it from the leaf hashes.
+        """
+        if tree_size is None:
+            tree_size = self.tree_size
+        if tree_size < 0 or tree_size > self.tree_size:
+            raise ValueError("Specified tree size is beyond known tree: %d" %
+                    tree_size)
+        if tree_size == self.tree_size:
+            frontier = self._frontier()
+        else:
+            frontier = merkle.CompactMerkleTree(self._hasher)
+            for chunk in self._leaf_hash_chunks(tree_size):
+                frontier.extend(chunk)
+        tree_export.write_export(fileobj, self.hash_algorithm, tree_size,
+                                 self._hasher.digest_size,
+                                 self._leaf_hash_chunks(tree_size),
+                                 frontier.hashes, frontier.root_hash())
+
+def _pinned(name):
+    """Makes a reader method run against a snapshot taken for the call.
+
+    Reads that span several database accesses (e.g. the tree size and then the
+    leaves) would otherwise observe concurrent writes half way through.
+    """
+    read = getattr(_LeveldbMerkleTreeReader, name)
+    def method(self, *args, **kwargs):
+        with self.snapshot() as snapshot:
+            return read(snapshot, *args, **kwargs)
+    method.__name__ = name
+    method.__doc__ = read.__doc__
+    return method
+
+class LeveldbMerkleTree(_LeveldbMerkleTreeReader):
+    """LevelDB Merkle Tree representation."""
+
+    def __init__(self, leaves=None, db="./merkle_db", leaves_db_prefix='leaves-', index_db_prefix='index-', stats_db_prefix='stats-', sth_db_prefix='sth-', bloom_false_positive_rate=0.01, hash_algorithm=None, segment_dir=None, segment_height=20, tiles_db_prefix='tiles-'):
+        """Start with the LevelDB database of leaves provided.
+
+        The reverse index is fronted by an in-memory Bloom filter over leaf
+        hashes, rebuilt from the index keyspace on open, so that lookups of
+        absent hashes do not need a database read. Pass
+        bloom_false_positive_rate=None to disable the filter.
+
+        |hash_algorithm| (see merkle.hash_algorithm()) is recorded when the
+        database is created and checked on every later open; by default the
+        recorded algorithm, or sha256 for a new database, is used.
+
+        With a |segment_dir|, every completed, aligned run of 2^segment_height
+        leaves is rolled over into an immutable segment file there (see
+        tree_segment) holding all of its nodes, and its leaves are removed
+        from LevelDB. Proofs then read old nodes from the memory-mapped
+        segments, and only the tail of the tree stays in the database.
+
+        Interior nodes are kept in tiles (see TILE_HEIGHT), written with the
+        leaves that complete them, so that computing any node reads a single
+        tile and a proof reads about one tile per TILE_HEIGHT levels. Tiles
+        are built on first open of databases that predate them.
+
+        Raises:
+            UnsupportedAlgorithmError: the algorithm is unavailable.
+            ValueError: the database was created with a different algorithm
+                or segment height, or has segments but no |segment_dir|.
+        """
+        self.__db = plyvel.DB(db, create_if_missing=True)
+        self.__leaves_db_prefix = leaves_db_prefix
+        self.__index_db_prefix = index_db_prefix
+        self.__stats_db_prefix = stats_db_prefix
+        self.__sth_db_prefix = sth_db_prefix
+        self.__tiles_db_prefix = tiles_db_prefix
+        self._leaves_db = self.__db.prefixed_db(leaves_db_prefix)
+        self._index_db = self.__db.prefixed_db(index_db_prefix)
+        self._stats_db = self.__db.prefixed_db(stats_db_prefix)
+        self._sth_db = self.__db.prefixed_db(sth_db_prefix)
+        self._tiles_db = self.__db.prefixed_db(tiles_db_prefix)
+        self._hasher = IncrementalTreeHasher(
+                self._load_hash_algorithm(hash_algorithm))
+        self.__segment_dir = segment_dir
+        self._segment_height = segment_height
+        self._segments = self._load_segments()
+        self.__segmented_size = len(self._segments) << segment_height
+        self.__bloom_false_positive_rate = bloom_false_positive_rate
+        self._bloom = None
+        if bloom_false_positive_rate is not None:
+            self._rebuild_bloom_filter()
+        self._load_tiles()
+        self.__frontier = self._load_frontier()
+        self.__latest_tree_head = _LeveldbMerkleTreeReader.get_latest_tree_head(
+                self)
+        self.__receipt_callbacks = []
+        if leaves is not None:
+            self.extend(leaves)
+
+    def close(self):
+        for segment in self._segments:
+            segment.close()
+        self.__db.close()
+
+    @property
+    def _segmented_size(self):
+        return self.__segmented_size
+
+    def snapshot(self):
+        """Returns a read-only view of the tree as it is now.
+
+        The view is pinned to a LevelDB snapshot, so its tree size and contents
+        do not change under concurrent writes. It can be shared between
+        threads. Release it with close(), or use it as a context manager.
+        """
+        # The segmented size is read after taking the LevelDB snapshot: it is
+        # raised before segmented leaves are deleted from LevelDB, so it
+        # covers every leaf missing from the snapshot.
+        snapshot = self.__db.snapshot()
+        return LeveldbMerkleTreeSnapshot(snapshot, self._hasher,
+                                         self._bloom, self.__leaves_db_prefix,
+                                         self.__index_db_prefix,
+                                         self.__stats_db_prefix,
+                                         self.__sth_db_prefix,
+                                         self._segments, self._segment_height,
+                                         self.__tiles_db_prefix,
+                                         self.__segmented_size)
+
+    get_leaf = _pinned("get_leaf")
+    get_leaves = _pinned("get_leaves")
+    get_root_hash = _pinned("get_root_hash")
+    get_subtree_hash = _pinned("get_subtree_hash")
+    get_consistency_proof = _pinned("get_consistency_proof")
+    get_inclusion_proof = _pinned("get_inclusion_proof")
+    get_inclusion_proof_upgrade = _pinned("get_inclusion_proof_upgrade")
+    get_range_proof = _pinned("get_range_proof")
+    get_tile = _pinned("get_tile")
+    export_snapshot = _pinned("export_snapshot")
+
+    @property
+    def leaves_db_prefix(self):
+        return self.__leaves_db_prefix
+
+    @property
+    def index_db_prefix(self):
+        return self.__index_db_prefix
+
+    @property
+    def stats_db_prefix(self):
+        return self.__stats_db_prefix
+
+    @property
+    def sth_db_prefix(self):
+        return self.__sth_db_prefix
+
+    @property
+    def tiles_db_prefix(self):
+        return self.__tiles_db_prefix
+
+    def _load_hash_algorithm(self, hash_algorithm):
+        """Returns the algorithm recorded in the database, recording it first
+        for new databases."""
+        stored = self._stats_db.get('hash_algorithm')
+        if stored is None:
+            # Databases from before the algorithm was recorded use SHA-256.
+            stored = 'sha256' if self.tree_size else hash_algorithm or 'sha256'
+            merkle.hash_algorithm(stored)
+            self.__db.put(self.__stats_db_prefix + 'hash_algorithm', stored)
+        if hash_algorithm is not None and hash_algorithm != stored:
+            raise ValueError("Database uses hash algorithm %s, not %s" %
+                             (stored, hash_algorithm))
+        return stored
+
+    def __segment_path(self, index):
+        return os.path.join(self.__segment_dir, "%08d.segment" % index)
+
+    def _load_segments(self):
+        count = int(self._stats_db.get('segments', default='0'))
+        if count and self.__segment_dir is None:
+            raise ValueError("Database has %d segments but no segment_dir "
+                             "was given" % count)
+        stored_height = self._stats_db.get('segment_height')
+        if (stored_height is not None and
+            int(stored_height) != self._segment_height):
+            raise ValueError("Database uses segments of height %s, not %d" %
+                             (stored_height, self._segment_height))
+        if self.__segment_dir is not None and not os.path.isdir(
+                self.__segment_dir):
+            os.makedirs(self.__segment_dir)
+        return [tree_segment.TreeSegment(self.__segment_path(i))
+                for i in range(count)]
+
+    def _roll_over(self):
+        """Moves completed runs of leaves out of LevelDB into segments."""
+        if self.__segment_dir is None:
+            return
+        height = self._segment_height
+        count = len(self._segments)
+        while (count + 1) << height <= self.tree_size:
+            start = count << height
+            stop = start + (1 << height)
+            path = self.__segment_path(count)
+            tree_segment.write_segment(path, height,
+                                       self.get_leaves(start, stop),
+                                       self._hasher)
+            # Readers only use the segment once the segmented size includes
+            # it, which happens before its leaves leave LevelDB.
+            self._segments.append(tree_segment.TreeSegment(path))
+            self.__segmented_size = stop
+            with self.__db.write_batch() as wb:
+                for i in xrange(start, stop):
+                    wb.delete(self.__leaves_db_prefix + encode_int(i))
+                wb.put(self.__stats_db_prefix + 'segments', str(count + 1))
+                wb.put(self.__stats_db_prefix + 'segment_height', str(height))
+            count += 1
+
+    def _load_tiles(self):
+        """Builds the tiles of databases created before they were stored."""
+        if self._stats_db.get('tile_height') is not None:
+            return
+        for start in xrange(0, self.tree_size, 65536):
+            updates = self._tile_updates(start, self.get_leaves(
+                    start, min(start + 65536, self.tree_size)))
+            with self.__db.write_batch() as wb:
+                self.__put_tiles(wb, updates)
+        self.__db.put(self.__stats_db_prefix + 'tile_height', str(TILE_HEIGHT))
+
+    def _tile_updates(self, start, leaf_hashes):
+        """Returns the tiles changed by appending |leaf_hashes| at |start|.
+
+        The result maps (level, index) to the new value of each tile above
+        level 0 that gains a node.
+        """
+        digest_size = self._hasher.digest_size
+        updates = {}
+        row = "".join(leaf_hashes)
+        level = 0
+        # |row| holds the hashes at level * TILE_HEIGHT from |start| on.
+        while (start + len(row) // digest_size) >> TILE_HEIGHT > (
+                start >> TILE_HEIGHT):
+            first = start >> TILE_HEIGHT
+            if start > first << TILE_HEIGHT:
+                # Only leaves are read here: at higher levels the row
+                # already starts at a tile boundary.
+                row = "".join(self.get_leaves(first << TILE_HEIGHT,
+                                              start)) + row
+                start = first << TILE_HEIGHT
+            complete = (len(row) // digest_size) >> TILE_HEIGHT
+            parents = row[:(complete << TILE_HEIGHT) * digest_size]
+            for _ in range(TILE_HEIGHT):
+                parents = self._hasher.hash_level(parents)
+            level += 1
+            index = first >> TILE_HEIGHT
+            row = self._read_tile(level, index) + parents
+            start = index << TILE_HEIGHT
+            tile_size = TILE_WIDTH * digest_size
+            for i in xrange(0, len(row), tile_size):
+                updates[(level, index + i // tile_size)] = row[i:i + tile_size]
+        return updates
+
+    def __put_tiles(self, wb, updates):
+        for (level, index), value in updates.iteritems():
+            wb.put(self.__tiles_db_prefix + _tile_key(level, index), value)
+
+    def _load_frontier(self):
+        """Loads the compact tree, rebuilding it for databases without one."""
+        if (self._stats_db.get('frontier') is not None or
+            self.tree_size == 0):
+            return self._frontier()
+        frontier = merkle.CompactMerkleTree(self._hasher)
+        frontier.extend(self.get_leaves())
+        self.__db.put(self.__stats_db_prefix + 'frontier',
+                      ''.join(frontier.hashes))
+        return frontier
+
+    @property
+    def bloom_filter(self):
+        """The Bloom filter fronting the index, or None if disabled."""
+        return self._bloom
+
+    def _rebuild_bloom_filter(self, capacity=None, leaf_hashes=()):
+        """Rebuild the Bloom filter from the index keyspace.
+
+        |leaf_hashes| are about to be written and are added as well.
+        """
+        if capacity is None:
+            capacity = 2 * self.tree_size
+        bloom = bloom_filter.BloomFilter(
+                max(capacity, _MIN_BLOOM_CAPACITY),
+                self.__bloom_false_positive_rate)
+        bloom.update(self._index_db.iterator(include_value=False))
+        bloom.update(leaf_hashes)
+        self._bloom = bloom
+
+    def _add_to_bloom_filter(self, leaf_hashes):
+        # Called before the hashes are written, so that concurrent readers
+        # never see an index entry that the filter would reject.
+        if self._bloom is None:
+            return
+        if len(self._bloom) + len(leaf_hashes) > self._bloom.capacity:
+            self._rebuild_bloom_filter(
+                    2 * (len(self._bloom) + len(leaf_hashes)), leaf_hashes)
+        else:
+            self._bloom.update(leaf_hashes)
+
+    def add_receipt_callback(self, callback):
+        """Calls callback(receipts) after every append.
+
+        receipts is the list of LeafReceipts extend_hashes() would return
+        with emit_proofs set. Callbacks run on the appending thread, after
+        the batch is committed; exceptions they raise are logged, not
+        propagated, since the leaves have already been appended.
+        """
+        self.__receipt_callbacks.append(callback)
+
+    def remove_receipt_callback(self, callback):
+        self.__receipt_callbacks.remove(callback)
+
+    def add_leaf(self, leaf):
+        """Adds |leaf| to the tree, returning the index of the entry."""
+        cur_tree_size = self.tree_size
+        self.extend_hashes([self._hasher.hash_leaf(leaf)])
+        return cur_tree_size
+
+    def extend(self, new_leaves, dedupe=False, emit_proofs=False):
+        """Extend this tree with new_leaves on the end.
+
+        See extend_hashes() for the meaning of |dedupe|, |emit_proofs| and
+        the return value.
+        """
+        leaf_hashes = [self._hasher.hash_leaf(l) for l in new_leaves]
+        return self.extend_hashes(leaf_hashes, dedupe=dedupe,
+                                  emit_proofs=emit_proofs)
+
+    def extend_hashes(self, leaf_hashes, dedupe=False, emit_proofs=False):
+        """Extend this tree with already-hashed leaves on the end.
+
+        If |dedupe| is set, leaf hashes already in the tree, or repeated
+        within the batch, are not appended again and the return value is a
+        list of (index, was_new) pairs, one per input leaf, giving the index
+        the leaf now lives at. All appends happen in a single write batch.
+
+        If |emit_proofs| is set, the return value is instead a list of
+        LeafReceipts, one per input leaf, holding its inclusion proof at the
+        new tree size. The proofs are computed from the batch's hashes and
+        the old frontier in O(batch + log n) hashes, with no database reads
+        except for deduplicated leaves from before the batch.
+
+        Raises:
+            ValueError: a leaf hash is not of the tree's digest size.
+        """
+        digest_size = self._hasher.digest_size
+        for lf in leaf_hashes:
+            if len(lf) != digest_size:
+                raise ValueError("Leaf hash of %d bytes, expected %d" %
+                                 (len(lf), digest_size))
+        cur_tree_size = self.tree_size
+        if dedupe:
+            results = []
+            new_hashes = []
+            batch_indices = {}
+            existing = self.get_leaf_indices(leaf_hashes)
+            for lf, index in zip(leaf_hashes, existing):
+                if index == -1:
+                    index = batch_indices.get(lf, -1)
+                if index != -1:
+                    results.append((index, False))
+                    continue
+                index = cur_tree_size + len(new_hashes)
+                batch_indices[lf] = index
+                new_hashes.append(lf)
+                results.append((index, True))
+            leaf_hashes = new_hashes
+        old_frontier = self.__frontier
+        frontier = old_frontier.extended(leaf_hashes)
+        tiles = self._tile_updates(cur_tree_size, leaf_hashes)
+        self._add_to_bloom_filter(leaf_hashes)
+        with self.__db.write_batch() as wb:
+            self.__put_tiles(wb, tiles)
+            for lf in leaf_hashes:
+                wb.put(self.__leaves_db_prefix + encode_int(cur_tree_size), lf)
+                wb.put(self.__index_db_prefix + lf, encode_int(cur_tree_size))
+                cur_tree_size += 1
+            wb.put(self.__stats_db_prefix + 'tree_size', str(cur_tree_size))
+            wb.put(self.__stats_db_prefix + 'frontier',
+                   ''.join(frontier.hashes))
+        self.__frontier = frontier
+        self._roll_over()
+        if emit_proofs or self.__receipt_callbacks:
+            if not dedupe:
+                results = [(i, True) for i in
+                           xrange(old_frontier.tree_size, cur_tree_size)]
+            with self.snapshot() as snapshot:
+                proofs = merkle.calculate_batch_inclusion_proofs(
+                        self._hasher, old_frontier.tree_size,
+                        old_frontier.hashes, leaf_hashes,
+                        [index for index, _ in results],
+                        snapshot.get_subtree_hash)
+            receipts = [LeafReceipt(index, cur_tree_size, proof, was_new)
+                        for (index, was_new), proof in zip(results, proofs)]
+            for callback in list(self.__receipt_callbacks):
+                try:
+                    callback(receipts)
+                except Exception:
+                    logging.exception("Receipt callback failed")
+            if emit_proofs:
+                return receipts
+        if dedupe:
+            return results
+
+    def import_snapshot(self, fileobj, expected_root_hash=None):
+        """Loads an export written by export_snapshot() into this empty tree.
+
+        Leaves are not rehashed: leaf hashes are written as they are read and
+        hashed once into the tiles above them. The compact tree is then read
+        off the rightmost tiles, hashing only their incomplete rows, and its
+        frontier and root must match the export's, and its root
+        |expected_root_hash|, if given. The leaves only
+        become part of the tree once the export's checksum and root have been
+        verified; a failed import leaves the tree empty.
+
+        Returns:
+            The root hash of the imported tree.
+
+        Raises:
+            ValueError: the tree is not empty or uses another hash algorithm.
+            EncodingError, UnsupportedVersionError: the export is unreadable.
+            ConsistencyError: the leaf hashes, frontier or root hash do not
+                match.
+        """
+        if self.tree_size:
+            raise ValueError("Can only import into an empty tree")
+        reader = tree_export.ExportReader(fileobj)
+        if reader.hash_algorithm != self.hash_algorithm:
+            raise ValueError("Export uses hash algorithm %s, not %s" %
+                             (reader.hash_algorithm, self.hash_algorithm))
+        tree_size = 0
+        rightmost_tiles = {}
+        edge = []
+        try:
+            if reader.digest_size != self._hasher.digest_size:
+                raise error.EncodingError("Export has %d-byte hashes" %
+                                          reader.digest_size)
+            for chunk in reader.leaf_hash_chunks():
+                tiles = self._tile_updates(tree_size, chunk)
+                for (level, index), value in sorted(tiles.iteritems()):
+                    rightmost_tiles[level] = value
+                edge = (edge + chunk)[-TILE_WIDTH:]
+                self._add_to_bloom_filter(chunk)
+                with self.__db.write_batch() as wb:
+                    self.__put_tiles(wb, tiles)
+                    for lf in chunk:
+                        wb.put(self.__leaves_db_prefix + encode_int(tree_size),
+                               lf)
+                        wb.put(self.__index_db_prefix + lf,
+                               encode_int(tree_size))
+                        tree_size += 1
+            node_hashes, root_hash = reader.finish()
+            frontier = self._frontier_from_tiles(tree_size, rightmost_tiles,
+                                                 edge)
+            if frontier.hashes != tuple(node_hashes):
+                raise error.ConsistencyError(
+                    "Exported frontier does not match the leaf hashes")
+            if frontier.root_hash() != root_hash:
+                raise error.ConsistencyError(
+                    "Exported leaf hashes do not match the exported root hash")
+            if (expected_root_hash is not None and
+                root_hash != expected_root_hash):
+                raise error.ConsistencyError(
+                    "Exported root hash %s, expected %s" %
+                    (root_hash.encode("hex"), expected_root_hash.encode("hex")))
+        except Exception:
+            exc_info = sys.exc_info()
+            self.__discard_import(tree_size)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        with self.__db.write_batch() as wb:
+            wb.put(self.__stats_db_prefix + 'tree_size', str(tree_size))
+            wb.put(self.__stats_db_prefix + 'frontier',
+                   ''.join(frontier.hashes))
+        self.__frontier = frontier
+        self._roll_over()
+        return root_hash
+
+    def _frontier_from_tiles(self, tree_size, rightmost_tiles, edge):
+        """Returns the CompactMerkleTree of |tree_size| leaves.
+
+        |rightmost_tiles| maps each level above 0 to the value of its last
+        tile and |edge| holds the last leaf hashes. Only the nodes of the
+        incomplete tile at each level are hashed.
+        """
+        digest_size = self._hasher.digest_size
+        hashes = []
+        levels = 0
+        while tree_size >> (levels * TILE_HEIGHT):
+            levels += 1
+        for level in reversed(range(levels)):
+            count = (tree_size >> (level * TILE_HEIGHT)) & (TILE_WIDTH - 1)
+            if not count:
+                continue
+            if level:
+                raw = rightmost_tiles[level][-count * digest_size:]
+                nodes = [raw[i:i + digest_size]
+                         for i in xrange(0, len(raw), digest_size)]
+            else:
+                nodes = edge[-count:]
+            hashes.extend(merkle.CompactMerkleTree(self._hasher).extended(
+                    nodes).hashes)
+        return merkle.CompactMerkleTree(self._hasher, tree_size, hashes)
+
+    def __discard_import(self, count):
+        with self.__db.write_batch() as wb:
+            for i, lf in enumerate(self._leaves_db.iterator(
+                    stop=encode_int(count), include_key=False)):
+                wb.delete(self.__leaves_db_prefix + encode_int(i))
+                wb.delete(self.__index_db_prefix + lf)
+            for key in self._tiles_db.iterator(include_value=False):
+                wb.delete(self.__tiles_db_prefix + key)
+        if self._bloom is not None:
+            self._rebuild_bloom_filter()
+
+    def get_latest_tree_head(self):
+        """Returns the most recently published TreeHead, or None."""
+        return self.__latest_tree_head
+
+    def publish_tree_head(self, timestamp=None, skip_levels=0):
+        """Publishes a TreeHead for the current tree.
+
+        Tree heads are immutable: if a head was already published at the
+        current size, that head is returned instead.
+
+        Consistency proofs from the previous published head, and from the
+        heads 2, 4, ..., 2^skip_levels publications back, are computed now and
+        stored, so that get_consistency_proof() between published sizes is a
+        single read. Publishing therefore costs the root hash plus up to
+        skip_levels + 1 consistency proofs, each O(log n) node reads, and a
+        scan of the last 2^skip_levels published heads.
+
+        Args:
+            timestamp: milliseconds since the epoch, defaults to now.
+            skip_levels: how many earlier heads beyond the previous one get a
+                precomputed proof (at power-of-two distances).
+
+        Returns:
+            The TreeHead for the current tree size.
+        """
+        proofs = []
+        with self.snapshot() as snapshot:
+            existing = snapshot.get_tree_head(snapshot.tree_size)
+            if existing is not None:
+                return existing
+            if timestamp is None:
+                timestamp = tree_head.current_timestamp()
+            head = tree_head.TreeHead(snapshot.tree_size, timestamp,
+                                      snapshot.get_root_hash())
+            earlier = snapshot._get_earlier_tree_heads(head.tree_size,
+                                                       2**skip_levels)
+            for level in range(skip_levels + 1):
+                if 2**level > len(earlier):
+                    break
+                old_size = earlier[2**level - 1].tree_size
+                proofs.append((old_size, snapshot.get_consistency_proof(
+                        old_size, head.tree_size)))
+        raw_size = encode_int(head.tree_size)
+        latest = self.__latest_tree_head
+        with self.__db.write_batch() as wb:
+            for old_size, proof in proofs:
+                wb.put(self.__sth_db_prefix + 'proof-' +
+                       encode_int(old_size) + raw_size, ''.join(proof))
+            wb.put(self.__sth_db_prefix + 'size-' + raw_size,
+                   tree_head.encode_tree_head(head))
+            wb.put(self.__sth_db_prefix + 'time-' +
+                   _encode_timestamp(head.timestamp) + raw_size, '')
+            if latest is None or head.tree_size > latest.tree_size:
+                wb.put(self.__sth_db_prefix + 'latest', raw_size)
+        if latest is None or head.tree_size > latest.tree_size:
+            self.__latest_tree_head = head
+        return head
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self._hasher)
+
+class LeveldbMerkleTreeSnapshot(_LeveldbMerkleTreeReader):
+    """Read-only view of a LeveldbMerkleTree pinned to a LevelDB snapshot."""
+
+    def __init__(self, snapshot, hasher, bloom, leaves_db_prefix,
+                 index_db_prefix, stats_db_prefix, sth_db_prefix,
+                 segments=(), segment_height=None, tiles_db_prefix='tiles-',
+                 segmented_size=None):
+        self.__snapshot = snapshot
+        self._hasher = hasher
+        self._bloom = bloom
+        self._segments = list(segments)
+        self._segment_height = segment_height
+        self._leaves_db = _PrefixedSnapshot(snapshot, leaves_db_prefix)
+        self._index_db = _PrefixedSnapshot(snapshot, index_db_prefix)
+        self._stats_db = _PrefixedSnapshot(snapshot, stats_db_prefix)
+        self._sth_db = _PrefixedSnapshot(snapshot, sth_db_prefix)
+        self._tiles_db = _PrefixedSnapshot(snapshot, tiles_db_prefix)
+        self.__tiles = lru_cache.LRUCache(_SNAPSHOT_TILE_CACHE_SIZE)
+        self.__tree_size = _LeveldbMerkleTreeReader.tree_size.fget(self)
+        if segmented_size is None:
+            segmented_size = _LeveldbMerkleTreeReader._segmented_size.fget(
+                    self)
+        if segment_height is not None:
+            # Leaves appended after the snapshot was taken may have been
+            # segmented since; they are not part of the snapshot.
+            segmented_size = min(segmented_size, self.__tree_size >>
+                                 segment_height << segment_height)
+        self.__segmented_size = segmented_size
+
+    @property
+    def tree_size(self):
+        return self.__tree_size
+
+    @property
+    def _segmented_size(self):
+        return self.__segmented_size
+
+    def _read_tile(self, level, index):
+        # Tiles cannot change under a snapshot, so recently used ones are
+        # kept rather than read again.
+        tile = self.__tiles.get((level, index))
+        if tile is None:
+            tile = _LeveldbMerkleTreeReader._read_tile(self, level, index)
+            self.__tiles.put((level, index), tile)
+        return tile
+
+    def close(self):
+        self.__snapshot.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     def __repr__(self):
-        return "%s(%r)" % (self.__class__.__name__, self.__hasher)
+        return "%s(%r, tree_size=%d)" % (self.__class__.__name__,
+                                         self._hasher, self.__tree_size)
 
 class IncrementalTreeHasher(merkle.TreeHasher):
+    """A TreeHasher whose leaves are already leaf hashes."""
+
+    def hash_full_tree(self, leaves):
+        """Hash a list of leaf hashes into a root, one level at a time."""
+        if not leaves:
+            return self.hash_empty()
+        level = "".join(leaves)
+        digest_size = self.digest_size
+        while len(level) > digest_size:
+            level = self.hash_level(level)
+        return level
+
     def _hash_full(self, leaves, l_idx, r_idx):
         """Hash the leaves between (l_idx, r_idx) as a valid entire tree.
 
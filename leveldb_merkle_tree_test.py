@@ -4,12 +4,21 @@
 
 from collections import namedtuple
 
+import logging
+import os
 import shutil
+import StringIO
 import tempfile
+import threading
 import unittest
 
+import plyvel
+
+import error
+import in_memory_merkle_tree
 import leveldb_merkle_tree
 import merkle
+import tree_export
 
 PathTestVector = namedtuple("PathTestVector",
     ["leaf", "tree_size_snapshot", "path_length", "path"])
@@ -234,5 +243,595 @@ class LeveldbMerkleTreeTest(unittest.TestCase):
                           tree.get_consistency_proof, n - 1, n - 3)
         tree.close()
 
+    def test_tree_get_leaf_index(self):
+        """Test reverse index lookups, with and without the Bloom filter."""
+        hasher = merkle.TreeHasher()
+        leaf_hashes = [hasher.hash_leaf(l) for l in TEST_VECTOR_DATA]
+        missing = hasher.hash_leaf("missing")
+        for fp_rate in (0.01, None):
+            shutil.rmtree(self.db)
+            tree = leveldb_merkle_tree.LeveldbMerkleTree(
+                    leaves=TEST_VECTOR_DATA, db=self.db,
+                    bloom_false_positive_rate=fp_rate)
+            for i, leaf_hash in enumerate(leaf_hashes):
+                self.assertEqual(tree.get_leaf_index(leaf_hash), i)
+            self.assertEqual(tree.get_leaf_index(missing), -1)
+            self.assertEqual(
+                    tree.get_leaf_indices([missing] + leaf_hashes[::-1]),
+                    [-1] + range(len(leaf_hashes))[::-1])
+            self.assertEqual(tree.get_leaf_indices([]), [])
+            tree.close()
+
+    def test_tree_bloom_filter_rebuilt_on_open(self):
+        """Test that the Bloom filter is rebuilt from the index on open."""
+        hasher = merkle.TreeHasher()
+        tree = leveldb_merkle_tree.LeveldbMerkleTree(
+                leaves=TEST_VECTOR_DATA, db=self.db)
+        tree.close()
+        tree = leveldb_merkle_tree.LeveldbMerkleTree(db=self.db)
+        self.assertEqual(tree.bloom_filter.stats.items, len(TEST_VECTOR_DATA))
+        self.assertEqual(tree.get_leaf_index(hasher.hash_leaf("00".decode(
+                "hex"))), 1)
+        self.assertEqual(tree.get_leaf_index(hasher.hash_leaf("missing")), -1)
+        stats = tree.bloom_filter.stats
+        self.assertEqual(stats.lookups, 2)
+        self.assertEqual(stats.maybe_hits + stats.definite_misses, 2)
+        tree.close()
+
+    def test_tree_bloom_filter_grows(self):
+        """Test that the Bloom filter keeps answering when over capacity."""
+        leaves = [str(i) for i in range(3000)]
+        tree = leveldb_merkle_tree.LeveldbMerkleTree(db=self.db)
+        tree.extend(leaves[:1000])
+        tree.extend(leaves[1000:])
+        self.assertGreaterEqual(tree.bloom_filter.capacity, 3000)
+        hasher = merkle.TreeHasher()
+        self.assertEqual(
+                tree.get_leaf_indices([hasher.hash_leaf(l) for l in leaves]),
+                range(3000))
+        tree.close()
+
+    def test_tree_extend_dedupe(self):
+        """Test that dedupe mode skips leaves already in the tree or batch."""
+        hasher = merkle.TreeHasher()
+        tree = leveldb_merkle_tree.LeveldbMerkleTree(
+                leaves=["a", "b"], db=self.db)
+        results = tree.extend(["c", "a", "c", "d", "b"], dedupe=True)
+        self.assertEqual(results, [(2, True), (0, False), (2, False),
+                                   (3, True), (1, False)])
+        self.assertEqual(tree.tree_size, 4)
+        self.assertEqual(tree.get_root_hash(),
+                         hasher.hash_full_tree(["a", "b", "c", "d"]))
+        self.assertEqual(tree.get_leaf_index(hasher.hash_leaf("a")), 0)
+        self.assertEqual(tree.extend(["a"], dedupe=True), [(0, False)])
+        self.assertEqual(tree.tree_size, 4)
+        # Without dedupe, duplicates are appended.
+        tree.extend(["a"])
+        self.assertEqual(tree.tree_size, 5)
+        tree.close()
+
+    def test_tree_snapshot_is_pinned(self):
+        """Test that a snapshot does not observe later writes."""
+        hasher = merkle.TreeHasher()
+        tree = leveldb_merkle_tree.LeveldbMerkleTree(
+                leaves=TEST_VECTOR_DATA[:5], db=self.db)
+        with tree.snapshot() as snapshot:
+            tree.extend(TEST_VECTOR_DATA[5:])
+            self.assertEqual(tree.tree_size, 8)
+            self.assertEqual(snapshot.tree_size, 5)
+            self.assertEqual(len(snapshot.get_leaves()), 5)
+            self.assertEqual(snapshot.get_leaf(5), None)
+            self.assertEqual(snapshot.get_root_hash(),
+                             hasher.hash_full_tree(TEST_VECTOR_DATA[:5]))
+            self.assertEqual(snapshot.get_inclusion_proof(1),
+                             tree.get_inclusion_proof(1, 5))
+            self.assertEqual(snapshot.get_consistency_proof(2),
+                             tree.get_consistency_proof(2, 5))
+            self.assertRaises(ValueError, snapshot.get_root_hash, 8)
+            leaf_hashes = [hasher.hash_leaf(l) for l in TEST_VECTOR_DATA]
+            self.assertEqual(snapshot.get_leaf_indices(leaf_hashes),
+                             [0, 1, 2, 3, 4, -1, -1, -1])
+            self.assertEqual(snapshot.get_leaf_index(leaf_hashes[6]), -1)
+        tree.close()
+
+    def test_snapshot_iterator_seek(self):
+        """Test seeking forward and reverse snapshot iterators."""
+        db = plyvel.DB(self.db, create_if_missing=True)
+        for prefix in ["a-", "b-", "c-"]:
+            for key in ["b", "d", "f"]:
+                db.put(prefix + key, key)
+        snapshot = db.snapshot()
+        view = leveldb_merkle_tree._PrefixedSnapshot(snapshot, "b-")
+        keys = ["b", "d", "f"]
+        for start, stop in [(None, None), (None, "e"), ("c", None)]:
+            in_range = [k for k in keys if (start is None or k >= start) and
+                        (stop is None or k < stop)]
+            for target in ["", "a", "b", "c", "d", "e", "z"]:
+                it = view.iterator(start=start, stop=stop,
+                                   include_value=False)
+                it.seek(target)
+                self.assertEqual(list(it), [k for k in in_range
+                                            if k >= target])
+                it = view.iterator(start=start, stop=stop,
+                                   include_value=False, reverse=True)
+                it.seek(target)
+                self.assertEqual(list(it), [k for k in in_range[::-1]
+                                            if k < target])
+        snapshot.close()
+        db.close()
+
+    def test_tree_snapshot_concurrent_readers(self):
+        """Test proofs served from threads while the tree is extended."""
+        leaves = [str(i) for i in range(64)]
+        hasher = merkle.TreeHasher()
+        tree = leveldb_merkle_tree.LeveldbMerkleTree(
+                leaves=leaves[:16], db=self.db)
+        verifier = merkle.MerkleVerifier()
+        errors = []
+        def read(snapshot):
+            try:
+                n = snapshot.tree_size
+                sth = DummySTH(n, snapshot.get_root_hash())
+                for i in range(n):
+                    verifier.verify_leaf_hash_inclusion(
+                            hasher.hash_leaf(leaves[i]), i,
+                            snapshot.get_inclusion_proof(i), sth)
+            except Exception as e:
+                errors.append(e)
+        threads = []
+        snapshots = []
+        for start in range(16, 64, 8):
+            snapshot = tree.snapshot()
+            snapshots.append(snapshot)
+            for _ in range(2):
+                threads.append(threading.Thread(target=read,
+                                                args=(snapshot,)))
+                threads[-1].start()
+            tree.extend(leaves[start:start + 8])
+        for t in threads:
+            t.join()
+        for snapshot in snapshots:
+            snapshot.close()
+        self.assertEqual(errors, [])
+        tree.close()
+
+    def test_tree_publish_tree_head(self):
+        """Test publishing and looking up tree heads."""
+        hasher = merkle.TreeHasher()
+        tree = leveldb_merkle_tree.LeveldbMerkleTree(
+                leaves=TEST_VECTOR_DATA[:3], db=self.db)
+        self.assertEqual(tree.get_latest_tree_head(), None)
+        head_3 = tree.publish_tree_head(timestamp=1000)
+        self.assertEqual(head_3.tree_size, 3)
+        self.assertEqual(head_3.sha256_root_hash,
+                         hasher.hash_full_tree(TEST_VECTOR_DATA[:3]))
+        # Heads are immutable.
+        self.assertEqual(tree.publish_tree_head(timestamp=1500), head_3)
+        tree.extend(TEST_VECTOR_DATA[3:])
+        head_8 = tree.publish_tree_head(timestamp=2000)
+        self.assertEqual(tree.get_latest_tree_head(), head_8)
+        self.assertEqual(tree.get_tree_head(3), head_3)
+        self.assertEqual(tree.get_tree_head(5), None)
+        self.assertEqual(tree.get_tree_head_at(999), None)
+        self.assertEqual(tree.get_tree_head_at(1000), head_3)
+        self.assertEqual(tree.get_tree_head_at(1999), head_3)
+        self.assertEqual(tree.get_tree_head_at(5000), head_8)
+        # A head works as an STH for verification.
+        merkle.MerkleVerifier().verify_leaf_hash_inclusion(
+                hasher.hash_leaf(TEST_VECTOR_DATA[1]), 1,
+                tree.get_inclusion_proof(1, 3), head_3)
+        tree.close()
+        tree = leveldb_merkle_tree.LeveldbMerkleTree(db=self.db)
+        self.assertEqual(tree.get_latest_tree_head(), head_8)
+        with tree.snapshot() as snapshot:
+            self.assertEqual(snapshot.get_latest_tree_head(), head_8)
+            self.assertEqual(snapshot.get_tree_head_at(1500), head_3)
+        tree.close()
+
+    def test_tree_precomputed_consistency_proofs(self):
+        """Test proofs stored between published tree heads."""
+        leaves = [str(i) for i in range(32)]
+        tree = leveldb_merkle_tree.LeveldbMerkleTree(db=self.db)
+        sizes = [1, 3, 4, 7, 9, 16, 20, 32]
+        start = 0
+        for size in sizes:
+            tree.extend(leaves[start:size])
+            start = size
+            tree.publish_tree_head(timestamp=size, skip_levels=2)
+        verifier = merkle.MerkleVerifier()
+        stored = tree._get_stored_consistency_proof
+        for i, new_size in enumerate(sizes):
+            for distance in (1, 2, 4):
+                if i < distance:
+                    continue
+                old_size = sizes[i - distance]
+                self.assertNotEqual(stored(old_size, new_size), None)
+                proof = tree.get_consistency_proof(old_size, new_size)
+                self.assertEqual(proof, tree._calculate_subproof(
+                        old_size, tree.get_leaves(stop=new_size), True))
+                verifier.verify_tree_consistency(
+                        old_size, new_size, tree.get_root_hash(old_size),
+                        tree.get_root_hash(new_size), proof)
+        self.assertEqual(stored(sizes[0], sizes[3]), None)
+        self.assertEqual(stored(3, 32), None)
+        tree.close()
+
+    def test_tree_frontier_rebuilt_for_old_databases(self):
+        """Test that a database without a stored frontier is upgraded."""
+        hasher = merkle.TreeHasher()
+        tree = leveldb_merkle_tree.LeveldbMerkleTree(
+                leaves=TEST_VECTOR_DATA, db=self.db)
+        tree._stats_db.delete('frontier')
+        tree.close()
+        tree = leveldb_merkle_tree.LeveldbMerkleTree(db=self.db)
+        self.assertEqual(tree.get_root_hash(),
+                         hasher.hash_full_tree(TEST_VECTOR_DATA))
+        tree.add_leaf("x")
+        self.assertEqual(tree.get_root_hash(),
+                         hasher.hash_full_tree(TEST_VECTOR_DATA + ["x"]))
+        tree.close()
+
+    def test_tree_hash_algorithm_recorded(self):
+        """Test that the hash algorithm is recorded and checked on open."""
+        hasher = merkle.TreeHasher("sha256/128")
+        tree = leveldb_merkle_tree.LeveldbMerkleTree(
+                leaves=TEST_VECTOR_DATA, db=self.db,
+                hash_algorithm="sha256/128")
+        self.assertEqual(tree.hash_algorithm, "sha256/128")
+        self.assertEqual(tree.get_root_hash(),
+                         hasher.hash_full_tree(TEST_VECTOR_DATA))
+        self.assertRaises(ValueError, tree.extend_hashes, ["x" * 32])
+        verifier = merkle.MerkleVerifier(hasher)
+        head = tree.publish_tree_head(timestamp=1)
+        self.assertEqual(len(head.root_hash), 16)
+        verifier.verify_leaf_inclusion(
+                TEST_VECTOR_DATA[3], 3, tree.get_inclusion_proof(3), head)
+        tree.close()
+
+        tree = leveldb_merkle_tree.LeveldbMerkleTree(db=self.db)
+        self.assertEqual(tree.hash_algorithm, "sha256/128")
+        self.assertEqual(tree.get_root_hash(), head.root_hash)
+        tree.close()
+        self.assertRaises(ValueError, leveldb_merkle_tree.LeveldbMerkleTree,
+                          db=self.db, hash_algorithm="sha256")
+
+    def test_tree_hash_algorithm_defaults_to_sha256(self):
+        """Test that trees without a hash algorithm use SHA-256."""
+        tree = leveldb_merkle_tree.LeveldbMerkleTree(db=self.db)
+        self.assertEqual(tree.hash_algorithm, "sha256")
+        tree.close()
+
+    def test_tree_export_import(self):
+        """Test that an exported tree imports into an identical tree."""
+        tree = leveldb_merkle_tree.LeveldbMerkleTree(
+                leaves=[str(i) for i in range(100)], db=self.db)
+        for size in (100, 37, 0):
+            out = StringIO.StringIO()
+            tree.export_snapshot(size, out)
+            db = os.path.join(self.db, "import-%d" % size)
+            imported = leveldb_merkle_tree.LeveldbMerkleTree(db=db)
+            root = imported.import_snapshot(
+                    StringIO.StringIO(out.getvalue()),
+                    expected_root_hash=tree.get_root_hash(size))
+            self.assertEqual(root, tree.get_root_hash(size))
+            self.assertEqual(imported.tree_size, size)
+            self.assertEqual(imported.get_root_hash(), root)
+            if size:
+                self.assertEqual(imported.get_inclusion_proof(size - 1),
+                                 tree.get_inclusion_proof(size - 1, size))
+                self.assertEqual(imported.get_leaf_index(
+                        tree.get_leaf(size - 1)), size - 1)
+            imported.add_leaf("x")
+            self.assertEqual(imported.get_root_hash(),
+                             merkle.TreeHasher().hash_full_tree(
+                                     [str(i) for i in range(size)] + ["x"]))
+            self.assertRaises(ValueError, imported.import_snapshot,
+                              StringIO.StringIO(out.getvalue()))
+            imported.close()
+
+    def test_tree_import_frontier_from_tiles(self):
+        """Test imports whose frontiers span several levels of tiles."""
+        self.addCleanup(setattr, leveldb_merkle_tree, "TILE_HEIGHT",
+                        leveldb_merkle_tree.TILE_HEIGHT)
+        self.addCleanup(setattr, leveldb_merkle_tree, "TILE_WIDTH",
+                        leveldb_merkle_tree.TILE_WIDTH)
+        leveldb_merkle_tree.TILE_HEIGHT = 2
+        leveldb_merkle_tree.TILE_WIDTH = 4
+        tree = leveldb_merkle_tree.LeveldbMerkleTree(
+                leaves=[str(i) for i in range(90)], db=self.db)
+        for size in (1, 4, 16, 21, 64, 67, 83, 90):
+            out = StringIO.StringIO()
+            tree.export_snapshot(size, out)
+            db = os.path.join(self.db, "import-%d" % size)
+            imported = leveldb_merkle_tree.LeveldbMerkleTree(db=db)
+            self.assertEqual(imported.import_snapshot(
+                    StringIO.StringIO(out.getvalue())),
+                    tree.get_root_hash(size))
+            self.assertEqual(imported.get_consistency_proof(size // 2),
+                             tree.get_consistency_proof(size // 2, size))
+            imported.close()
+        tree.close()
+        tree.close()
+
+    def test_tree_failed_import_leaves_tree_empty(self):
+        """Test that a bad export is rejected and nothing is imported."""
+        tree = leveldb_merkle_tree.LeveldbMerkleTree(
+                leaves=TEST_VECTOR_DATA, db=self.db)
+        out = StringIO.StringIO()
+        tree.export_snapshot(None, out)
+        data = out.getvalue()
+        tree.close()
+        imported = leveldb_merkle_tree.LeveldbMerkleTree(
+                db=os.path.join(self.db, "import"))
+        self.assertRaises(error.EncodingError, imported.import_snapshot,
+                          StringIO.StringIO(data[:-1]))
+        self.assertRaises(error.ConsistencyError, imported.import_snapshot,
+                          StringIO.StringIO(data), "x" * 32)
+        # A corrupt leaf hash, with a valid checksum, frontier and root.
+        hasher = merkle.TreeHasher()
+        leaf_hashes = [hasher.hash_leaf(l) for l in TEST_VECTOR_DATA]
+        frontier = merkle.CompactMerkleTree(
+                leveldb_merkle_tree.IncrementalTreeHasher("sha256"))
+        frontier.extend(leaf_hashes)
+        out = StringIO.StringIO()
+        tree_export.write_export(out, "sha256", len(leaf_hashes), 32,
+                                 [leaf_hashes[:3] + ["x" * 32] +
+                                  leaf_hashes[4:]], frontier.hashes,
+                                 frontier.root_hash())
+        self.assertRaises(error.ConsistencyError, imported.import_snapshot,
+                          StringIO.StringIO(out.getvalue()))
+        self.assertEqual(imported.tree_size, 0)
+        self.assertEqual(imported.get_leaves(), [])
+        self.assertEqual(imported.get_leaf_index(
+                merkle.TreeHasher().hash_leaf(TEST_VECTOR_DATA[0])), -1)
+        imported.import_snapshot(StringIO.StringIO(data))
+        self.assertEqual(imported.tree_size, len(TEST_VECTOR_DATA))
+        imported.close()
+
+    def test_tree_segments(self):
+        """Test that completed runs of leaves move into segment files."""
+        segment_dir = os.path.join(self.db, "segments")
+        tree = leveldb_merkle_tree.LeveldbMerkleTree(
+                db=os.path.join(self.db, "tree"), segment_dir=segment_dir,
+                segment_height=2)
+        reference = leveldb_merkle_tree.LeveldbMerkleTree(
+                db=os.path.join(self.db, "reference"))
+        leaves = [str(i) for i in range(19)]
+        for chunk in (leaves[:3], leaves[3:10], leaves[10:]):
+            tree.extend(chunk)
+            reference.extend(chunk)
+        self.assertEqual(sorted(os.listdir(segment_dir)),
+                         ["%08d.segment" % i for i in range(4)])
+        # Only the leaves past the last segment stay in LevelDB.
+        self.assertEqual(list(tree._leaves_db.iterator(include_value=False)),
+                         [leveldb_merkle_tree.encode_int(i)
+                          for i in range(16, 19)])
+        self.assertEqual(tree.get_leaves(), reference.get_leaves())
+        self.assertEqual(tree.get_leaves(5, 17), reference.get_leaves(5, 17))
+        for size in range(1, 20):
+            self.assertEqual(tree.get_root_hash(size),
+                             reference.get_root_hash(size))
+            for index in range(size):
+                self.assertEqual(tree.get_inclusion_proof(index, size),
+                                 reference.get_inclusion_proof(index, size))
+            for old_size in range(1, size):
+                self.assertEqual(
+                        tree.get_consistency_proof(old_size, size),
+                        reference.get_consistency_proof(old_size, size))
+        self.assertEqual(tree.get_leaf_index(tree.get_leaf(6)), 6)
+
+        tree.close()
+        self.assertRaises(ValueError, leveldb_merkle_tree.LeveldbMerkleTree,
+                          db=os.path.join(self.db, "tree"))
+        self.assertRaises(ValueError, leveldb_merkle_tree.LeveldbMerkleTree,
+                          db=os.path.join(self.db, "tree"),
+                          segment_dir=segment_dir, segment_height=3)
+        tree = leveldb_merkle_tree.LeveldbMerkleTree(
+                db=os.path.join(self.db, "tree"), segment_dir=segment_dir,
+                segment_height=2)
+        with tree.snapshot() as snapshot:
+            tree.add_leaf("19")
+            reference.add_leaf("19")
+            self.assertEqual(len(os.listdir(segment_dir)), 5)
+            # The snapshot still reads leaves 16-18 from LevelDB.
+            self.assertEqual(snapshot.get_leaves(), reference.get_leaves(0, 19))
+        self.assertEqual(tree.get_root_hash(), reference.get_root_hash())
+        out = StringIO.StringIO()
+        tree.export_snapshot(None, out)
+        expected = StringIO.StringIO()
+        reference.export_snapshot(None, expected)
+        self.assertEqual(out.getvalue(), expected.getvalue())
+        tree.close()
+        reference.close()
+
+    def test_tree_tiles(self):
+        """Test that tiles hold the nodes of complete subtrees."""
+        tree = leveldb_merkle_tree.LeveldbMerkleTree(db=self.db)
+        hasher = merkle.TreeHasher()
+        leaves = [str(i) for i in range(600)]
+        for chunk in (leaves[:100], leaves[100:300], leaves[300:301],
+                      leaves[301:]):
+            tree.extend(chunk)
+        self.assertEqual(tree.get_tile(0, 2),
+                         [hasher.hash_leaf(l) for l in leaves[512:]])
+        self.assertEqual(tree.get_tile(1, 0),
+                         [hasher.hash_full_tree(leaves[i:i + 256])
+                          for i in (0, 256)])
+        self.assertEqual(tree.get_tile(2, 0), [])
+        for size in (1, 255, 256, 257, 511, 512, 513, 600):
+            self.assertEqual(tree.get_root_hash(size),
+                             hasher.hash_full_tree(leaves[:size]))
+        verifier = merkle.MerkleVerifier()
+        head = tree.publish_tree_head(timestamp=1)
+        for index in (0, 255, 256, 300, 599):
+            verifier.verify_leaf_inclusion(
+                    leaves[index], index,
+                    tree.get_inclusion_proof(index, 600), head)
+        tree.close()
+
+    def test_tree_tiles_at_every_level(self):
+        """Test proofs from several levels of (small) tiles."""
+        self.addCleanup(setattr, leveldb_merkle_tree, "TILE_HEIGHT",
+                        leveldb_merkle_tree.TILE_HEIGHT)
+        self.addCleanup(setattr, leveldb_merkle_tree, "TILE_WIDTH",
+                        leveldb_merkle_tree.TILE_WIDTH)
+        leveldb_merkle_tree.TILE_HEIGHT = 2
+        leveldb_merkle_tree.TILE_WIDTH = 4
+        tree = leveldb_merkle_tree.LeveldbMerkleTree(db=self.db)
+        reference = in_memory_merkle_tree.InMemoryMerkleTree([])
+        hasher = merkle.TreeHasher()
+        for i in range(70):
+            tree.add_leaf(str(i))
+            reference.add_leaf(str(i))
+        self.assertEqual(tree.get_tile(3, 0), [
+                hasher.hash_full_tree([str(i) for i in range(64)])])
+        for size in range(1, 71):
+            self.assertEqual(tree.get_root_hash(size),
+                             reference.get_root_hash(size))
+            for index in range(0, size, 7):
+                self.assertEqual(
+                        tree.get_inclusion_proof(index, size),
+                        reference.get_inclusion_proof(index, size))
+            for old_size in range(1, size, 5):
+                self.assertEqual(
+                        tree.get_consistency_proof(old_size, size),
+                        reference.get_consistency_proof(old_size, size))
+        tiles = list(tree._tiles_db.iterator())
+        tree.close()
+        # 17 nodes at level 2, 4 at level 4 and 1 at level 6.
+        self.assertEqual(len(tiles), 5 + 1 + 1)
+
+    def test_snapshot_tile_cache_is_bounded(self):
+        """Test that snapshots keep only a few tiles, evicting the rest."""
+        self.addCleanup(setattr, leveldb_merkle_tree,
+                        "_SNAPSHOT_TILE_CACHE_SIZE",
+                        leveldb_merkle_tree._SNAPSHOT_TILE_CACHE_SIZE)
+        leveldb_merkle_tree._SNAPSHOT_TILE_CACHE_SIZE = 2
+        tree = leveldb_merkle_tree.LeveldbMerkleTree(
+                leaves=[str(i) for i in range(3000)], db=self.db)
+        with tree.snapshot() as snapshot:
+            for index in range(0, 3000, 97):
+                self.assertEqual(snapshot.get_inclusion_proof(index),
+                                 tree.get_inclusion_proof(index))
+            self.assertEqual(
+                    len(snapshot._LeveldbMerkleTreeSnapshot__tiles), 2)
+        tree.close()
+
+    def test_tree_builds_missing_tiles(self):
+        """Test that opening a tree without tiles builds them."""
+        tree = leveldb_merkle_tree.LeveldbMerkleTree(
+                leaves=[str(i) for i in range(1000)], db=self.db)
+        tiles = list(tree._tiles_db.iterator())
+        root = tree.get_root_hash(700)
+        tree.close()
+        db = plyvel.DB(self.db)
+        for key in db.iterator(prefix='tiles-', include_value=False):
+            db.delete(key)
+        db.delete('stats-tile_height')
+        db.close()
+        tree = leveldb_merkle_tree.LeveldbMerkleTree(db=self.db)
+        self.assertEqual(list(tree._tiles_db.iterator()), tiles)
+        self.assertEqual(tree.get_root_hash(700), root)
+        tree.close()
+
+    def test_tree_inclusion_proof_upgrade(self):
+        """Test that upgraded proofs match proofs at the new size."""
+        tree = leveldb_merkle_tree.LeveldbMerkleTree(db=self.db)
+        tree.extend([str(i) for i in range(300)])
+        old_proof = tree.get_inclusion_proof(7, 300)
+        tree.extend([str(i) for i in range(300, 1000)])
+        upgrade = tree.get_inclusion_proof_upgrade(7, 300)
+        self.assertEqual(merkle.upgrade_inclusion_proof(
+                7, 300, old_proof, 1000, upgrade),
+                         tree.get_inclusion_proof(7, 1000))
+        self.assertTrue(len(upgrade) < len(old_proof))
+        self.assertRaises(ValueError, tree.get_inclusion_proof_upgrade,
+                          7, 300, 1001)
+        tree.close()
+
+    def test_tree_extend_emits_proofs(self):
+        """Test receipts from extend() and receipt callbacks."""
+        tree = leveldb_merkle_tree.LeveldbMerkleTree(db=self.db)
+        tree.extend([str(i) for i in range(300)])
+        received = []
+        tree.add_receipt_callback(received.append)
+        receipts = tree.extend([str(i) for i in range(300, 600)],
+                               emit_proofs=True)
+        self.assertEqual(received, [receipts])
+        verifier = merkle.MerkleVerifier()
+        head = tree.publish_tree_head(timestamp=1)
+        for i, receipt in enumerate(receipts):
+            self.assertEqual(receipt, leveldb_merkle_tree.LeafReceipt(
+                    300 + i, 600, tree.get_inclusion_proof(300 + i, 600),
+                    True))
+            verifier.verify_leaf_inclusion(str(300 + i), receipt.leaf_index,
+                                           receipt.audit_path, head)
+
+        receipts = tree.extend(["5", "new", "new"], dedupe=True,
+                               emit_proofs=True)
+        self.assertEqual([(r.leaf_index, r.was_new) for r in receipts],
+                         [(5, False), (600, True), (600, False)])
+        self.assertEqual(receipts[0].audit_path,
+                         tree.get_inclusion_proof(5, 601))
+        self.assertEqual(len(received), 2)
+        tree.remove_receipt_callback(received.append)
+        self.assertEqual(tree.add_leaf("x"), 601)
+        self.assertEqual(len(received), 2)
+        tree.close()
+
+    def test_tree_failing_receipt_callback(self):
+        """Test that a failing receipt callback does not fail the append."""
+        tree = leveldb_merkle_tree.LeveldbMerkleTree(db=self.db)
+        received = []
+        def fail(receipts):
+            raise RuntimeError("callback failed")
+        tree.add_receipt_callback(fail)
+        tree.add_receipt_callback(received.append)
+        logger = logging.getLogger()
+        level = logger.level
+        logger.setLevel(logging.CRITICAL)
+        try:
+            receipts = tree.extend(["a", "b"], emit_proofs=True)
+        finally:
+            logger.setLevel(level)
+        self.assertEqual(len(receipts), 2)
+        self.assertEqual(received, [receipts])
+        self.assertEqual(tree.tree_size, 2)
+        tree.close()
+
+    def test_tree_range_proof(self):
+        """Test that range proofs verify against the tree head."""
+        tree = leveldb_merkle_tree.LeveldbMerkleTree(
+                leaves=[str(i) for i in range(1000)], db=self.db)
+        head = tree.publish_tree_head(timestamp=1)
+        reference = in_memory_merkle_tree.InMemoryMerkleTree(
+                [str(i) for i in range(1000)])
+        for start, end in ((0, 1000), (0, 256), (100, 612), (999, 1000)):
+            proof = tree.get_range_proof(start, end)
+            self.assertEqual(proof, reference.get_range_proof(start, end))
+            merkle.MerkleVerifier().verify_range_hash_inclusion(
+                    tree.get_leaves(start, end), start, proof, head)
+        self.assertEqual(tree.get_range_proof(3, 5, 8),
+                         reference.get_range_proof(3, 5, 8))
+        self.assertRaises(ValueError, tree.get_range_proof, 3, 5, 1001)
+        tree.close()
+
+    def test_tree_get_subtree_hash(self):
+        """Test subtree hashes of arbitrary leaf ranges."""
+        leaves = [str(i) for i in range(600)]
+        tree = leveldb_merkle_tree.LeveldbMerkleTree(leaves=leaves,
+                                                     db=self.db)
+        reference = in_memory_merkle_tree.InMemoryMerkleTree(leaves)
+        hasher = merkle.TreeHasher()
+        for start, end in ((0, 600), (256, 512), (3, 3), (3, 4), (5, 300),
+                           (100, 599), (512, 600)):
+            self.assertEqual(tree.get_subtree_hash(start, end),
+                             hasher.hash_full_tree(leaves[start:end]))
+            self.assertEqual(reference.get_subtree_hash(start, end),
+                             hasher.hash_full_tree(leaves[start:end]))
+        self.assertRaises(ValueError, tree.get_subtree_hash, 5, 601)
+        self.assertRaises(ValueError, reference.get_subtree_hash, 5, 4)
+        tree.close()
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,198 @@
+"""A monitor that follows a log's tree heads with a compact tree.
+
+LogMonitor keeps only the CompactMerkleTree frontier of the log up to the
+last tree head it verified, persisted to a state file. Each poll streams the
+leaf hashes added since then, extends the frontier, checks its root against
+the log's new tree head and verifies the new head's consistency with the old
+one, so a poll costs work proportional to the new entries.
+
+The log is read through a source with the methods of
+replica_sync.LocalPrimary.
+
+>>> monitor = log_monitor.LogMonitor(source, "./monitor.state",
+...                                  on_leaves=check_entries)
+>>> monitor.poll()
+"""
+
+import base64
+import logging
+import os
+import threading
+
+import error
+import leveldb_merkle_tree
+import merkle
+import tree_head
+
+
+def encode_state(hash_algorithm, head, frontier_hashes):
+    """Serialise a verified head and its frontier into monitor state."""
+    lines = [hash_algorithm,
+             "%d %d %s" % (head.tree_size, head.timestamp,
+                           base64.b64encode(head.root_hash))]
+    lines.extend(base64.b64encode(h) for h in frontier_hashes)
+    return "\n".join(lines) + "\n"
+
+
+def decode_state(data):
+    """Parse monitor state written by encode_state().
+
+    Returns:
+        A (hash_algorithm, TreeHead, frontier hashes) tuple.
+
+    Raises:
+        EncodingError: the state is malformed.
+    """
+    lines = data.split("\n")
+    if len(lines) < 3 or lines[-1]:
+        raise error.EncodingError("Malformed monitor state")
+    try:
+        tree_size, timestamp, root_hash = lines[1].split(" ")
+        head = tree_head.TreeHead(int(tree_size), int(timestamp),
+                                  base64.b64decode(root_hash))
+        hashes = [base64.b64decode(line) for line in lines[2:-1]]
+    except (ValueError, TypeError) as e:
+        raise error.EncodingError("Malformed monitor state: %s" % e)
+    return lines[0], head, hashes
+
+
+class LogMonitor(object):
+    """Follows the tree heads of a log, verifying each against the last.
+
+    |on_leaves(start, leaf_hashes)| is called with each chunk of new leaf
+    hashes as it is streamed, before the head covering them is verified; a
+    poll that raises means that the leaves it delivered are not trusted.
+    Without a state file, the monitor starts from the empty tree.
+    """
+
+    def __init__(self, source, state_path=None, chunk_size=4096,
+                 on_leaves=None):
+        self.__source = source
+        self.__state_path = state_path
+        self.__chunk_size = chunk_size
+        self.__on_leaves = on_leaves
+        self.__hasher = leveldb_merkle_tree.IncrementalTreeHasher(
+                source.hash_algorithm)
+        self.__verifier = merkle.MerkleVerifier(self.__hasher)
+        self.__head = None
+        self.__frontier = merkle.CompactMerkleTree(self.__hasher)
+        self.__lock = threading.Lock()
+        self.__stop = threading.Event()
+        self.__thread = None
+        self.__load_state()
+
+    def __repr__(self):
+        return "%s(%r, %r)" % (self.__class__.__name__, self.__source,
+                               self.__state_path)
+
+    @property
+    def tree_head(self):
+        """The last verified TreeHead, or None."""
+        return self.__head
+
+    @property
+    def tree_size(self):
+        return self.__frontier.tree_size
+
+    def __load_state(self):
+        if self.__state_path is None or not os.path.exists(self.__state_path):
+            return
+        with open(self.__state_path, "rb") as f:
+            hash_algorithm, head, hashes = decode_state(f.read())
+        if hash_algorithm != self.__hasher.algorithm:
+            raise ValueError("Monitor state uses hash algorithm %s, not %s" %
+                             (hash_algorithm, self.__hasher.algorithm))
+        frontier = merkle.CompactMerkleTree(self.__hasher, head.tree_size,
+                                            hashes)
+        if frontier.root_hash() != head.root_hash:
+            raise error.EncodingError(
+                "Monitor state frontier does not match its tree head")
+        self.__head = head
+        self.__frontier = frontier
+
+    def __save_state(self):
+        if self.__state_path is None:
+            return
+        tmp_path = self.__state_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(encode_state(self.__hasher.algorithm, self.__head,
+                                 self.__frontier.hashes))
+        os.rename(tmp_path, self.__state_path)
+
+    def poll(self):
+        """Catches up with the log's latest tree head.
+
+        Returns:
+            The last verified TreeHead, or None if the log has none yet.
+
+        Raises:
+            ConsistencyError: the log's new head does not extend the last
+                verified one, or its root does not match its leaves.
+            ProofError: the log's consistency proof is invalid.
+        """
+        with self.__lock:
+            head = self.__source.get_tree_head()
+            if head is None:
+                return self.__head
+            old = self.__head
+            if old is not None:
+                if head.tree_size < old.tree_size:
+                    raise error.ConsistencyError(
+                        "Log shrank from %d to %d leaves" %
+                        (old.tree_size, head.tree_size))
+                if head.tree_size == old.tree_size:
+                    if head.root_hash != old.root_hash:
+                        raise error.ConsistencyError(
+                            "Log has two roots at size %d" % head.tree_size)
+                    return old
+            frontier = self.__frontier
+            while frontier.tree_size < head.tree_size:
+                start = frontier.tree_size
+                stop = min(start + self.__chunk_size, head.tree_size)
+                leaf_hashes = self.__source.get_leaf_hashes(start, stop)
+                if len(leaf_hashes) != stop - start:
+                    raise error.ProofError("Log sent %d leaves for [%d, %d)" %
+                                           (len(leaf_hashes), start, stop))
+                frontier = frontier.extended(leaf_hashes)
+                if self.__on_leaves is not None:
+                    self.__on_leaves(start, leaf_hashes)
+            if frontier.root_hash() != head.root_hash:
+                raise error.ConsistencyError(
+                    "Leaves of the log do not match its head at size %d" %
+                    head.tree_size)
+            if old is not None and old.tree_size:
+                self.__verifier.verify_tree_consistency(
+                        old.tree_size, head.tree_size, old.root_hash,
+                        head.root_hash, self.__source.get_consistency_proof(
+                                old.tree_size, head.tree_size))
+            self.__head = head
+            self.__frontier = frontier
+            self.__save_state()
+            logging.debug("Monitor verified head at %d", head.tree_size)
+            return head
+
+    def start(self, poll_interval=60.0):
+        """Calls poll() periodically from a background thread."""
+        if self.__thread is not None:
+            raise RuntimeError("Monitor already started")
+        self.__stop.clear()
+        self.__thread = threading.Thread(target=self.__run,
+                                         args=(poll_interval,),
+                                         name="log-monitor")
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def __run(self, poll_interval):
+        while not self.__stop.wait(poll_interval):
+            try:
+                self.poll()
+            except Exception:
+                logging.exception("Failed to poll log")
+
+    def stop(self):
+        """Stops the background thread started by start()."""
+        if self.__thread is None:
+            return
+        self.__stop.set()
+        self.__thread.join()
+        self.__thread = None
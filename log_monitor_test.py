@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+"""Tests for log_monitor."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import error
+import leveldb_merkle_tree
+import log_monitor
+import replica_sync
+import tree_head
+
+
+class _RecordingSource(replica_sync.LocalPrimary):
+    """Records the ranges of leaf hashes read, optionally forging heads."""
+
+    def __init__(self, tree):
+        super(_RecordingSource, self).__init__(tree)
+        self.reads = []
+        self.forged_head = None
+
+    def get_tree_head(self):
+        if self.forged_head is not None:
+            return self.forged_head
+        return super(_RecordingSource, self).get_tree_head()
+
+    def get_leaf_hashes(self, start, stop):
+        self.reads.append((start, stop))
+        return super(_RecordingSource, self).get_leaf_hashes(start, stop)
+
+
+class LogMonitorTest(unittest.TestCase):
+    """Tests for LogMonitor."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.state = os.path.join(self.dir, "monitor.state")
+        self.tree = leveldb_merkle_tree.LeveldbMerkleTree(
+                db=os.path.join(self.dir, "db"))
+        self.source = _RecordingSource(self.tree)
+
+    def tearDown(self):
+        self.tree.close()
+        shutil.rmtree(self.dir)
+
+    def test_state_round_trip(self):
+        head = tree_head.TreeHead(3, 4, "r" * 32)
+        data = log_monitor.encode_state("sha256", head, ["a" * 32, "b" * 32])
+        self.assertEqual(log_monitor.decode_state(data),
+                         ("sha256", head, ["a" * 32, "b" * 32]))
+        self.assertRaises(error.EncodingError, log_monitor.decode_state,
+                          data[:-1])
+        self.assertRaises(error.EncodingError, log_monitor.decode_state,
+                          "sha256\nx 4 cg==\n")
+
+    def test_polls_read_only_new_leaves(self):
+        delivered = []
+        monitor = log_monitor.LogMonitor(
+                self.source, self.state, chunk_size=7,
+                on_leaves=lambda start, hashes: delivered.append(
+                        (start, len(hashes))))
+        self.assertEqual(monitor.poll(), None)
+        self.tree.extend([str(i) for i in range(10)])
+        first = self.tree.publish_tree_head(timestamp=1)
+        self.assertEqual(monitor.poll(), first)
+        self.assertEqual(self.source.reads, [(0, 7), (7, 10)])
+        self.assertEqual(delivered, [(0, 7), (7, 3)])
+
+        self.tree.extend([str(i) for i in range(10, 25)])
+        second = self.tree.publish_tree_head(timestamp=2)
+        self.assertEqual(monitor.poll(), second)
+        self.assertEqual(self.source.reads[2:], [(10, 17), (17, 24),
+                                                 (24, 25)])
+        self.assertEqual(monitor.poll(), second)
+        self.assertEqual(len(self.source.reads), 5)
+        self.assertEqual(monitor.tree_size, 25)
+
+    def test_state_persists(self):
+        self.tree.extend([str(i) for i in range(13)])
+        first = self.tree.publish_tree_head(timestamp=1)
+        log_monitor.LogMonitor(self.source, self.state).poll()
+        self.tree.extend([str(i) for i in range(13, 20)])
+        second = self.tree.publish_tree_head(timestamp=2)
+        source = _RecordingSource(self.tree)
+        monitor = log_monitor.LogMonitor(source, self.state)
+        self.assertEqual(monitor.tree_head, first)
+        self.assertEqual(monitor.poll(), second)
+        self.assertEqual(source.reads, [(13, 20)])
+
+    def test_detects_forged_heads(self):
+        self.tree.extend([str(i) for i in range(8)])
+        head = self.tree.publish_tree_head(timestamp=1)
+        monitor = log_monitor.LogMonitor(self.source, self.state)
+        monitor.poll()
+        self.source.forged_head = tree_head.TreeHead(8, 2, "x" * 32)
+        self.assertRaises(error.ConsistencyError, monitor.poll)
+        self.source.forged_head = tree_head.TreeHead(5, 2, head.root_hash)
+        self.assertRaises(error.ConsistencyError, monitor.poll)
+        self.tree.extend([str(i) for i in range(8, 12)])
+        self.source.forged_head = tree_head.TreeHead(12, 3, "x" * 32)
+        self.assertRaises(error.ConsistencyError, monitor.poll)
+        # A failed poll leaves the verified head and its state alone.
+        self.assertEqual(monitor.tree_head, head)
+        self.assertEqual(
+                log_monitor.LogMonitor(self.source, self.state).tree_head,
+                head)
+        self.source.forged_head = None
+        head = self.tree.publish_tree_head(timestamp=4)
+        self.assertEqual(monitor.poll(), head)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+"""A bounded mapping that evicts the least recently used entries."""
+
+import collections
+import threading
+
+
+class LRUCache(object):
+    """Holds up to |capacity| entries, evicting the least recently used.
+
+    It can be shared between threads. hits and misses count the lookups made
+    with get().
+    """
+
+    def __init__(self, capacity):
+        if capacity < 1:
+            raise ValueError("Capacity must be positive: %d" % capacity)
+        self.__capacity = capacity
+        self.__entries = collections.OrderedDict()
+        self.__lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return "%s(%d)" % (self.__class__.__name__, self.__capacity)
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def __contains__(self, key):
+        return key in self.__entries
+
+    @property
+    def capacity(self):
+        return self.__capacity
+
+    def get(self, key, default=None):
+        """Returns the entry for |key|, marking it as recently used."""
+        with self.__lock:
+            try:
+                value = self.__entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.__entries[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.__lock:
+            self.__entries.pop(key, None)
+            self.__entries[key] = value
+            while len(self.__entries) > self.__capacity:
+                self.__entries.popitem(last=False)
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
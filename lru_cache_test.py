@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+
+"""Tests for LRUCache."""
+
+import unittest
+
+import lru_cache
+
+
+class LRUCacheTest(unittest.TestCase):
+    """Tests for LRUCache."""
+
+    def test_evicts_least_recently_used(self):
+        cache = lru_cache.LRUCache(2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+        cache.put("c", 3)
+        self.assertFalse("b" in cache)
+        self.assertEqual(cache.get("b", -1), -1)
+        self.assertEqual((cache.get("a"), cache.get("c")), (1, 3))
+        cache.put("a", 4)
+        cache.put("d", 5)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get("a"), 4)
+        self.assertEqual((cache.hits, cache.misses), (4, 1))
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_bad_capacity(self):
+        self.assertRaises(ValueError, lru_cache.LRUCache, 0)
+
+if __name__ == "__main__":
+    unittest.main()
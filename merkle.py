@@ -1,6 +1,6 @@
 """Merkle trees.
 
-Benchmark sample code:
+Benchmark sample code (see benchmark.py for the full benchmark suite):
 
 >>> import os
 >>> import timeit
@@ -22,10 +22,22 @@ Benchmark sample code:
 1.50476324558
 """
 
+import functools
 import hashlib
 import logging
 
 import error
+import lru_cache
+
+try:
+    import pyblake2
+except ImportError:
+    pyblake2 = None
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
 
 
 def count_bits_set(i):
@@ -47,12 +59,319 @@ def lowest_bit_set(i):
     return lowBit
 
 
+def _largest_power_of_two_below(n):
+    """Returns the largest power of two strictly smaller than n >= 2."""
+    return 1 << ((n - 1).bit_length() - 1)
+
+
+def perfect_subtrees(start, end):
+    """Yields (start, size) for the perfect subtrees covering [start, end).
+
+    Sizes are descending, so the hashes of the subtrees fold into the hash of
+    the range as for a CompactMerkleTree, provided that the range is one of
+    an RFC 6962 tree, i.e. that |start| is a multiple of a power of two no
+    smaller than end - start.
+    """
+    while start < end:
+        size = 1 << ((end - start).bit_length() - 1)
+        while start % size:
+            size >>= 1
+        yield start, size
+        start += size
+
+
+def calculate_subtree_hash(start, end, hasher, perfect_subtree_hash):
+    """Returns MTH(D[start:end]), the tree hash of the leaves [start, end).
+
+    |perfect_subtree_hash(start, size)| returns the hash of the perfect
+    subtree of |size| leaves at |start|, a multiple of |size|, letting trees
+    serve it from stored nodes. Ranges that are nodes of the tree, as in
+    proofs, fold O(log n) such subtrees; other ranges are split as RFC 6962
+    splits D[start:end] until their parts are aligned.
+    """
+    size = end - start
+    if size <= 0:
+        return hasher.hash_empty()
+    k = 1 << (size.bit_length() - 1)
+    if start % k == 0:
+        return hasher._hash_fold([perfect_subtree_hash(s, n) for s, n in
+                                  perfect_subtrees(start, end)])
+    k = _largest_power_of_two_below(size)
+    return hasher.hash_children(
+            calculate_subtree_hash(start, start + k, hasher,
+                                   perfect_subtree_hash),
+            calculate_subtree_hash(start + k, end, hasher,
+                                   perfect_subtree_hash))
+
+
+def calculate_inclusion_proof(leaf_index, tree_size, subtree_hash):
+    """Merkle audit path, RFC6962 Section 2.1.1.
+
+    |subtree_hash(start, end)| returns the hash of the leaves [start, end),
+    which lets trees serve proofs from stored nodes instead of leaves.
+    """
+    path = []
+    start, end = 0, tree_size
+    while end - start > 1:
+        k = _largest_power_of_two_below(end - start)
+        if leaf_index < start + k:
+            path.append(subtree_hash(start + k, end))
+            end = start + k
+        else:
+            path.append(subtree_hash(start, start + k))
+            start += k
+    path.reverse()
+    return path
+
+
+def calculate_range_proof(start, end, tree_size, subtree_hash):
+    """Proof that the leaves [start, end) are those of a tree of |tree_size|.
+
+    The proof holds, from left to right, the hashes of the largest nodes of
+    the tree that do not overlap the range, i.e. the nodes along the paths of
+    the first and last leaf of the range: at most 2 log n hashes. See
+    calculate_inclusion_proof() for |subtree_hash|.
+    """
+    if not 0 <= start < end <= tree_size:
+        raise ValueError("Bad range [%d, %d) for tree size %d" %
+                         (start, end, tree_size))
+    proof = []
+    def walk(node_start, node_end):
+        if node_end <= start or end <= node_start:
+            proof.append(subtree_hash(node_start, node_end))
+        elif not (start <= node_start and node_end <= end):
+            k = _largest_power_of_two_below(node_end - node_start)
+            walk(node_start, node_start + k)
+            walk(node_start + k, node_end)
+    walk(0, tree_size)
+    return proof
+
+
+def calculate_batch_inclusion_proofs(hasher, old_size, frontier_hashes,
+                                     leaf_hashes, leaf_indices,
+                                     subtree_hash=None):
+    """Inclusion proofs against a tree just extended with |leaf_hashes|.
+
+    The tree had |old_size| leaves, with the perfect subtree hashes
+    |frontier_hashes| of a CompactMerkleTree, before |leaf_hashes| were
+    appended. Returns a proof at the new size for each of |leaf_indices|.
+
+    Nodes over the new leaves are computed once from |leaf_hashes| and shared
+    between the proofs, and the old part of the tree is covered by the
+    frontier, so proofs for a whole batch take O(batch + log n) hashes.
+    |subtree_hash(start, end)| (see calculate_inclusion_proof()) is only
+    called for old nodes the frontier does not hold, i.e. for proofs of
+    leaves from before the batch.
+    """
+    new_size = old_size + len(leaf_hashes)
+    known = {}
+    for (start, size), node in zip(perfect_subtrees(0, old_size),
+                                   frontier_hashes):
+        known[(start, start + size)] = node
+    for i, leaf_hash in enumerate(leaf_hashes):
+        known[(old_size + i, old_size + i + 1)] = leaf_hash
+
+    def node_hash(start, end):
+        node = known.get((start, end))
+        if node is None:
+            if end <= old_size:
+                node = subtree_hash(start, end)
+            else:
+                k = _largest_power_of_two_below(end - start)
+                node = hasher.hash_children(node_hash(start, start + k),
+                                            node_hash(start + k, end))
+            known[(start, end)] = node
+        return node
+
+    return [calculate_inclusion_proof(index, new_size, node_hash)
+            for index in leaf_indices]
+
+
+def _subtree_range(start, end):
+    return start, end
+
+
+def calculate_inclusion_proof_upgrade(leaf_index, old_size, new_size,
+                                      subtree_hash):
+    """Returns the nodes needed to upgrade an inclusion proof to |new_size|.
+
+    A proof for |leaf_index| at |new_size| shares with the proof at
+    |old_size| every node covering the same leaves, i.e. all but the nodes
+    at the right of the old path. Only the others are computed and returned,
+    in proof order; upgrade_inclusion_proof() merges them into the old proof.
+    See calculate_inclusion_proof() for |subtree_hash|.
+    """
+    if not 0 <= leaf_index < old_size <= new_size:
+        raise ValueError("Cannot upgrade a proof for leaf %d from size %d to "
+                         "%d" % (leaf_index, old_size, new_size))
+    old_ranges = set(calculate_inclusion_proof(leaf_index, old_size,
+                                               _subtree_range))
+    return [subtree_hash(start, end) for start, end in
+            calculate_inclusion_proof(leaf_index, new_size, _subtree_range)
+            if (start, end) not in old_ranges]
+
+
+def upgrade_inclusion_proof(leaf_index, old_size, old_proof, new_size,
+                            upgrade):
+    """Merges the |upgrade| nodes into an inclusion proof at |old_size|.
+
+    Returns:
+        The inclusion proof for |leaf_index| at |new_size|.
+
+    Raises:
+        ProofError: the proofs do not have the expected number of nodes.
+    """
+    old_ranges = calculate_inclusion_proof(leaf_index, old_size,
+                                           _subtree_range)
+    if len(old_proof) != len(old_ranges):
+        raise error.ProofError("Proof at size %d has %d nodes, expected %d" %
+                               (old_size, len(old_proof), len(old_ranges)))
+    old_nodes = dict(zip(old_ranges, old_proof))
+    new_ranges = calculate_inclusion_proof(leaf_index, new_size,
+                                           _subtree_range)
+    new_nodes = iter(upgrade)
+    proof = [old_nodes[r] if r in old_nodes else next(new_nodes, None)
+             for r in new_ranges]
+    if None in proof or next(new_nodes, None) is not None:
+        raise error.ProofError("Upgrade to size %d has the wrong number of "
+                               "nodes: %d" % (new_size, len(upgrade)))
+    return proof
+
+
+def calculate_consistency_proof(old_size, new_size, subtree_hash):
+    """Consistency proof, RFC6962 Section 2.1.2.
+
+    See calculate_inclusion_proof() for |subtree_hash|.
+    """
+    if old_size == 0 or old_size == new_size:
+        return []
+    proof = []
+    start, end, m, complete_subtree = 0, new_size, old_size, True
+    while True:
+        if m == end - start:
+            if not complete_subtree:
+                proof.append(subtree_hash(start, end))
+            break
+        k = _largest_power_of_two_below(end - start)
+        if m <= k:
+            proof.append(subtree_hash(start + k, end))
+            end = start + k
+        else:
+            proof.append(subtree_hash(start, start + k))
+            start += k
+            m -= k
+            complete_subtree = False
+    proof.reverse()
+    return proof
+
+
+class _TruncatedHash(object):
+    """A hash object whose digest is cut down to the first |digest_size|."""
+
+    def __init__(self, hashfunc, digest_size, data=""):
+        self.__hash = hashfunc(data)
+        self.digest_size = digest_size
+        self.name = "%s/%d" % (self.__hash.name, digest_size * 8)
+
+    def update(self, data):
+        self.__hash.update(data)
+
+    def digest(self):
+        return self.__hash.digest()[:self.digest_size]
+
+
+def _blake2_constructor(name):
+    constructor = getattr(hashlib, name, None)
+    if constructor is None and pyblake2 is not None:
+        constructor = getattr(pyblake2, name)
+    return constructor
+
+
+# Default (and maximum) digest sizes in bytes.
+_DIGEST_SIZES = {"sha256": 32, "sha512": 64, "blake2b": 64, "blake2s": 32,
+                 "blake3": 32}
+
+
+def hash_algorithm(name):
+    """Returns a hashfunc for TreeHasher, given an algorithm name.
+
+    Names are sha256, sha512, blake2b, blake2s and blake3, optionally followed
+    by "/<bits>" to select a shorter digest, e.g. "blake2b/256" or
+    "sha256/128". BLAKE2 and BLAKE3 produce shorter digests natively (so
+    "blake2b/256" is BLAKE2b-256), while SHA-2 digests are truncated.
+    blake2b and blake2s need the pyblake2 module; blake3 needs the blake3
+    module.
+
+    Raises:
+        UnsupportedAlgorithmError: the algorithm is unknown or unavailable.
+    """
+    base, _, bits = name.partition("/")
+    if base not in _DIGEST_SIZES:
+        raise error.UnsupportedAlgorithmError(
+            "Unknown hash algorithm: %s" % name)
+    digest_size = _DIGEST_SIZES[base]
+    if bits:
+        try:
+            bits = int(bits)
+        except ValueError:
+            bits = 0
+        if bits <= 0 or bits % 8 or bits // 8 > digest_size:
+            raise error.UnsupportedAlgorithmError(
+                "Invalid digest size for %s: %s" % (base, name))
+        digest_size = bits // 8
+
+    if base in ("sha256", "sha512"):
+        hashfunc = getattr(hashlib, base)
+        if digest_size == _DIGEST_SIZES[base]:
+            return hashfunc
+        return functools.partial(_TruncatedHash, hashfunc, digest_size)
+    if base == "blake3":
+        if blake3 is None:
+            raise error.UnsupportedAlgorithmError(
+                "blake3 needs the blake3 module")
+        if digest_size == _DIGEST_SIZES[base]:
+            return blake3.blake3
+        return functools.partial(_TruncatedHash, blake3.blake3, digest_size)
+    constructor = _blake2_constructor(base)
+    if constructor is None:
+        raise error.UnsupportedAlgorithmError(
+            "%s needs the pyblake2 module" % base)
+    return functools.partial(constructor, digest_size=digest_size)
+
+
 class TreeHasher(object):
-    """Merkle hasher with domain separation for leaves and nodes."""
+    """Merkle hasher with domain separation for leaves and nodes.
+
+    |hashfunc| is a hashlib-style constructor, or an algorithm name accepted
+    by hash_algorithm().
+    """
 
     def __init__(self, hashfunc=hashlib.sha256):
+        if isinstance(hashfunc, basestring):
+            self.algorithm = hashfunc
+            hashfunc = hash_algorithm(hashfunc)
+        else:
+            h = hashfunc()
+            name = getattr(h, "name", None)
+            if name:
+                name = name.lower()
+                # Name shorter digests as hash_algorithm() does.
+                digest_size = len(h.digest())
+                if (_DIGEST_SIZES.get(name, digest_size) != digest_size and
+                    "/" not in name):
+                    name = "%s/%d" % (name, digest_size * 8)
+            self.algorithm = name
         self.hashfunc = hashfunc
 
+    @property
+    def digest_size(self):
+        """The size of every hash produced by this hasher."""
+        try:
+            return self.__digest_size
+        except AttributeError:
+            self.__digest_size = len(self.hash_empty())
+            return self.__digest_size
+
     def __repr__(self):
         return "%s(%r)" % (self.__class__.__name__, self.hashfunc)
 
@@ -73,6 +392,40 @@ class TreeHasher(object):
         hasher.update("\x01" + left + right)
         return hasher.digest()
 
+    def _hashes_children_directly(self):
+        # hash_level() may call hashfunc itself unless hash_children has been
+        # replaced, by a subclass or on the instance.
+        return ("hash_children" not in vars(self) and
+                type(self).hash_children.__func__ is
+                TreeHasher.hash_children.__func__)
+
+    def hash_level(self, level):
+        """Hash a level of a tree into its parent level.
+
+        |level| is the concatenation of the level's node hashes, left to right,
+        and so is the result. Adjacent pairs are hashed together and an
+        unpaired last node is carried up unchanged, so applying this until a
+        single hash remains gives the RFC 6962 root.
+        """
+        digest_size = self.digest_size
+        if len(level) % digest_size:
+            raise ValueError("Level of %d bytes is not made of %d-byte hashes"
+                             % (len(level), digest_size))
+        pair_size = 2 * digest_size
+        end = len(level) - len(level) % pair_size
+        if self._hashes_children_directly():
+            # Saves two Python calls per node over hash_children().
+            hashfunc = self.hashfunc
+            parents = [hashfunc("\x01" + level[i:i + pair_size]).digest()
+                       for i in xrange(0, end, pair_size)]
+        else:
+            hash_children = self.hash_children
+            parents = [hash_children(level[i:i + digest_size],
+                                     level[i + digest_size:i + pair_size])
+                       for i in xrange(0, end, pair_size)]
+        parents.append(level[end:])
+        return "".join(parents)
+
     def _hash_full(self, leaves, l_idx, r_idx):
         """Hash the leaves between (l_idx, r_idx) as a valid entire tree.
 
@@ -270,11 +623,35 @@ class CompactMerkleTree(object):
         return new_tree
 
 
+def sth_root_hash(sth):
+    """Returns the root hash of an STH or TreeHead.
+
+    Prefers a root_hash attribute, for heads of trees that do not use SHA-256,
+    and falls back to sha256_root_hash.
+    """
+    root_hash = getattr(sth, "root_hash", None)
+    if root_hash is None:
+        root_hash = sth.sha256_root_hash
+    return root_hash
+
+
 class MerkleVerifier(object):
-    """A utility class for doing Merkle path computations."""
+    """A utility class for doing Merkle path computations.
+
+    The hasher must match the one the tree was built with; proofs containing
+    hashes of the wrong size are rejected.
+
+    With a |cache_size|, the verifier remembers up to that many nodes proven
+    under a root and consistency proofs it has verified. Once an inclusion
+    proof reaches a node already proven under the same root, the rest of it
+    is compared with the proven siblings instead of being hashed, and the
+    same consistency proof between the same two heads is only checked once.
+    """
 
-    def __init__(self, hasher=TreeHasher()):
+    def __init__(self, hasher=TreeHasher(), cache_size=None):
         self.hasher = hasher
+        self.__cache = (lru_cache.LRUCache(cache_size) if cache_size
+                        else None)
 
     def __repr__(self):
         return "%r(hasher: %r)" % (self.__class__.__name__, self.hasher)
@@ -282,6 +659,19 @@ class MerkleVerifier(object):
     def __str__(self):
         return "%s(hasher: %s)" % (self.__class__.__name__, self.hasher)
 
+    @property
+    def cache(self):
+        """The LRUCache of verified nodes and heads, or None."""
+        return self.__cache
+
+    def _check_proof_hashes(self, proof):
+        digest_size = self.hasher.digest_size
+        for node in proof:
+            if len(node) != digest_size:
+                raise error.ProofError(
+                    "Proof contains a hash of %d bytes, expected %d" %
+                    (len(node), digest_size))
+
     @error.returns_true_or_raises
     def verify_tree_consistency(self, old_tree_size, new_tree_size, old_root,
                                 new_root, proof):
@@ -336,6 +726,15 @@ class MerkleVerifier(object):
                                 "empty tree.")
             return True
 
+        self._check_proof_hashes(proof)
+
+        # A pair is only skipped if it comes with the proof it was verified
+        # with.
+        verified_key = ("consistency", old_size, old_root, new_size, new_root)
+        if (self.__cache is not None and
+            self.__cache.get(verified_key) == tuple(proof)):
+            return True
+
         # Now 0 < old_size < new_size
         # A consistency proof is essentially an audit proof for the node with
         # index old_size - 1 in the newer tree. The sole difference is that
@@ -411,6 +810,8 @@ class MerkleVerifier(object):
             pass
         else:
             logging.warning("Proof has extra nodes")
+        if self.__cache is not None:
+            self.__cache.put(verified_key, tuple(proof))
         return True
 
     def _calculate_root_hash_from_audit_path(self, leaf_hash, node_index,
@@ -439,6 +840,63 @@ class MerkleVerifier(object):
                                    len(audit_path))
         return calculated_hash
 
+    def _calculate_root_hash_with_cache(self, leaf_hash, node_index,
+                                        audit_path, tree_size, root_hash):
+        """Like _calculate_root_hash_from_audit_path(), using the node cache.
+
+        The cache maps a node proven under |root_hash| to its hash and the
+        audit path above it. Once the path reaches such a node, comparing the
+        rest of the proof with that audit path replaces hashing it. When the
+        proof leads to |root_hash|, the nodes below that point and their
+        siblings are remembered as proven.
+        """
+        cache = self.__cache
+        calculated_hash = leaf_hash
+        last_node = tree_size - 1
+        level = 0
+        used = 0
+        nodes = []
+        while last_node > 0:
+            key = (tree_size, root_hash, level, node_index)
+            if key in cache:
+                entry = cache.get(key)
+                if (entry is not None and entry[0] == calculated_hash and
+                    entry[1] == tuple(audit_path[used:])):
+                    break
+            if node_index % 2 or node_index < last_node:
+                if used == len(audit_path):
+                    raise error.ProofError('Proof too short: left with node '
+                                           'index %d' % node_index)
+                audit_hash = audit_path[used]
+                nodes.append((level, node_index, calculated_hash, used,
+                              audit_hash))
+                used += 1
+                if node_index % 2:
+                    calculated_hash = self.hasher.hash_children(
+                        audit_hash, calculated_hash)
+                else:
+                    calculated_hash = self.hasher.hash_children(
+                        calculated_hash, audit_hash)
+            else:
+                nodes.append((level, node_index, calculated_hash, used, None))
+            node_index //= 2
+            last_node //= 2
+            level += 1
+        else:
+            if used != len(audit_path):
+                raise error.ProofError('Proof too long: Left with %d hashes.' %
+                                       (len(audit_path) - used))
+            if calculated_hash != root_hash:
+                return calculated_hash
+        for level, index, node, used, sibling in nodes:
+            key = (tree_size, root_hash, level, index)
+            if key not in cache:
+                cache.put(key, (node, tuple(audit_path[used:])))
+            key = (tree_size, root_hash, level, index ^ 1)
+            if sibling is not None and key not in cache:
+                cache.put(key, (sibling, (node,) + tuple(audit_path[used + 1:])))
+        return root_hash
+
     @classmethod
     def audit_path_length(cls, index, tree_size):
         length = 0
@@ -460,10 +918,10 @@ class MerkleVerifier(object):
         Args:
             leaf_hash: The hash of the leaf for which the proof was provided.
             leaf_index: Index of the leaf in the tree.
-            proof: A list of SHA-256 hashes representing the  Merkle audit path.
+            proof: A list of hashes representing the Merkle audit path.
             sth: STH with the same tree size as the one used to fetch the proof.
-            The sha256_root_hash from this STH will be compared against the
-            root hash produced from the proof.
+            The root hash of this STH (see sth_root_hash()) will be compared
+            against the root hash produced from the proof.
 
         Returns:
             True. The return value is enforced by a decorator and need not be
@@ -483,15 +941,108 @@ class MerkleVerifier(object):
             raise ValueError("Negative tree size or leaf index: "
                                    "Tree size: %d Leaf index: %d" %
                                    (tree_size, leaf_index))
-        calculated_root_hash = self._calculate_root_hash_from_audit_path(
-                leaf_hash, leaf_index, proof[:], tree_size)
-        if calculated_root_hash == sth.sha256_root_hash:
+        self._check_proof_hashes(proof)
+        root_hash = sth_root_hash(sth)
+        if self.__cache is None:
+            calculated_root_hash = self._calculate_root_hash_from_audit_path(
+                    leaf_hash, leaf_index, proof[:], tree_size)
+        else:
+            calculated_root_hash = self._calculate_root_hash_with_cache(
+                    leaf_hash, leaf_index, proof, tree_size, root_hash)
+        if calculated_root_hash == root_hash:
             return True
 
         raise error.ProofError("Constructed root hash differs from provided "
                                "root hash. Constructed: %s Expected: %s" %
                                (calculated_root_hash.encode("base64").strip(),
-                                sth.sha256_root_hash.encode("base64").strip()))
+                                root_hash.encode("base64").strip()))
+
+    @error.returns_true_or_raises
+    def verify_range_hash_inclusion(self, leaf_hashes, start, proof, sth):
+        """Verify that |leaf_hashes| are the leaves at [start, start + len).
+
+        Args:
+            leaf_hashes: The hashes of a contiguous range of leaves.
+            start: Index of the first leaf in the tree.
+            proof: A range proof, see calculate_range_proof().
+            sth: STH with the same tree size as the one used to fetch the
+            proof.
+
+        Returns:
+            True. The return value is enforced by a decorator and need not be
+                checked by the caller.
+
+        Raises:
+            ProofError: the proof is invalid.
+        """
+        start = int(start)
+        end = start + len(leaf_hashes)
+        tree_size = int(sth.tree_size)
+        if not 0 <= start < end <= tree_size:
+            raise ValueError("Bad range [%d, %d) for tree size %d" %
+                             (start, end, tree_size))
+        self._check_proof_hashes(proof)
+        nodes = iter(proof)
+        def node_hash(node_start, node_end):
+            if node_end <= start or end <= node_start:
+                node = next(nodes, None)
+                if node is None:
+                    raise error.ProofError("Range proof too short")
+                return node
+            if node_end - node_start == 1:
+                return leaf_hashes[node_start - start]
+            k = _largest_power_of_two_below(node_end - node_start)
+            return self.hasher.hash_children(
+                    node_hash(node_start, node_start + k),
+                    node_hash(node_start + k, node_end))
+        calculated_root_hash = node_hash(0, tree_size)
+        if next(nodes, None) is not None:
+            raise error.ProofError("Range proof too long")
+        root_hash = sth_root_hash(sth)
+        if calculated_root_hash == root_hash:
+            return True
+
+        raise error.ProofError("Constructed root hash differs from provided "
+                               "root hash. Constructed: %s Expected: %s" %
+                               (calculated_root_hash.encode("base64").strip(),
+                                root_hash.encode("base64").strip()))
+
+    @error.returns_true_or_raises
+    def verify_range_inclusion(self, leaves, start, proof, sth):
+        """Verify that |leaves| are the leaves at [start, start + len).
+
+        See verify_range_hash_inclusion().
+        """
+        return self.verify_range_hash_inclusion(
+                [self.hasher.hash_leaf(leaf) for leaf in leaves], start, proof,
+                sth)
+
+    @error.returns_true_or_raises
+    def verify_leaf_hash_inclusion_upgrade(self, leaf_hash, leaf_index,
+                                           old_size, old_proof, upgrade, sth):
+        """Verify an inclusion proof upgraded to the size of |sth|.
+
+        Args:
+            leaf_hash: The hash of the leaf for which the proofs were provided.
+            leaf_index: Index of the leaf in the tree.
+            old_size: The tree size of |old_proof|.
+            old_proof: An inclusion proof at |old_size|.
+            upgrade: The nodes returned by calculate_inclusion_proof_upgrade()
+            for the size of |sth|. upgrade_inclusion_proof() gives the full
+            proof to keep for the next upgrade.
+            sth: STH the upgraded proof is checked against.
+
+        Returns:
+            True. The return value is enforced by a decorator and need not be
+                checked by the caller.
+
+        Raises:
+            ProofError: the proof is invalid.
+        """
+        proof = upgrade_inclusion_proof(leaf_index, old_size, old_proof,
+                                        int(sth.tree_size), upgrade)
+        return self.verify_leaf_hash_inclusion(leaf_hash, leaf_index, proof,
+                                               sth)
 
     @error.returns_true_or_raises
     def verify_leaf_inclusion(self, leaf, leaf_index, proof, sth):
@@ -502,10 +1053,10 @@ class MerkleVerifier(object):
         Args:
             leaf: The leaf for which the proof was provided.
             leaf_index: Index of the leaf in the tree.
-            proof: A list of SHA-256 hashes representing the  Merkle audit path.
+            proof: A list of hashes representing the Merkle audit path.
             sth: STH with the same tree size as the one used to fetch the proof.
-            The sha256_root_hash from this STH will be compared against the
-            root hash produced from the proof.
+            The root hash of this STH (see sth_root_hash()) will be compared
+            against the root hash produced from the proof.
 
         Returns:
             True. The return value is enforced by a decorator and need not be
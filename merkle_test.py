@@ -92,6 +92,68 @@ class TreeHasherTest(unittest.TestCase):
             expected_hash = TreeHasherTest.test_vector_hashes[i].decode("hex")
             self.assertEqual(hasher.hash_full_tree(test_vector), expected_hash)
 
+    def test_hash_level(self):
+        hasher = merkle.TreeHasher()
+        leaf_hashes = [hasher.hash_leaf(c) for c in "abcde"]
+        h = hasher.hash_children
+        self.assertEqual(hasher.hash_level("".join(leaf_hashes)),
+                         h(leaf_hashes[0], leaf_hashes[1]) +
+                         h(leaf_hashes[2], leaf_hashes[3]) + leaf_hashes[4])
+        self.assertEqual(hasher.hash_level(""), "")
+        self.assertRaises(ValueError, hasher.hash_level, "x" * 33)
+        for n in xrange(1, 18):
+            level = "".join(hasher.hash_leaf(str(i)) for i in xrange(n))
+            while len(level) > 32:
+                level = hasher.hash_level(level)
+            self.assertEqual(level, hasher.hash_full_tree(
+                    [str(i) for i in xrange(n)]))
+
+    def test_hash_level_uses_overridden_hash_children(self):
+        hex_hasher = HexTreeHasher()
+        leaves = [hex_hasher.hash_leaf(c) for c in ["aa", "bb", "cc"]]
+        self.assertEqual(hex_hasher.hash_level("".join(leaves)),
+                         hex_hasher.hash_children(leaves[0], leaves[1]) +
+                         leaves[2])
+        hasher = merkle.TreeHasher()
+        hasher.hash_children = lambda left, right: "x" * 32
+        self.assertEqual(hasher.hash_level("y" * 64), "x" * 32)
+
+    def test_hash_algorithm_by_name(self):
+        hasher = merkle.TreeHasher("sha256")
+        self.assertEqual(hasher.algorithm, "sha256")
+        self.assertEqual(hasher.digest_size, 32)
+        self.assertEqual(hasher.hash_full_tree("abc"),
+                         merkle.TreeHasher().hash_full_tree("abc"))
+        self.assertEqual(merkle.TreeHasher().algorithm, "sha256")
+
+    def test_truncated_hash_algorithm(self):
+        hasher = merkle.TreeHasher("sha256/128")
+        self.assertEqual(hasher.digest_size, 16)
+        self.assertEqual(hasher.hash_empty(),
+                         TreeHasherTest.sha256_empty_hash.decode("hex")[:16])
+        self.assertEqual(hasher.hash_leaf("a"),
+                         merkle.TreeHasher().hash_leaf("a")[:16])
+        for name in ("sha256/128", "sha256/160", "sha512/256"):
+            self.assertEqual(merkle.TreeHasher(
+                    merkle.hash_algorithm(name)).algorithm, name)
+
+    def test_unsupported_hash_algorithms(self):
+        for name in ("md5", "sha256/0", "sha256/12", "sha256/512",
+                     "sha256/x"):
+            self.assertRaises(error.UnsupportedAlgorithmError,
+                              merkle.hash_algorithm, name)
+
+    def test_blake2_hash_algorithm(self):
+        try:
+            hasher = merkle.TreeHasher("blake2b/256")
+        except error.UnsupportedAlgorithmError:
+            self.skipTest("BLAKE2 needs pyblake2")
+        self.assertEqual(hasher.digest_size, 32)
+        self.assertEqual(merkle.TreeHasher(
+                merkle.hash_algorithm("blake2b/256")).algorithm, "blake2b/256")
+        self.assertNotEqual(hasher.hash_leaf("a"),
+                            merkle.TreeHasher().hash_leaf("a"))
+
 
 class HexTreeHasher(merkle.TreeHasher):
     def __init__(self, hashfunc=hashlib.sha256):
@@ -494,6 +556,314 @@ class MerkleVerifierTest(unittest.TestCase):
                   verifier.verify_leaf_inclusion(
                       leaves[j], j, proof, sth))
 
+    def test_verify_with_other_hash_algorithm(self):
+        hasher = merkle.TreeHasher("sha512/128")
+        verifier = merkle.MerkleVerifier(hasher)
+        leaves = ["a", "b", "c"]
+        tree = merkle.CompactMerkleTree(hasher)
+        tree.extend(leaves[:2])
+        old_root = tree.root_hash()
+        tree.extend(leaves[2:])
+        leaf_hashes = [hasher.hash_leaf(l) for l in leaves]
+        TreeHead = namedtuple("TreeHead", ["tree_size", "root_hash"])
+        sth = TreeHead(3, tree.root_hash())
+        proof = [hasher.hash_children(leaf_hashes[0], leaf_hashes[1])]
+        self.assertTrue(verifier.verify_leaf_inclusion("c", 2, proof, sth))
+        self.assertTrue(verifier.verify_tree_consistency(
+                2, 3, old_root, tree.root_hash(), [leaf_hashes[2]]))
+        # A SHA-256 sized proof node is rejected outright.
+        self.assertRaises(error.ProofError, verifier.verify_leaf_inclusion,
+                          "c", 2, [proof[0] + "\x00" * 16], sth)
+
+
+class InclusionProofUpgradeTest(unittest.TestCase):
+    leaves = [str(i) for i in range(20)]
+    hasher = merkle.TreeHasher()
+
+    def subtree_hash(self, start, end):
+        self.reads.append((start, end))
+        return self.hasher.hash_full_tree(self.leaves[start:end])
+
+    def setUp(self):
+        self.reads = []
+
+    def test_upgrade_matches_full_proof(self):
+        verifier = merkle.MerkleVerifier()
+        for new_size in range(1, 21):
+            root = self.hasher.hash_full_tree(self.leaves[:new_size])
+            sth = namedtuple("STH", ["sha256_root_hash", "tree_size"])(
+                    root, new_size)
+            for old_size in range(1, new_size + 1):
+                for index in range(old_size):
+                    old_proof = merkle.calculate_inclusion_proof(
+                            index, old_size, self.subtree_hash)
+                    new_proof = merkle.calculate_inclusion_proof(
+                            index, new_size, self.subtree_hash)
+                    del self.reads[:]
+                    upgrade = merkle.calculate_inclusion_proof_upgrade(
+                            index, old_size, new_size, self.subtree_hash)
+                    self.assertEqual(len(self.reads), len(upgrade))
+                    self.assertTrue(len(upgrade) <= len(new_proof))
+                    self.assertEqual(merkle.upgrade_inclusion_proof(
+                            index, old_size, old_proof, new_size, upgrade),
+                                     new_proof)
+                    self.assertTrue(
+                            verifier.verify_leaf_hash_inclusion_upgrade(
+                                    self.hasher.hash_leaf(self.leaves[index]),
+                                    index, old_size, old_proof, upgrade, sth))
+
+    def test_upgrade_reuses_left_nodes(self):
+        # Leaf 0 at size 16 only gains the subtree [16, 20) at size 20.
+        upgrade = merkle.calculate_inclusion_proof_upgrade(
+                0, 16, 20, self.subtree_hash)
+        self.assertEqual(self.reads, [(16, 20)])
+        self.assertEqual(len(upgrade), 1)
+
+    def test_bad_upgrades(self):
+        old_proof = merkle.calculate_inclusion_proof(3, 8, self.subtree_hash)
+        upgrade = merkle.calculate_inclusion_proof_upgrade(
+                3, 8, 20, self.subtree_hash)
+        self.assertRaises(error.ProofError, merkle.upgrade_inclusion_proof,
+                          3, 8, old_proof[1:], 20, upgrade)
+        self.assertRaises(error.ProofError, merkle.upgrade_inclusion_proof,
+                          3, 8, old_proof, 20, upgrade + upgrade)
+        self.assertRaises(error.ProofError, merkle.upgrade_inclusion_proof,
+                          3, 8, old_proof, 20, [])
+        self.assertRaises(ValueError, merkle.calculate_inclusion_proof_upgrade,
+                          3, 8, 7, self.subtree_hash)
+        sth = namedtuple("STH", ["sha256_root_hash", "tree_size"])(
+                self.hasher.hash_full_tree(self.leaves), 20)
+        verifier = merkle.MerkleVerifier()
+        self.assertRaises(error.ProofError,
+                          verifier.verify_leaf_hash_inclusion_upgrade,
+                          self.hasher.hash_leaf("x"), 3, 8, old_proof, upgrade,
+                          sth)
+
+class BatchInclusionProofsTest(unittest.TestCase):
+    leaves = [str(i) for i in range(40)]
+    hasher = merkle.TreeHasher()
+
+    def subtree_hash(self, start, end):
+        self.reads.append((start, end))
+        return self.hasher.hash_full_tree(self.leaves[start:end])
+
+    def setUp(self):
+        self.reads = []
+
+    def test_batch_proofs_match_single_proofs(self):
+        for old_size in range(0, 20):
+            frontier = merkle.CompactMerkleTree(self.hasher)
+            frontier.extend(self.leaves[:old_size])
+            for new_size in range(old_size + 1, 40, 3):
+                leaf_hashes = [self.hasher.hash_leaf(l) for l in
+                               self.leaves[old_size:new_size]]
+                del self.reads[:]
+                proofs = merkle.calculate_batch_inclusion_proofs(
+                        self.hasher, old_size, frontier.hashes, leaf_hashes,
+                        range(old_size, new_size), self.subtree_hash)
+                self.assertEqual(self.reads, [])
+                self.assertEqual(proofs, [
+                        merkle.calculate_inclusion_proof(
+                                i, new_size, self.subtree_hash)
+                        for i in range(old_size, new_size)])
+
+    def test_batch_proofs_for_old_leaves(self):
+        frontier = merkle.CompactMerkleTree(self.hasher)
+        frontier.extend(self.leaves[:21])
+        leaf_hashes = [self.hasher.hash_leaf(l) for l in self.leaves[21:]]
+        proofs = merkle.calculate_batch_inclusion_proofs(
+                self.hasher, 21, frontier.hashes, leaf_hashes, [3, 20, 30],
+                self.subtree_hash)
+        self.assertEqual(proofs, [
+                merkle.calculate_inclusion_proof(i, 40, self.subtree_hash)
+                for i in (3, 20, 30)])
+
+class RangeProofTest(unittest.TestCase):
+    leaves = [str(i) for i in range(17)]
+    hasher = merkle.TreeHasher()
+
+    def subtree_hash(self, start, end):
+        return self.hasher.hash_full_tree(self.leaves[start:end])
+
+    def test_range_proofs(self):
+        verifier = merkle.MerkleVerifier()
+        STH = namedtuple("STH", ["sha256_root_hash", "tree_size"])
+        for tree_size in range(1, 18):
+            sth = STH(self.hasher.hash_full_tree(self.leaves[:tree_size]),
+                      tree_size)
+            for start in range(tree_size):
+                for end in range(start + 1, tree_size + 1):
+                    proof = merkle.calculate_range_proof(
+                            start, end, tree_size, self.subtree_hash)
+                    self.assertTrue(len(proof) <=
+                                    2 * (tree_size - 1).bit_length())
+                    leaves = self.leaves[start:end]
+                    self.assertTrue(verifier.verify_range_inclusion(
+                            leaves, start, proof, sth))
+                    if tree_size == 1:
+                        continue
+                    if end - start > 1:
+                        self.assertRaises(error.ProofError,
+                                          verifier.verify_range_inclusion,
+                                          leaves[::-1], start, proof, sth)
+                    if proof:
+                        self.assertRaises(error.ProofError,
+                                          verifier.verify_range_inclusion,
+                                          leaves, start, proof[1:], sth)
+                    self.assertRaises(error.ProofError,
+                                      verifier.verify_range_inclusion,
+                                      leaves, start, proof + [proof[0] if
+                                                              proof else
+                                                              "x" * 32], sth)
+
+    def test_single_leaf_range_is_inclusion_proof(self):
+        # The nodes are the same, listed from left to right.
+        for index in range(17):
+            proof = merkle.calculate_range_proof(index, index + 1, 17,
+                                                 self.subtree_hash)
+            self.assertEqual(sorted(proof), sorted(
+                    merkle.calculate_inclusion_proof(index, 17,
+                                                     self.subtree_hash)))
+
+    def test_bad_ranges(self):
+        self.assertRaises(ValueError, merkle.calculate_range_proof, 3, 3, 5,
+                          self.subtree_hash)
+        self.assertRaises(ValueError, merkle.calculate_range_proof, 3, 6, 5,
+                          self.subtree_hash)
+
+class SubtreeHashTest(unittest.TestCase):
+
+    def test_matches_hash_full_tree(self):
+        hasher = merkle.TreeHasher()
+        leaves = [str(i) for i in range(20)]
+        reads = []
+        def perfect_subtree_hash(start, size):
+            self.assertEqual(start % size, 0)
+            reads.append(size)
+            return hasher.hash_full_tree(leaves[start:start + size])
+        for start in range(20):
+            for end in range(start, 21):
+                self.assertEqual(merkle.calculate_subtree_hash(
+                        start, end, hasher, perfect_subtree_hash),
+                                 hasher.hash_full_tree(leaves[start:end]))
+        del reads[:]
+        merkle.calculate_subtree_hash(0, 19, hasher, perfect_subtree_hash)
+        self.assertEqual(reads, [16, 2, 1])
+
+class _CountingHasher(merkle.TreeHasher):
+    """Counts the calls to hash_children()."""
+
+    calls = 0
+
+    def hash_children(self, left, right):
+        self.calls += 1
+        return super(_CountingHasher, self).hash_children(left, right)
+
+
+class VerifierCacheTest(unittest.TestCase):
+    leaves = [str(i) for i in range(17)]
+    hasher = merkle.TreeHasher()
+    STH = namedtuple("STH", ["sha256_root_hash", "tree_size"])
+
+    def subtree_hash(self, start, end):
+        return self.hasher.hash_full_tree(self.leaves[start:end])
+
+    def sth(self, tree_size):
+        return self.STH(self.subtree_hash(0, tree_size), tree_size)
+
+    def test_matches_uncached_verification(self):
+        verifier = merkle.MerkleVerifier(cache_size=1000)
+        for tree_size in range(1, 18):
+            sth = self.sth(tree_size)
+            for _ in range(2):
+                for index in range(tree_size):
+                    proof = merkle.calculate_inclusion_proof(
+                            index, tree_size, self.subtree_hash)
+                    leaf = self.leaves[index]
+                    self.assertTrue(verifier.verify_leaf_inclusion(
+                            leaf, index, proof, sth))
+                    self.assertRaises(error.ProofError,
+                                      verifier.verify_leaf_inclusion,
+                                      leaf, index, proof + ["x" * 32], sth)
+                    if tree_size == 1:
+                        continue
+                    self.assertRaises(error.ProofError,
+                                      verifier.verify_leaf_inclusion,
+                                      leaf, index, proof[:-1], sth)
+                    self.assertRaises(error.ProofError,
+                                      verifier.verify_leaf_inclusion,
+                                      "bad", index, proof, sth)
+        self.assertTrue(verifier.cache.hits)
+
+    def test_stops_at_proven_nodes(self):
+        hasher = _CountingHasher()
+        verifier = merkle.MerkleVerifier(hasher, cache_size=100)
+        sth = self.sth(16)
+        proof = merkle.calculate_inclusion_proof(0, 16, self.subtree_hash)
+        verifier.verify_leaf_inclusion("0", 0, proof, sth)
+        self.assertEqual(hasher.calls, 4)
+        # Leaf 1 was proven as the sibling of leaf 0.
+        proof = merkle.calculate_inclusion_proof(1, 16, self.subtree_hash)
+        verifier.verify_leaf_inclusion("1", 1, proof, sth)
+        self.assertEqual(hasher.calls, 4)
+        proof = merkle.calculate_inclusion_proof(4, 16, self.subtree_hash)
+        verifier.verify_leaf_inclusion("4", 4, proof, sth)
+        self.assertEqual(hasher.calls, 6)
+        # Nodes are only proven under the root they were checked against.
+        other = self.STH("x" * 32, 16)
+        self.assertRaises(error.ProofError, verifier.verify_leaf_inclusion,
+                          "4", 4, proof, other)
+        self.assertEqual(hasher.calls, 10)
+
+    def test_warm_cache_needs_no_hashing(self):
+        hasher = _CountingHasher()
+        verifier = merkle.MerkleVerifier(hasher, cache_size=1000)
+        sth = self.sth(17)
+        proofs = [merkle.calculate_inclusion_proof(i, 17, self.subtree_hash)
+                  for i in range(17)]
+        for i, proof in enumerate(proofs):
+            verifier.verify_leaf_inclusion(self.leaves[i], i, proof, sth)
+        calls = hasher.calls
+        for i, proof in enumerate(proofs):
+            verifier.verify_leaf_inclusion(self.leaves[i], i, proof, sth)
+        # Only the leaves themselves are hashed again.
+        self.assertEqual(hasher.calls, calls)
+
+    def test_rejects_bad_upper_path_against_warm_cache(self):
+        verifier = merkle.MerkleVerifier(cache_size=100)
+        sth = self.sth(16)
+        proof = merkle.calculate_inclusion_proof(0, 16, self.subtree_hash)
+        verifier.verify_leaf_inclusion("0", 0, proof, sth)
+        proof = merkle.calculate_inclusion_proof(1, 16, self.subtree_hash)
+        for bad in range(1, 4):
+            bad_proof = proof[:bad] + ["z" * 32] * (4 - bad)
+            self.assertRaises(error.ProofError,
+                              verifier.verify_leaf_inclusion,
+                              "1", 1, bad_proof, sth)
+            self.assertRaises(error.ProofError,
+                              merkle.MerkleVerifier().verify_leaf_inclusion,
+                              "1", 1, bad_proof, sth)
+        self.assertTrue(verifier.verify_leaf_inclusion("1", 1, proof, sth))
+
+    def test_skips_verified_consistency(self):
+        hasher = _CountingHasher()
+        verifier = merkle.MerkleVerifier(hasher, cache_size=100)
+        old, new = self.sth(5), self.sth(17)
+        proof = merkle.calculate_consistency_proof(5, 17, self.subtree_hash)
+        verifier.verify_tree_consistency(5, 17, old.sha256_root_hash,
+                                         new.sha256_root_hash, proof)
+        calls = hasher.calls
+        self.assertTrue(calls)
+        verifier.verify_tree_consistency(5, 17, old.sha256_root_hash,
+                                         new.sha256_root_hash, proof)
+        self.assertEqual(hasher.calls, calls)
+        # A verified pair with another proof is checked again.
+        self.assertRaises(error.ProofError, verifier.verify_tree_consistency,
+                          5, 17, old.sha256_root_hash, new.sha256_root_hash,
+                          proof[:-1] + ["z" * 32])
+        self.assertRaises(error.ConsistencyError,
+                          verifier.verify_tree_consistency, 5, 17, "x" * 32,
+                          new.sha256_root_hash, proof)
 
 if __name__ == "__main__":
     unittest.main()
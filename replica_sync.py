@@ -0,0 +1,203 @@
+"""Incremental sync of a replica LeveldbMerkleTree from a primary log.
+
+A replica at tree size m catches up with a tree head of the primary at size n
+with a single consistency proof from m to n, verified against the replica's
+own root with MerkleVerifier.verify_tree_consistency(). The new nodes of that
+proof are the hashes of the subtrees covering [m, n). Each subtree larger than
+a chunk is split in two, and the hashes of the halves, fetched from the
+primary, are checked against it; each subtree of at most a chunk has its leaf
+hashes fetched and checked against its hash before they are written. Each
+committed chunk is therefore a verified prefix of the head, and the replica
+never holds more than one chunk in memory.
+
+The primary is anything with the methods of LocalPrimary; a network client
+would implement the same interface. When a sync fails because the replica
+diverged, find_divergence() locates the first bad leaf.
+"""
+
+import logging
+import threading
+
+import divergence
+import error
+import leveldb_merkle_tree
+import merkle
+
+
+class LocalPrimary(object):
+    """In-process stand-in for a primary serving a LeveldbMerkleTree."""
+
+    def __init__(self, tree):
+        self.__tree = tree
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.__tree)
+
+    @property
+    def hash_algorithm(self):
+        return self.__tree.hash_algorithm
+
+    def get_tree_head(self):
+        """Returns the latest published TreeHead, or None."""
+        return self.__tree.get_latest_tree_head()
+
+    def get_leaf_hashes(self, start, stop):
+        """Returns the leaf hashes in [start, stop)."""
+        return self.__tree.get_leaves(start, stop)
+
+    def get_consistency_proof(self, tree_size_1, tree_size_2):
+        return self.__tree.get_consistency_proof(tree_size_1, tree_size_2)
+
+    def get_subtree_hash(self, start, end):
+        return self.__tree.get_subtree_hash(start, end)
+
+
+class ReplicaSync(object):
+    """Keeps a replica LeveldbMerkleTree in sync with a primary."""
+
+    def __init__(self, replica, primary, chunk_size=4096):
+        if replica.hash_algorithm != primary.hash_algorithm:
+            raise ValueError("Replica uses hash algorithm %s, primary %s" %
+                             (replica.hash_algorithm, primary.hash_algorithm))
+        self.__replica = replica
+        self.__primary = primary
+        self.__chunk_size = chunk_size
+        self.__verifier = merkle.MerkleVerifier(replica.hasher)
+        self.__hasher = leveldb_merkle_tree.IncrementalTreeHasher(
+                replica.hash_algorithm)
+        self.__lock = threading.Lock()
+        self.__stop = threading.Event()
+        self.__thread = None
+
+    def __repr__(self):
+        return "%s(%r, %r)" % (self.__class__.__name__, self.__replica,
+                               self.__primary)
+
+    def sync(self, head=None):
+        """Brings the replica up to |head|, or the primary's latest head.
+
+        Returns:
+            The replica's tree size afterwards.
+
+        Raises:
+            ConsistencyError: the replica has diverged from the primary.
+            ProofError: the primary sent leaves or proofs that do not match
+                its tree head. Chunks verified before the failure stay
+                committed.
+        """
+        with self.__lock:
+            if head is None:
+                head = self.__primary.get_tree_head()
+            tree_size = self.__replica.tree_size
+            if head is None:
+                return tree_size
+            if head.tree_size <= tree_size:
+                if (self.__replica.get_root_hash(head.tree_size) !=
+                    head.root_hash):
+                    raise error.ConsistencyError(
+                        "Replica root differs from the primary's at size %d" %
+                        head.tree_size)
+                return tree_size
+            for start, end, subtree_hash in self.__new_subtrees(tree_size,
+                                                                head):
+                self.__sync_subtree(start, end, subtree_hash)
+                logging.debug("Replica synced to %d of %d", end,
+                              head.tree_size)
+            return self.__replica.tree_size
+
+    def __new_subtrees(self, tree_size, head):
+        """Returns (start, end, hash) for the subtrees covering the new leaves.
+
+        The hashes come from the consistency proof from |tree_size| to the
+        head, verified against the replica's root.
+        """
+        if tree_size == 0:
+            return [(0, head.tree_size, head.root_hash)]
+        proof = self.__primary.get_consistency_proof(tree_size,
+                                                     head.tree_size)
+        root_hash = self.__replica.get_root_hash()
+        try:
+            self.__verifier.verify_tree_consistency(
+                    tree_size, head.tree_size, root_hash, head.root_hash,
+                    proof)
+        except error.ProofError:
+            # When the replica's tree is balanced, its root is a node of the
+            # proof, so a diverged replica looks like a bad proof.
+            if self.__primary.get_subtree_hash(0, tree_size) != root_hash:
+                raise error.ConsistencyError(
+                    "Replica root differs from the primary's at size %d" %
+                    tree_size)
+            raise
+        # The ranges of the proof's nodes, in the order the proof lists them.
+        ranges = merkle.calculate_consistency_proof(
+                tree_size, head.tree_size, lambda start, end: (start, end))
+        return sorted((start, end, node)
+                      for (start, end), node in zip(ranges, proof)
+                      if start >= tree_size)
+
+    def __sync_subtree(self, start, end, subtree_hash):
+        """Fetches and writes the leaves of a subtree with a verified hash."""
+        if end - start > self.__chunk_size:
+            mid = start + (1 << ((end - start - 1).bit_length() - 1))
+            left = self.__primary.get_subtree_hash(start, mid)
+            right = self.__primary.get_subtree_hash(mid, end)
+            if self.__hasher.hash_children(left, right) != subtree_hash:
+                raise error.ProofError(
+                    "Primary sent bad subtree hashes for [%d, %d)" %
+                    (start, end))
+            self.__sync_subtree(start, mid, left)
+            self.__sync_subtree(mid, end, right)
+            return
+        leaf_hashes = self.__primary.get_leaf_hashes(start, end)
+        if len(leaf_hashes) != end - start:
+            raise error.ProofError("Primary sent %d leaves for [%d, %d)" %
+                                   (len(leaf_hashes), start, end))
+        if self.__hasher.hash_full_tree(leaf_hashes) != subtree_hash:
+            raise error.ProofError("Primary sent bad leaves in [%d, %d)" %
+                                   (start, end))
+        self.__replica.extend_hashes(leaf_hashes)
+
+    def find_divergence(self, head=None):
+        """Returns the first replica leaf that differs from the primary's.
+
+        The replica is compared with the primary's tree up to |head|, by
+        default the primary's latest head, in O(log n) subtree hash
+        comparisons (see divergence.find_divergence()).
+
+        Returns:
+            The index of the first differing leaf, or None if the replica is
+            a prefix of the primary's tree at |head| or extends it.
+        """
+        if head is None:
+            head = self.__primary.get_tree_head()
+        if head is None:
+            return None
+        return divergence.find_divergence(
+                self.__replica, self.__primary,
+                min(self.__replica.tree_size, head.tree_size))
+
+    def start(self, poll_interval=1.0):
+        """Calls sync() periodically from a background thread."""
+        if self.__thread is not None:
+            raise RuntimeError("Sync already started")
+        self.__stop.clear()
+        self.__thread = threading.Thread(target=self.__run,
+                                         args=(poll_interval,),
+                                         name="replica-sync")
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def __run(self, poll_interval):
+        while not self.__stop.wait(poll_interval):
+            try:
+                self.sync()
+            except Exception:
+                logging.exception("Failed to sync replica")
+
+    def stop(self):
+        """Stops the background thread started by start()."""
+        if self.__thread is None:
+            return
+        self.__stop.set()
+        self.__thread.join()
+        self.__thread = None
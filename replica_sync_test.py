@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+"""Tests for replica_sync."""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import error
+import leveldb_merkle_tree
+import replica_sync
+
+
+class _TamperingPrimary(replica_sync.LocalPrimary):
+    """Sends a wrong hash for one leaf."""
+
+    def __init__(self, tree, bad_index):
+        super(_TamperingPrimary, self).__init__(tree)
+        self.bad_index = bad_index
+
+    def get_leaf_hashes(self, start, stop):
+        hashes = super(_TamperingPrimary, self).get_leaf_hashes(start, stop)
+        if start <= self.bad_index < stop:
+            hashes[self.bad_index - start] = "x" * 32
+        return hashes
+
+
+class _CountingPrimary(replica_sync.LocalPrimary):
+    """Counts the consistency proofs requested."""
+
+    def __init__(self, tree):
+        super(_CountingPrimary, self).__init__(tree)
+        self.consistency_proofs = 0
+
+    def get_consistency_proof(self, tree_size_1, tree_size_2):
+        self.consistency_proofs += 1
+        return super(_CountingPrimary, self).get_consistency_proof(
+                tree_size_1, tree_size_2)
+
+
+class ReplicaSyncTest(unittest.TestCase):
+    """Tests for ReplicaSync."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.primary_tree = leveldb_merkle_tree.LeveldbMerkleTree(
+                db=os.path.join(self.dir, "primary"))
+        self.replica = leveldb_merkle_tree.LeveldbMerkleTree(
+                db=os.path.join(self.dir, "replica"))
+
+    def tearDown(self):
+        self.primary_tree.close()
+        self.replica.close()
+        shutil.rmtree(self.dir)
+
+    def test_sync_in_chunks(self):
+        primary = replica_sync.LocalPrimary(self.primary_tree)
+        sync = replica_sync.ReplicaSync(self.replica, primary, chunk_size=7)
+        self.assertEqual(sync.sync(), 0)
+        self.primary_tree.extend([str(i) for i in range(30)])
+        self.primary_tree.publish_tree_head(timestamp=1)
+        self.assertEqual(sync.sync(), 30)
+        self.assertEqual(self.replica.get_root_hash(),
+                         self.primary_tree.get_root_hash())
+        self.primary_tree.extend([str(i) for i in range(30, 45)])
+        head = self.primary_tree.publish_tree_head(timestamp=2)
+        self.primary_tree.add_leaf("unpublished")
+        self.assertEqual(sync.sync(), 45)
+        self.assertEqual(self.replica.get_root_hash(), head.root_hash)
+        self.assertEqual(sync.sync(), 45)
+
+    def test_bad_leaves_are_not_committed(self):
+        self.primary_tree.extend([str(i) for i in range(20)])
+        self.primary_tree.publish_tree_head(timestamp=1)
+        primary = _TamperingPrimary(self.primary_tree, 12)
+        sync = replica_sync.ReplicaSync(self.replica, primary, chunk_size=5)
+        self.assertRaises(error.VerifyError, sync.sync)
+        # [0, 20) is checked as [0, 4), [4, 8), [8, 12), [12, 16), [16, 20).
+        self.assertEqual(self.replica.tree_size, 12)
+        self.assertEqual(self.replica.get_root_hash(),
+                         self.primary_tree.get_root_hash(12))
+        primary.bad_index = -1
+        self.assertEqual(sync.sync(), 20)
+
+    def test_one_consistency_proof_per_sync(self):
+        primary = _CountingPrimary(self.primary_tree)
+        sync = replica_sync.ReplicaSync(self.replica, primary, chunk_size=4)
+        self.primary_tree.extend([str(i) for i in range(5)])
+        self.primary_tree.publish_tree_head(timestamp=1)
+        self.assertEqual(sync.sync(), 5)
+        self.assertEqual(primary.consistency_proofs, 0)
+        self.primary_tree.extend([str(i) for i in range(5, 61)])
+        head = self.primary_tree.publish_tree_head(timestamp=2)
+        self.assertEqual(sync.sync(), 61)
+        self.assertEqual(primary.consistency_proofs, 1)
+        self.assertEqual(self.replica.get_root_hash(), head.root_hash)
+
+    def test_bad_subtree_hashes(self):
+        self.primary_tree.extend([str(i) for i in range(20)])
+        self.primary_tree.publish_tree_head(timestamp=1)
+        primary = replica_sync.LocalPrimary(self.primary_tree)
+        primary.get_subtree_hash = lambda start, end: "x" * 32
+        sync = replica_sync.ReplicaSync(self.replica, primary, chunk_size=5)
+        self.assertRaises(error.ProofError, sync.sync)
+        self.assertEqual(self.replica.tree_size, 0)
+
+    def test_replica_ahead_of_head(self):
+        self.replica.extend(["a", "b", "c"])
+        self.primary_tree.extend(["a", "b"])
+        head = self.primary_tree.publish_tree_head(timestamp=1)
+        sync = replica_sync.ReplicaSync(
+                self.replica, replica_sync.LocalPrimary(self.primary_tree))
+        self.assertEqual(sync.sync(), 3)
+        self.assertRaises(error.ConsistencyError, sync.sync,
+                          head._replace(sha256_root_hash="x" * 32))
+
+    def test_diverged_replica(self):
+        self.replica.extend(["a", "b"])
+        self.primary_tree.extend(["a", "c", "d"])
+        self.primary_tree.publish_tree_head(timestamp=1)
+        sync = replica_sync.ReplicaSync(
+                self.replica, replica_sync.LocalPrimary(self.primary_tree))
+        self.assertRaises(error.ConsistencyError, sync.sync)
+        self.assertEqual(self.replica.tree_size, 2)
+        self.assertEqual(sync.find_divergence(), 1)
+        self.replica.add_leaf("e")
+        self.assertRaises(error.ConsistencyError, sync.sync)
+
+    def test_background_sync(self):
+        primary = replica_sync.LocalPrimary(self.primary_tree)
+        sync = replica_sync.ReplicaSync(self.replica, primary)
+        sync.start(poll_interval=0.01)
+        self.primary_tree.extend(["a", "b", "c"])
+        self.primary_tree.publish_tree_head(timestamp=1)
+        for _ in range(500):
+            if self.replica.tree_size == 3:
+                break
+            time.sleep(0.01)
+        sync.stop()
+        self.assertEqual(self.replica.tree_size, 3)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,351 @@
+"""A log sharded across several LeveldbMerkleTrees.
+
+Entries are partitioned across N shard trees, each in its own database and
+served by its own process, so that hashing and writes proceed in parallel.
+freeze() publishes a tree head on every shard that has grown and appends
+those shard heads, as leaves, to a top-level tree, whose compact frontier
+gives a single root for the whole log. An entry is proven by its inclusion in
+a frozen shard head plus that head's inclusion in the top-level tree, which
+ShardedMerkleVerifier checks.
+
+>>> log = sharded_log.ShardedLog("./sharded_db", num_shards=4)
+>>> locations = log.extend(entries)          # [(shard, leaf_index), ...]
+>>> head = log.freeze()
+>>> proof = log.get_inclusion_proof(*locations[0])
+>>> sharded_log.ShardedMerkleVerifier().verify_sharded_inclusion(
+...     entries[0], proof, head)
+"""
+
+from collections import namedtuple
+import multiprocessing
+import os
+import struct
+import sys
+import threading
+import zlib
+
+import plyvel
+
+import error
+import leveldb_merkle_tree
+import merkle
+import tree_head
+
+
+class ShardHead(namedtuple("ShardHead", ["shard", "tree_size", "timestamp",
+                                         "root_hash"])):
+    """A tree head published by one shard and frozen into the top tree."""
+    __slots__ = ()
+
+
+_SHARD_FORMAT = ">I"
+_SHARD_SIZE = struct.calcsize(_SHARD_FORMAT)
+
+
+def encode_shard_head(head):
+    """Serialise a ShardHead into the top-level tree leaf for it."""
+    return struct.pack(_SHARD_FORMAT, head.shard) + tree_head.encode_tree_head(
+            tree_head.TreeHead(head.tree_size, head.timestamp, head.root_hash))
+
+
+def decode_shard_head(data):
+    """Parse a top-level tree leaf produced by encode_shard_head()."""
+    shard, = struct.unpack(_SHARD_FORMAT, data[:_SHARD_SIZE])
+    head = tree_head.decode_tree_head(data[_SHARD_SIZE:])
+    return ShardHead(shard, head.tree_size, head.timestamp, head.root_hash)
+
+
+ShardedProof = namedtuple("ShardedProof", ["shard_head", "leaf_index",
+                                           "shard_proof", "top_leaf_index",
+                                           "top_proof"])
+
+
+class ShardedMerkleVerifier(merkle.MerkleVerifier):
+    """A MerkleVerifier that also checks proofs from a ShardedLog."""
+
+    @error.returns_true_or_raises
+    def verify_sharded_leaf_hash_inclusion(self, leaf_hash, proof, sth):
+        """Verify a ShardedProof for |leaf_hash| against a top-level STH.
+
+        Returns:
+            True. The return value is enforced by a decorator and need not be
+                checked by the caller.
+
+        Raises:
+            ProofError: the proof is invalid.
+        """
+        self.verify_leaf_hash_inclusion(leaf_hash, proof.leaf_index,
+                                        proof.shard_proof, proof.shard_head)
+        top_leaf_hash = self.hasher.hash_leaf(
+                encode_shard_head(proof.shard_head))
+        return self.verify_leaf_hash_inclusion(
+                top_leaf_hash, proof.top_leaf_index, proof.top_proof, sth)
+
+    @error.returns_true_or_raises
+    def verify_sharded_inclusion(self, leaf, proof, sth):
+        """Verify a ShardedProof for |leaf| against a top-level STH."""
+        return self.verify_sharded_leaf_hash_inclusion(
+                self.hasher.hash_leaf(leaf), proof, sth)
+
+
+def hash_partitioner(num_shards):
+    """Returns a partitioner spreading leaves over shards by a CRC32."""
+    def partition(leaf):
+        return (zlib.crc32(leaf) & 0xffffffff) % num_shards
+    return partition
+
+
+# Methods of LeveldbMerkleTree a shard process serves.
+_SHARD_METHODS = frozenset([
+        "extend", "get_leaf", "get_root_hash", "get_inclusion_proof",
+        "get_consistency_proof", "get_latest_tree_head", "publish_tree_head"])
+
+
+def _serve_shard(conn, db, hash_algorithm):
+    tree = leveldb_merkle_tree.LeveldbMerkleTree(
+            db=db, hash_algorithm=hash_algorithm)
+    try:
+        while True:
+            try:
+                method, args = conn.recv()
+            except EOFError:
+                return
+            if method is None:
+                return
+            try:
+                if method == "tree_size":
+                    result = tree.tree_size
+                elif method in _SHARD_METHODS:
+                    result = getattr(tree, method)(*args)
+                else:
+                    raise ValueError("Unknown shard method %s" % method)
+            except Exception:
+                conn.send((False, sys.exc_info()[1]))
+            else:
+                conn.send((True, result))
+    finally:
+        tree.close()
+
+
+class _Shard(object):
+    """Runs a LeveldbMerkleTree in a child process."""
+
+    def __init__(self, db, hash_algorithm):
+        self.__conn, child_conn = multiprocessing.Pipe()
+        self.__process = multiprocessing.Process(
+                target=_serve_shard, args=(child_conn, db, hash_algorithm))
+        self.__process.daemon = True
+        self.__process.start()
+        child_conn.close()
+        self.__lock = threading.Lock()
+
+    def send(self, method, *args):
+        """Starts a call; every send() must be followed by a receive()."""
+        self.__lock.acquire()
+        try:
+            self.__conn.send((method, args))
+        except:
+            self.__lock.release()
+            raise
+
+    def receive(self):
+        try:
+            ok, result = self.__conn.recv()
+        finally:
+            self.__lock.release()
+        if not ok:
+            raise result
+        return result
+
+    def call(self, method, *args):
+        self.send(method, *args)
+        return self.receive()
+
+    def close(self):
+        with self.__lock:
+            self.__conn.send((None, ()))
+            self.__process.join()
+            self.__conn.close()
+
+
+def _receive_all(shards):
+    """Receives a result from each shard, then raises the first failure."""
+    results = []
+    exc_info = None
+    for shard in shards:
+        try:
+            results.append(shard.receive())
+        except Exception:
+            exc_info = exc_info or sys.exc_info()
+            results.append(None)
+    if exc_info is not None:
+        raise exc_info[0], exc_info[1], exc_info[2]
+    return results
+
+
+class ShardedLog(object):
+    """A log of entries partitioned over |num_shards| shard trees.
+
+    |partitioner(leaf)| picks the shard of each leaf and defaults to
+    hash_partitioner(num_shards); a partitioner keyed on the entry's
+    timestamp gives time-windowed shards. The number of shards is fixed when
+    the log is created.
+    """
+
+    def __init__(self, directory, num_shards, partitioner=None,
+                 hash_algorithm=None):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # Start the shard processes before this process opens any database.
+        self.__shards = [
+                _Shard(os.path.join(directory, "shard-%d" % i), hash_algorithm)
+                for i in range(num_shards)]
+        self.__partitioner = partitioner or hash_partitioner(num_shards)
+        self.__top = leveldb_merkle_tree.LeveldbMerkleTree(
+                db=os.path.join(directory, "top"),
+                hash_algorithm=hash_algorithm)
+        # Maps (shard, shard tree size) to the index of the top-level leaf
+        # freezing that shard head, followed by the leaf itself (the top tree
+        # only keeps leaf hashes).
+        self.__frozen = plyvel.DB(os.path.join(directory, "frozen"),
+                                  create_if_missing=True)
+        self.__lock = threading.Lock()
+
+    def close(self):
+        for shard in self.__shards:
+            shard.close()
+        self.__top.close()
+        self.__frozen.close()
+
+    @property
+    def num_shards(self):
+        return len(self.__shards)
+
+    @property
+    def top_tree(self):
+        """The LeveldbMerkleTree of frozen shard heads."""
+        return self.__top
+
+    def extend(self, new_leaves):
+        """Appends |new_leaves|, hashing and writing on all shards at once.
+
+        Returns:
+            A list of (shard, leaf_index) pairs, one per leaf.
+        """
+        batches = [[] for _ in self.__shards]
+        placement = []
+        for leaf in new_leaves:
+            shard = self.__partitioner(leaf)
+            placement.append((shard, len(batches[shard])))
+            batches[shard].append(leaf)
+        with self.__lock:
+            busy = [i for i, batch in enumerate(batches) if batch]
+            shards = [self.__shards[i] for i in busy]
+            for shard in shards:
+                shard.send("tree_size")
+            starts = dict(zip(busy, _receive_all(shards)))
+            for i, shard in zip(busy, shards):
+                shard.send("extend", batches[i])
+            _receive_all(shards)
+        return [(shard, starts[shard] + offset)
+                for shard, offset in placement]
+
+    def add_leaf(self, leaf):
+        return self.extend([leaf])[0]
+
+    def get_leaf(self, shard, leaf_index):
+        """Returns the leaf hash at |leaf_index| in |shard|."""
+        return self.__shards[shard].call("get_leaf", leaf_index)
+
+    def shard_tree_size(self, shard):
+        return self.__shards[shard].call("tree_size")
+
+    def __last_frozen(self, shard, top_size):
+        """Returns the last size of |shard| frozen into the top tree, and the
+        keys of records left behind by freezes that did not reach it."""
+        stale = []
+        it = self.__frozen.iterator(prefix=struct.pack(_SHARD_FORMAT, shard),
+                                    reverse=True)
+        try:
+            for key, value in it:
+                if leveldb_merkle_tree.decode_int(value[:4]) < top_size:
+                    return leveldb_merkle_tree.decode_int(
+                            key[_SHARD_SIZE:]), stale
+                stale.append(key)
+        finally:
+            it.close()
+        return 0, stale
+
+    def freeze(self, timestamp=None):
+        """Freezes the shards' current roots into a new top-level head.
+
+        Returns:
+            The top-level TreeHead, which covers every entry added before the
+            call.
+        """
+        if timestamp is None:
+            timestamp = tree_head.current_timestamp()
+        with self.__lock:
+            for shard in self.__shards:
+                shard.send("publish_tree_head", timestamp)
+            heads = _receive_all(self.__shards)
+            top_size = self.__top.tree_size
+            frozen = []
+            stale = []
+            for i, head in enumerate(heads):
+                last_size, stale_keys = self.__last_frozen(i, top_size)
+                stale.extend(stale_keys)
+                if head.tree_size > last_size:
+                    frozen.append(ShardHead(i, head.tree_size, head.timestamp,
+                                            head.root_hash))
+            leaves = [encode_shard_head(h) for h in frozen]
+            # Record where each head goes first, so that a crash between the
+            # two writes leaves only records that the next freeze discards.
+            with self.__frozen.write_batch() as wb:
+                for key in stale:
+                    wb.delete(key)
+                for offset, (head, leaf) in enumerate(zip(frozen, leaves)):
+                    wb.put(struct.pack(_SHARD_FORMAT, head.shard) +
+                           leveldb_merkle_tree.encode_int(head.tree_size),
+                           leveldb_merkle_tree.encode_int(top_size + offset) +
+                           leaf)
+            self.__top.extend(leaves)
+            return self.__top.publish_tree_head(timestamp)
+
+    def get_tree_head(self):
+        """Returns the latest top-level TreeHead, or None."""
+        return self.__top.get_latest_tree_head()
+
+    def get_inclusion_proof(self, shard, leaf_index, top_tree_size=None):
+        """Returns a ShardedProof for an entry against a top-level head.
+
+        The proof goes through the first frozen head of |shard| that covers
+        the entry. |top_tree_size| defaults to that of the latest head.
+
+        Raises:
+            ValueError: the entry is not covered by the top-level head.
+        """
+        if top_tree_size is None:
+            head = self.get_tree_head()
+            top_tree_size = head.tree_size if head else 0
+        prefix = struct.pack(_SHARD_FORMAT, shard)
+        it = self.__frozen.iterator(
+                start=prefix + leveldb_merkle_tree.encode_int(leaf_index + 1),
+                stop=struct.pack(_SHARD_FORMAT, shard + 1))
+        try:
+            record = next(it, None)
+        finally:
+            it.close()
+        if record is not None:
+            top_leaf_index = leveldb_merkle_tree.decode_int(record[1][:4])
+        if record is None or top_leaf_index >= top_tree_size:
+            raise ValueError("Entry %d of shard %d is not frozen into a "
+                             "top-level tree of size %d" %
+                             (leaf_index, shard, top_tree_size))
+        shard_head = decode_shard_head(record[1][4:])
+        return ShardedProof(
+                shard_head, leaf_index,
+                self.__shards[shard].call("get_inclusion_proof", leaf_index,
+                                          shard_head.tree_size),
+                top_leaf_index,
+                self.__top.get_inclusion_proof(top_leaf_index, top_tree_size))
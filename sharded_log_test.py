@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+"""Tests for ShardedLog."""
+
+import shutil
+import tempfile
+import unittest
+
+import error
+import merkle
+import sharded_log
+
+
+class ShardHeadTest(unittest.TestCase):
+    """Tests for the shard head encoding."""
+
+    def test_encode_decode(self):
+        head = sharded_log.ShardHead(3, 10, 1234, "r" * 32)
+        self.assertEqual(sharded_log.decode_shard_head(
+                sharded_log.encode_shard_head(head)), head)
+
+
+class ShardedLogTest(unittest.TestCase):
+    """Tests for ShardedLog."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.log = sharded_log.ShardedLog(self.dir, num_shards=3)
+
+    def tearDown(self):
+        self.log.close()
+        shutil.rmtree(self.dir)
+
+    def test_extend_partitions_leaves(self):
+        leaves = [str(i) for i in range(30)]
+        locations = self.log.extend(leaves)
+        partition = sharded_log.hash_partitioner(3)
+        hasher = merkle.TreeHasher()
+        for leaf, (shard, index) in zip(leaves, locations):
+            self.assertEqual(shard, partition(leaf))
+            self.assertEqual(self.log.get_leaf(shard, index),
+                             hasher.hash_leaf(leaf))
+        self.assertEqual(sum(self.log.shard_tree_size(i) for i in range(3)),
+                         30)
+        self.assertEqual(self.log.add_leaf("30")[1],
+                         self.log.shard_tree_size(partition("30")) - 1)
+
+    def test_freeze_and_prove(self):
+        verifier = sharded_log.ShardedMerkleVerifier()
+        leaves = [str(i) for i in range(20)]
+        locations = self.log.extend(leaves[:10])
+        self.assertRaises(ValueError, self.log.get_inclusion_proof,
+                          *locations[0])
+        first = self.log.freeze(timestamp=1)
+        self.assertEqual(first.tree_size, 3)
+        locations += self.log.extend(leaves[10:])
+        second = self.log.freeze(timestamp=2)
+        self.assertEqual(second.tree_size, 6)
+        # Freezing with no new entries publishes no new shard heads.
+        self.assertEqual(self.log.freeze(timestamp=3), second)
+
+        for i, (leaf, location) in enumerate(zip(leaves, locations)):
+            proof = self.log.get_inclusion_proof(*location)
+            self.assertTrue(verifier.verify_sharded_inclusion(
+                    leaf, proof, second))
+            self.assertRaises(error.ProofError,
+                              verifier.verify_sharded_inclusion,
+                              leaf + "x", proof, second)
+            if i < 10:
+                # Entries frozen in the first head are proven through the
+                # shard heads it froze, against either top-level head.
+                self.assertTrue(proof.top_leaf_index < 3)
+                proof = self.log.get_inclusion_proof(*location,
+                                                     top_tree_size=3)
+                verifier.verify_sharded_inclusion(leaf, proof, first)
+        consistency = self.log.top_tree.get_consistency_proof(3, 6)
+        verifier.verify_tree_consistency(3, 6, first.root_hash,
+                                         second.root_hash, consistency)
+
+    def test_reopen(self):
+        locations = self.log.extend(["a", "b", "c"])
+        head = self.log.freeze(timestamp=1)
+        self.log.close()
+        self.log = sharded_log.ShardedLog(self.dir, num_shards=3)
+        self.assertEqual(self.log.get_tree_head(), head)
+        proof = self.log.get_inclusion_proof(*locations[1])
+        sharded_log.ShardedMerkleVerifier().verify_sharded_inclusion(
+                "b", proof, head)
+        self.assertEqual(self.log.freeze(timestamp=2), head)
+
+if __name__ == "__main__":
+    unittest.main()
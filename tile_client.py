@@ -0,0 +1,276 @@
+"""A client that builds and verifies proofs from exported tiles.
+
+TileClient reads the checkpoint and tiles written by tile_export from a tile
+source, computes inclusion and consistency proofs itself and verifies them
+against the checkpoint, so clients needing many proofs put no load on the
+log. Tiles are kept in an LRU cache keyed by (level, index, width); a full
+tile also serves any narrower view of itself.
+
+A tile source is anything with a fetch(path) method returning the contents of
+a file of the export, such as DirectoryTileSource or HttpTileSource.
+
+>>> client = tile_client.TileClient(tile_client.HttpTileSource(url))
+>>> head = client.update_checkpoint()
+>>> client.verify_inclusion(leaf, leaf_index)
+"""
+
+import os
+import urllib2
+
+import error
+import leveldb_merkle_tree
+import lru_cache
+import merkle
+import tile_export
+
+
+class DirectoryTileSource(object):
+    """Reads an export from a local directory."""
+
+    def __init__(self, directory):
+        self.__directory = directory
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.__directory)
+
+    def fetch(self, path):
+        with open(os.path.join(self.__directory, path), "rb") as f:
+            return f.read()
+
+
+class HttpTileSource(object):
+    """Reads an export served over HTTP below |base_url|."""
+
+    def __init__(self, base_url, timeout=30):
+        self.__base_url = base_url.rstrip("/")
+        self.__timeout = timeout
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.__base_url)
+
+    def fetch(self, path):
+        response = urllib2.urlopen(self.__base_url + "/" + path,
+                                   timeout=self.__timeout)
+        try:
+            return response.read()
+        finally:
+            response.close()
+
+
+class TileClient(object):
+    """Builds and verifies proofs from the tiles of a tile source.
+
+    The client trusts the first checkpoint it reads, or |trusted_head| if
+    given; every later checkpoint is only accepted once it is proven
+    consistent with the trusted one.
+    """
+
+    def __init__(self, source, cache_size=1024, trusted_head=None):
+        self.__source = source
+        self.__cache = lru_cache.LRUCache(cache_size)
+        self.__head = trusted_head
+        self.__hasher = None
+        self.__verifier = None
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.__source)
+
+    @property
+    def cache(self):
+        """The LRUCache of tiles."""
+        return self.__cache
+
+    @property
+    def tree_head(self):
+        """The trusted TreeHead, or None before the first checkpoint."""
+        return self.__head
+
+    @property
+    def hasher(self):
+        return self.__hasher
+
+    @property
+    def tree_size(self):
+        """The size of the trusted head, fetching a checkpoint if needed."""
+        return self.__require_head().tree_size
+
+    def update_checkpoint(self):
+        """Fetches the checkpoint and moves the trusted head forward to it.
+
+        Returns:
+            The trusted TreeHead afterwards.
+
+        Raises:
+            ConsistencyError, ProofError: the new checkpoint is not consistent
+                with the trusted head, or is older than it.
+        """
+        hash_algorithm, head = tile_export.decode_checkpoint(
+                self.__source.fetch(tile_export.CHECKPOINT))
+        if self.__hasher is None:
+            self.__hasher = merkle.TreeHasher(hash_algorithm)
+            self.__verifier = merkle.MerkleVerifier(self.__hasher)
+        elif hash_algorithm != self.__hasher.algorithm:
+            raise error.ConsistencyError(
+                "Checkpoint changed hash algorithm from %s to %s" %
+                (self.__hasher.algorithm, hash_algorithm))
+        if self.__head is None:
+            self.__head = head
+        elif head.tree_size < self.__head.tree_size:
+            raise error.ConsistencyError(
+                "Checkpoint rolled back from %d to %d leaves" %
+                (self.__head.tree_size, head.tree_size))
+        else:
+            self.verify_consistency(self.__head, head)
+            self.__head = head
+        return self.__head
+
+    def __require_head(self):
+        if self.__head is None or self.__hasher is None:
+            self.update_checkpoint()
+        return self.__head
+
+    def _get_tile(self, level, index, width):
+        """Returns the concatenated hashes of a tile of |width| hashes.
+
+        Each call counts as a single hit or miss of the cache.
+        """
+        full_key = (level, index, leveldb_merkle_tree.TILE_WIDTH)
+        if width != leveldb_merkle_tree.TILE_WIDTH and full_key in self.__cache:
+            full = self.__cache.get(full_key)
+            if full is not None:
+                return full[:width * self.__hasher.digest_size]
+        tile = self.__cache.get((level, index, width))
+        if tile is not None:
+            return tile
+        tile = self.__source.fetch(tile_export.tile_path(level, index, width))
+        if len(tile) != width * self.__hasher.digest_size:
+            raise error.EncodingError(
+                "Tile (%d, %d) of width %d has %d bytes" %
+                (level, index, width, len(tile)))
+        self.__cache.put((level, index, width), tile)
+        return tile
+
+    def _perfect_subtree_hash(self, start, size, tree_size):
+        """Returns the hash of a perfect subtree from the tile below it."""
+        level = size.bit_length() - 1
+        tile_level, height = divmod(level, leveldb_merkle_tree.TILE_HEIGHT)
+        shift = tile_level * leveldb_merkle_tree.TILE_HEIGHT
+        node_index = start >> shift
+        tile_index = node_index >> leveldb_merkle_tree.TILE_HEIGHT
+        tile_start = tile_index << leveldb_merkle_tree.TILE_HEIGHT
+        # Tiles are fetched at their width in a tree of |tree_size|.
+        width = min(leveldb_merkle_tree.TILE_WIDTH,
+                    (tree_size >> shift) - tile_start)
+        digest_size = self.__hasher.digest_size
+        offset = (node_index - tile_start) * digest_size
+        hashes = self._get_tile(tile_level, tile_index, width)[
+                offset:offset + (digest_size << height)]
+        for _ in range(height):
+            hashes = self.__hasher.hash_level(hashes)
+        return hashes
+
+    def __subtree_hash(self, tree_size):
+        def subtree_hash(start, end):
+            return merkle.calculate_subtree_hash(
+                    start, end, self.__hasher,
+                    lambda s, size: self._perfect_subtree_hash(s, size,
+                                                               tree_size))
+        return subtree_hash
+
+    def __check_size(self, tree_size):
+        head = self.__require_head()
+        if tree_size is None:
+            return head.tree_size
+        if tree_size > head.tree_size:
+            raise ValueError("Tree size %d is beyond the checkpoint at %d" %
+                             (tree_size, head.tree_size))
+        return tree_size
+
+    def get_leaf_hash(self, leaf_index):
+        """Returns the leaf hash at |leaf_index|."""
+        tree_size = self.__check_size(None)
+        if not 0 <= leaf_index < tree_size:
+            raise ValueError("Leaf %d is beyond the checkpoint at %d" %
+                             (leaf_index, tree_size))
+        return self._perfect_subtree_hash(leaf_index, 1, tree_size)
+
+    def get_subtree_hash(self, start, end):
+        """Returns MTH(D[start:end]), computed from the tiles."""
+        tree_size = self.__check_size(None)
+        if not 0 <= start <= end <= tree_size:
+            raise ValueError("Bad range [%d, %d) for tree size %d" %
+                             (start, end, tree_size))
+        return self.__subtree_hash(tree_size)(start, end)
+
+    def get_root_hash(self, tree_size=None):
+        """Returns the root hash at |tree_size|, computed from the tiles."""
+        tree_size = self.__check_size(tree_size)
+        return self.__subtree_hash(self.__head.tree_size)(0, tree_size)
+
+    def get_inclusion_proof(self, leaf_index, tree_size=None):
+        """Returns an inclusion proof computed from the tiles."""
+        tree_size = self.__check_size(tree_size)
+        if not 0 <= leaf_index < tree_size:
+            raise ValueError("Leaf %d is beyond tree size %d" %
+                             (leaf_index, tree_size))
+        return merkle.calculate_inclusion_proof(
+                leaf_index, tree_size, self.__subtree_hash(
+                        self.__head.tree_size))
+
+    def get_consistency_proof(self, tree_size_1, tree_size_2=None):
+        """Returns a consistency proof computed from the tiles."""
+        tree_size_2 = self.__check_size(tree_size_2)
+        if not 0 <= tree_size_1 <= tree_size_2:
+            raise ValueError("Bad tree sizes %d, %d" %
+                             (tree_size_1, tree_size_2))
+        if tree_size_1 == tree_size_2 or tree_size_1 == 0:
+            return []
+        return merkle.calculate_consistency_proof(
+                tree_size_1, tree_size_2, self.__subtree_hash(
+                        self.__head.tree_size))
+
+    @error.returns_true_or_raises
+    def verify_leaf_hash_inclusion(self, leaf_hash, leaf_index):
+        """Verifies that |leaf_hash| is at |leaf_index| in the trusted head.
+
+        Returns:
+            True. The return value is enforced by a decorator and need not be
+                checked by the caller.
+
+        Raises:
+            ProofError: the tiles do not prove the inclusion.
+        """
+        head = self.__require_head()
+        proof = self.get_inclusion_proof(leaf_index)
+        return self.__verifier.verify_leaf_hash_inclusion(
+                leaf_hash, leaf_index, proof, head)
+
+    @error.returns_true_or_raises
+    def verify_inclusion(self, leaf, leaf_index):
+        """Verifies that |leaf| is at |leaf_index| in the trusted head."""
+        self.__require_head()
+        return self.verify_leaf_hash_inclusion(self.__hasher.hash_leaf(leaf),
+                                               leaf_index)
+
+    @error.returns_true_or_raises
+    def verify_consistency(self, old_head, new_head=None):
+        """Verifies that |old_head| is a prefix of |new_head|.
+
+        |new_head| defaults to the trusted head. The proof is built from tiles
+        of the size of |new_head|, which must be the checkpoint's.
+
+        Raises:
+            ConsistencyError, ProofError: the heads are not consistent.
+        """
+        if new_head is None:
+            new_head = self.__require_head()
+        if old_head.tree_size > new_head.tree_size:
+            raise ValueError("Old head at %d is beyond the new one at %d" %
+                             (old_head.tree_size, new_head.tree_size))
+        proof = ([] if old_head.tree_size in (0, new_head.tree_size) else
+                 merkle.calculate_consistency_proof(
+                         old_head.tree_size, new_head.tree_size,
+                         self.__subtree_hash(new_head.tree_size)))
+        return self.__verifier.verify_tree_consistency(
+                old_head.tree_size, new_head.tree_size, old_head.root_hash,
+                new_head.root_hash, proof)
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+
+"""Tests for tile_client."""
+
+import BaseHTTPServer
+import os
+import shutil
+import SimpleHTTPServer
+import tempfile
+import threading
+import unittest
+
+import error
+import in_memory_merkle_tree
+import leveldb_merkle_tree
+import merkle
+import tile_client
+import tile_export
+
+
+class _CountingSource(tile_client.DirectoryTileSource):
+    """Records the paths fetched."""
+
+    def __init__(self, directory):
+        super(_CountingSource, self).__init__(directory)
+        self.fetched = []
+
+    def fetch(self, path):
+        self.fetched.append(path)
+        return super(_CountingSource, self).fetch(path)
+
+
+class TileClientTest(unittest.TestCase):
+    """Tests for TileClient against a TileExporter's output."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.tiles = os.path.join(self.dir, "tiles")
+        self.tree = leveldb_merkle_tree.LeveldbMerkleTree(
+                db=os.path.join(self.dir, "db"))
+        self.exporter = tile_export.TileExporter(self.tree, self.tiles)
+        self.leaves = [str(i) for i in range(700)]
+
+    def tearDown(self):
+        self.tree.close()
+        shutil.rmtree(self.dir)
+
+    def _publish(self, stop, timestamp):
+        self.tree.extend(self.leaves[self.tree.tree_size:stop])
+        return self.exporter.export(self.tree.publish_tree_head(timestamp))
+
+    def test_proofs_match_the_tree(self):
+        head = self._publish(600, 1)
+        client = tile_client.TileClient(
+                tile_client.DirectoryTileSource(self.tiles))
+        self.assertEqual(client.update_checkpoint(), head)
+        reference = in_memory_merkle_tree.InMemoryMerkleTree(
+                self.leaves[:600])
+        for size in (1, 255, 256, 257, 512, 599, 600):
+            self.assertEqual(client.get_root_hash(size),
+                             reference.get_root_hash(size))
+        for index in (0, 1, 255, 256, 300, 511, 599):
+            self.assertEqual(client.get_inclusion_proof(index),
+                             reference.get_inclusion_proof(index, 600))
+            self.assertTrue(client.verify_inclusion(self.leaves[index], index))
+            self.assertRaises(error.ProofError, client.verify_inclusion,
+                              "nope", index)
+        for old_size in (1, 100, 256, 513):
+            self.assertEqual(client.get_consistency_proof(old_size),
+                             reference.get_consistency_proof(old_size, 600))
+        for start, end in ((0, 600), (7, 300), (256, 512)):
+            self.assertEqual(client.get_subtree_hash(start, end),
+                             merkle.TreeHasher().hash_full_tree(
+                                     self.leaves[start:end]))
+        self.assertEqual(client.get_leaf_hash(5),
+                         merkle.TreeHasher().hash_leaf("5"))
+        self.assertRaises(ValueError, client.get_inclusion_proof, 600)
+
+    def test_cache(self):
+        self._publish(600, 1)
+        source = _CountingSource(self.tiles)
+        client = tile_client.TileClient(source, cache_size=3)
+        client.verify_inclusion(self.leaves[3], 3)
+        # The checkpoint, leaf tiles 0 and 2 and the level 1 tile.
+        self.assertEqual(len(source.fetched), 4)
+        # Each fetched tile was a single cache miss.
+        self.assertEqual(client.cache.misses, 3)
+        client.verify_inclusion(self.leaves[4], 4)
+        # A full tile also serves the narrower tile at a smaller size.
+        client.get_inclusion_proof(3, 200)
+        self.assertEqual(len(source.fetched), 4)
+        self.assertFalse((0, 0, 200) in client.cache)
+        client.verify_inclusion(self.leaves[300], 300)
+        self.assertEqual(source.fetched[-1], "tile/8/0/001")
+        self.assertEqual(client.cache.misses, len(source.fetched) - 1)
+        self.assertEqual(len(client.cache), 3)
+
+    def test_checkpoint_updates_are_verified(self):
+        first = self._publish(300, 1)
+        client = tile_client.TileClient(
+                tile_client.DirectoryTileSource(self.tiles))
+        self.assertEqual(client.update_checkpoint(), first)
+        second = self._publish(650, 2)
+        self.assertEqual(client.update_checkpoint(), second)
+        self.assertTrue(client.verify_consistency(first))
+        self.assertTrue(client.verify_inclusion(self.leaves[640], 640))
+
+        forked = tile_client.TileClient(
+                tile_client.DirectoryTileSource(self.tiles),
+                trusted_head=first._replace(sha256_root_hash="x" * 32))
+        self.assertRaises(error.VerifyError, forked.update_checkpoint)
+        self.assertEqual(forked.tree_head.tree_size, 300)
+
+        # A checkpoint older than the trusted head is a rollback.
+        self.tree.extend(self.leaves[650:])
+        ahead = tile_client.TileClient(
+                tile_client.DirectoryTileSource(self.tiles),
+                trusted_head=self.tree.publish_tree_head(3))
+        self.assertRaises(error.ConsistencyError, ahead.update_checkpoint)
+
+    def test_http_source(self):
+        head = self._publish(300, 1)
+        tiles = self.tiles
+
+        class Handler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+            def translate_path(self, path):
+                return os.path.join(tiles, path.lstrip("/"))
+
+            def log_message(self, *args):
+                pass
+
+        server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            client = tile_client.TileClient(tile_client.HttpTileSource(
+                    "http://127.0.0.1:%d/" % server.server_address[1]))
+            self.assertEqual(client.update_checkpoint(), head)
+            self.assertTrue(client.verify_inclusion(self.leaves[299], 299))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,162 @@
+"""Static export of a LeveldbMerkleTree's tiles, for serving proofs as files.
+
+The tiles of the tree (see leveldb_merkle_tree.TILE_HEIGHT) are written as
+immutable files below a directory, in the layout of transparency-log tile
+schemes, together with a checkpoint naming the tree head they cover:
+
+    checkpoint               the exported tree head
+    tile/8/L/NNN             full tile NNN at tile level L
+    tile/8/L/NNN.p/W         partial tile holding W hashes
+
+Tile level 0 holds the leaf hashes. A tile index is split into path elements
+of three digits, all but the last prefixed with "x", so that tile 1234067 is
+tile/8/0/x001/x234/067. Full tiles never change, and a partial tile is named
+by its width, so every file can be cached forever; only the checkpoint is
+replaced. Clients fetch the tiles they need and compute proofs themselves.
+
+>>> exporter = tile_export.TileExporter(tree, "./tiles")
+>>> tree.extend(leaves)
+>>> exporter.export(tree.publish_tree_head())
+"""
+
+import base64
+import os
+
+import error
+import leveldb_merkle_tree
+import tree_head
+
+
+CHECKPOINT = "checkpoint"
+
+
+def tile_path(level, index, width=None):
+    """Returns the path of a tile relative to the export directory.
+
+    |width| is the number of hashes in the tile, defaulting to a full tile.
+    """
+    elements = ["%03d" % (index % 1000)]
+    index //= 1000
+    while index:
+        elements.append("x%03d" % (index % 1000))
+        index //= 1000
+    path = "/".join(["tile", str(leveldb_merkle_tree.TILE_HEIGHT),
+                     str(level)] + elements[::-1])
+    if width is not None and width != leveldb_merkle_tree.TILE_WIDTH:
+        path += ".p/%d" % width
+    return path
+
+
+def tile_widths(tree_size, old_tree_size=0):
+    """Yields (level, index, width) for the tiles of a tree of |tree_size|.
+
+    Tiles that a tree of |old_tree_size| already has, with the same width,
+    are left out.
+    """
+    level = 0
+    count = tree_size
+    old_count = old_tree_size
+    while count:
+        start = old_count & ~(leveldb_merkle_tree.TILE_WIDTH - 1)
+        for index in xrange(start, count, leveldb_merkle_tree.TILE_WIDTH):
+            width = min(count - index, leveldb_merkle_tree.TILE_WIDTH)
+            if index + width > old_count:
+                yield (level, index >> leveldb_merkle_tree.TILE_HEIGHT, width)
+        level += 1
+        count >>= leveldb_merkle_tree.TILE_HEIGHT
+        old_count >>= leveldb_merkle_tree.TILE_HEIGHT
+
+
+def encode_checkpoint(hash_algorithm, head):
+    """Serialise a TreeHead into the text of a checkpoint file."""
+    return "%s\n%d\n%d\n%s\n" % (hash_algorithm, head.tree_size,
+                                 head.timestamp,
+                                 base64.b64encode(head.root_hash))
+
+
+def decode_checkpoint(data):
+    """Parse a checkpoint written by encode_checkpoint().
+
+    Returns:
+        A (hash_algorithm, TreeHead) pair.
+
+    Raises:
+        EncodingError: the checkpoint is malformed.
+    """
+    lines = data.split("\n")
+    if len(lines) != 5 or lines[4]:
+        raise error.EncodingError("Malformed checkpoint")
+    try:
+        return lines[0], tree_head.TreeHead(int(lines[1]), int(lines[2]),
+                                            base64.b64decode(lines[3]))
+    except (ValueError, TypeError) as e:
+        raise error.EncodingError("Malformed checkpoint: %s" % e)
+
+
+def _write_file(path, data):
+    """Writes |path| under a temporary name and renames it into place."""
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.rename(tmp_path, path)
+
+
+class TileExporter(object):
+    """Writes the tiles of a LeveldbMerkleTree below |directory|.
+
+    Each export only writes the tiles that are new since the last checkpoint,
+    so it is cheap to call after every published head.
+    """
+
+    def __init__(self, tree, directory):
+        self.__tree = tree
+        self.__directory = directory
+
+    def __repr__(self):
+        return "%s(%r, %r)" % (self.__class__.__name__, self.__tree,
+                               self.__directory)
+
+    def get_checkpoint(self):
+        """Returns the TreeHead of the current checkpoint, or None."""
+        try:
+            with open(os.path.join(self.__directory, CHECKPOINT), "rb") as f:
+                data = f.read()
+        except IOError:
+            return None
+        hash_algorithm, head = decode_checkpoint(data)
+        if hash_algorithm != self.__tree.hash_algorithm:
+            raise ValueError("Export uses hash algorithm %s, not %s" %
+                             (hash_algorithm, self.__tree.hash_algorithm))
+        return head
+
+    def export(self, head=None):
+        """Exports the tiles of |head|, then points the checkpoint at it.
+
+        |head| defaults to the latest tree head published by the tree. A head
+        older than the current checkpoint is not exported.
+
+        Returns:
+            The TreeHead of the checkpoint afterwards, or None if there is
+            none.
+        """
+        if head is None:
+            head = self.__tree.get_latest_tree_head()
+        checkpoint = self.get_checkpoint()
+        if head is None or (checkpoint is not None and
+                            head.tree_size <= checkpoint.tree_size):
+            return checkpoint
+        old_size = checkpoint.tree_size if checkpoint is not None else 0
+        for level, index, width in tile_widths(head.tree_size, old_size):
+            hashes = self.__tree.get_tile(level, index)[:width]
+            if len(hashes) != width:
+                raise ValueError("Tree has no tile (%d, %d) of width %d" %
+                                 (level, index, width))
+            _write_file(os.path.join(self.__directory,
+                                     tile_path(level, index, width)),
+                        "".join(hashes))
+        _write_file(os.path.join(self.__directory, CHECKPOINT),
+                    encode_checkpoint(self.__tree.hash_algorithm, head))
+        return head
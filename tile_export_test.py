@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+"""Tests for tile_export."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import error
+import leveldb_merkle_tree
+import merkle
+import tile_export
+import tree_head
+
+
+class TileExportTest(unittest.TestCase):
+    """Tests for the tile layout and TileExporter."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.tiles = os.path.join(self.dir, "tiles")
+        self.tree = leveldb_merkle_tree.LeveldbMerkleTree(
+                db=os.path.join(self.dir, "db"))
+
+    def tearDown(self):
+        self.tree.close()
+        shutil.rmtree(self.dir)
+
+    def _files(self):
+        files = set()
+        for root, _, names in os.walk(self.tiles):
+            for name in names:
+                files.add(os.path.relpath(os.path.join(root, name),
+                                          self.tiles))
+        return files
+
+    def _read(self, path):
+        with open(os.path.join(self.tiles, path), "rb") as f:
+            return f.read()
+
+    def test_tile_path(self):
+        self.assertEqual(tile_export.tile_path(0, 5), "tile/8/0/005")
+        self.assertEqual(tile_export.tile_path(1, 1234067, 256),
+                         "tile/8/1/x001/x234/067")
+        self.assertEqual(tile_export.tile_path(2, 1000, 17),
+                         "tile/8/2/x001/000.p/17")
+
+    def test_tile_widths(self):
+        self.assertEqual(list(tile_export.tile_widths(0)), [])
+        self.assertEqual(list(tile_export.tile_widths(600)),
+                         [(0, 0, 256), (0, 1, 256), (0, 2, 88), (1, 0, 2)])
+        self.assertEqual(list(tile_export.tile_widths(600, 300)),
+                         [(0, 1, 256), (0, 2, 88), (1, 0, 2)])
+        self.assertEqual(list(tile_export.tile_widths(600, 600)), [])
+
+    def test_checkpoint(self):
+        head = tree_head.TreeHead(12, 34, "r" * 32)
+        data = tile_export.encode_checkpoint("sha256", head)
+        self.assertEqual(tile_export.decode_checkpoint(data), ("sha256", head))
+        self.assertRaises(error.EncodingError, tile_export.decode_checkpoint,
+                          data[:-1])
+        self.assertRaises(error.EncodingError, tile_export.decode_checkpoint,
+                          "sha256\nx\n34\n\n")
+
+    def test_incremental_export(self):
+        exporter = tile_export.TileExporter(self.tree, self.tiles)
+        self.assertEqual(exporter.export(), None)
+        hasher = merkle.TreeHasher()
+        leaf_hashes = [hasher.hash_leaf(str(i)) for i in range(600)]
+        self.tree.extend_hashes(leaf_hashes[:300])
+        first = exporter.export(self.tree.publish_tree_head(timestamp=1))
+        self.assertEqual(self._files(), set([
+                "checkpoint", "tile/8/0/000", "tile/8/0/001.p/44",
+                "tile/8/1/000.p/1"]))
+        self.assertEqual(self._read("tile/8/0/001.p/44"),
+                         "".join(leaf_hashes[256:300]))
+        self.assertEqual(self._read("tile/8/1/000.p/1"),
+                         hasher.hash_full_tree([str(i) for i in range(256)]))
+
+        self.tree.extend_hashes(leaf_hashes[300:])
+        # Only published heads are exported by default.
+        self.assertEqual(exporter.export(), first)
+        os.remove(os.path.join(self.tiles, "tile/8/0/000"))
+        second = exporter.export(self.tree.publish_tree_head(timestamp=2))
+        self.assertEqual(exporter.get_checkpoint(), second)
+        # Tiles of the first export are not written again.
+        self.assertEqual(self._files(), set([
+                "checkpoint", "tile/8/0/001.p/44", "tile/8/0/001",
+                "tile/8/0/002.p/88", "tile/8/1/000.p/1", "tile/8/1/000.p/2"]))
+        self.assertEqual(self._read("tile/8/1/000.p/2"),
+                         "".join(self.tree.get_tile(1, 0)))
+        self.assertEqual(exporter.export(first), second)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,131 @@
+"""Compact binary export format for Merkle trees.
+
+An export holds everything needed to serve a tree without rehashing:
+
+    magic "MTEXPORT", version (1 byte)
+    hash algorithm name length (1 byte), hash algorithm name
+    tree size (8 bytes), digest size (1 byte)
+    leaf hashes, tree size * digest size bytes, in leaf order
+    node count (1 byte), node hashes: the roots of the tree's perfect
+        subtrees, one per level, largest first (the compact tree frontier)
+    root hash
+    SHA-256 of everything above
+
+All integers are big-endian. The format is written and read as a stream, so
+exports of any size need only a chunk of leaf hashes in memory.
+"""
+
+import hashlib
+import struct
+
+import error
+
+
+MAGIC = "MTEXPORT"
+VERSION = 1
+
+_HEADER_FORMAT = ">QB"
+_HEADER_SIZE = struct.calcsize(_HEADER_FORMAT)
+_CHECKSUM_SIZE = hashlib.sha256().digest_size
+
+
+class _ChecksummedWriter(object):
+    def __init__(self, fileobj):
+        self.__fileobj = fileobj
+        self.checksum = hashlib.sha256()
+
+    def write(self, data):
+        self.checksum.update(data)
+        self.__fileobj.write(data)
+
+
+def write_export(fileobj, hash_algorithm, tree_size, digest_size,
+                 leaf_hash_chunks, node_hashes, root_hash):
+    """Writes a tree export to |fileobj|.
+
+    Args:
+        fileobj: a file-like object to write to.
+        hash_algorithm: name of the tree's hash algorithm.
+        tree_size: number of leaves.
+        digest_size: size of every hash.
+        leaf_hash_chunks: an iterable of lists of leaf hashes, in order.
+        node_hashes: the compact tree frontier for |tree_size| leaves.
+        root_hash: the root hash for |tree_size| leaves.
+
+    Raises:
+        ValueError: the leaf hashes do not add up to |tree_size|.
+    """
+    out = _ChecksummedWriter(fileobj)
+    out.write(MAGIC + chr(VERSION) + chr(len(hash_algorithm)) +
+              hash_algorithm)
+    out.write(struct.pack(_HEADER_FORMAT, tree_size, digest_size))
+    written = 0
+    for chunk in leaf_hash_chunks:
+        out.write("".join(chunk))
+        written += len(chunk)
+    if written != tree_size:
+        raise ValueError("Exported %d leaf hashes for a tree of size %d" %
+                         (written, tree_size))
+    out.write(chr(len(node_hashes)) + "".join(node_hashes))
+    out.write(root_hash)
+    fileobj.write(out.checksum.digest())
+
+
+class ExportReader(object):
+    """Reads a tree export written by write_export().
+
+    The header is read on construction. Read the leaf hashes with
+    leaf_hash_chunks(), then call finish() for the node hashes and root hash,
+    which are only returned once the checksum has been verified.
+
+    Raises:
+        EncodingError: the export is malformed, truncated or corrupt.
+        UnsupportedVersionError: the export has an unknown version.
+    """
+
+    def __init__(self, fileobj):
+        self.__fileobj = fileobj
+        self.__checksum = hashlib.sha256()
+        magic = self.__read(len(MAGIC) + 2)
+        if magic[:len(MAGIC)] != MAGIC:
+            raise error.EncodingError("Not a tree export")
+        version = ord(magic[len(MAGIC)])
+        if version != VERSION:
+            raise error.UnsupportedVersionError(
+                "Unsupported tree export version %d" % version)
+        self.hash_algorithm = self.__read(ord(magic[-1]))
+        self.tree_size, self.digest_size = struct.unpack(
+            _HEADER_FORMAT, self.__read(_HEADER_SIZE))
+        self.__leaves_read = 0
+
+    def __read(self, size, checksummed=True):
+        data = self.__fileobj.read(size)
+        if len(data) != size:
+            raise error.EncodingError("Truncated tree export")
+        if checksummed:
+            self.__checksum.update(data)
+        return data
+
+    def leaf_hash_chunks(self, chunk_size=65536):
+        """Yields the leaf hashes in lists of up to |chunk_size|."""
+        digest_size = self.digest_size
+        while self.__leaves_read < self.tree_size:
+            count = min(chunk_size, self.tree_size - self.__leaves_read)
+            data = self.__read(count * digest_size)
+            self.__leaves_read += count
+            yield [data[i:i + digest_size]
+                   for i in xrange(0, len(data), digest_size)]
+
+    def finish(self):
+        """Returns (node_hashes, root_hash) and verifies the checksum."""
+        for _ in self.leaf_hash_chunks():
+            pass
+        digest_size = self.digest_size
+        count = ord(self.__read(1))
+        data = self.__read(count * digest_size)
+        node_hashes = [data[i:i + digest_size]
+                       for i in xrange(0, len(data), digest_size)]
+        root_hash = self.__read(digest_size)
+        if self.__read(_CHECKSUM_SIZE, False) != self.__checksum.digest():
+            raise error.EncodingError("Tree export checksum mismatch")
+        return node_hashes, root_hash
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+
+"""Tests for tree_export."""
+
+import StringIO
+import unittest
+
+import error
+import merkle
+import tree_export
+
+
+class TreeExportTest(unittest.TestCase):
+    """Tests for write_export() and ExportReader."""
+
+    def _export(self, leaves):
+        hasher = merkle.TreeHasher()
+        leaf_hashes = [hasher.hash_leaf(l) for l in leaves]
+        frontier = merkle.CompactMerkleTree(hasher)
+        frontier.extend(leaves)
+        out = StringIO.StringIO()
+        tree_export.write_export(out, "sha256", len(leaves), 32,
+                                 [leaf_hashes[:2], leaf_hashes[2:]],
+                                 frontier.hashes, frontier.root_hash())
+        return out.getvalue(), leaf_hashes, frontier
+
+    def test_round_trip(self):
+        data, leaf_hashes, frontier = self._export("abcde")
+        reader = tree_export.ExportReader(StringIO.StringIO(data))
+        self.assertEqual(reader.hash_algorithm, "sha256")
+        self.assertEqual(reader.tree_size, 5)
+        self.assertEqual(reader.digest_size, 32)
+        chunks = list(reader.leaf_hash_chunks(chunk_size=2))
+        self.assertEqual([len(c) for c in chunks], [2, 2, 1])
+        self.assertEqual(sum(chunks, []), leaf_hashes)
+        self.assertEqual(reader.finish(),
+                         (list(frontier.hashes), frontier.root_hash()))
+
+    def test_leaf_count_must_match(self):
+        self.assertRaises(ValueError, tree_export.write_export,
+                          StringIO.StringIO(), "sha256", 3, 32, [["x" * 32]],
+                          [], "r" * 32)
+
+    def test_corrupt_exports(self):
+        data = self._export("abcde")[0]
+        corrupt = data[:40] + chr(ord(data[40]) ^ 1) + data[41:]
+        reader = tree_export.ExportReader(StringIO.StringIO(corrupt))
+        self.assertRaises(error.EncodingError, reader.finish)
+        reader = tree_export.ExportReader(StringIO.StringIO(data[:-1]))
+        self.assertRaises(error.EncodingError, reader.finish)
+        self.assertRaises(error.EncodingError, tree_export.ExportReader,
+                          StringIO.StringIO("NOTANEXPORT"))
+        future = data[:8] + chr(2) + data[9:]
+        self.assertRaises(error.UnsupportedVersionError,
+                          tree_export.ExportReader, StringIO.StringIO(future))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,134 @@
+"""Tree heads: immutable (tree_size, timestamp, root) checkpoints of a log.
+
+A TreeHead can be passed wherever MerkleVerifier expects an STH. The
+TreeHeadPublisher decides when a tree publishes a new head: every N leaves,
+every so many seconds, or both.
+"""
+
+from collections import namedtuple
+import logging
+import struct
+import threading
+import time
+
+
+class TreeHead(namedtuple("TreeHead", ["tree_size", "timestamp",
+                                        "sha256_root_hash"])):
+    """A published tree head.
+
+    The timestamp is in milliseconds since the epoch. Tree heads are not
+    signed. Despite its name, sha256_root_hash holds the root hash under
+    whichever algorithm the tree uses; root_hash is an alias for it.
+    """
+    __slots__ = ()
+
+    @property
+    def root_hash(self):
+        return self.sha256_root_hash
+
+
+_TREE_HEAD_FORMAT = ">QQ"
+_TREE_HEAD_HEADER_SIZE = struct.calcsize(_TREE_HEAD_FORMAT)
+
+
+def encode_tree_head(head):
+    """Serialise a TreeHead into a bytestring."""
+    return (struct.pack(_TREE_HEAD_FORMAT, head.tree_size, head.timestamp) +
+            head.sha256_root_hash)
+
+
+def decode_tree_head(data):
+    """Parse a bytestring produced by encode_tree_head()."""
+    tree_size, timestamp = struct.unpack(
+            _TREE_HEAD_FORMAT, data[:_TREE_HEAD_HEADER_SIZE])
+    return TreeHead(tree_size, timestamp, data[_TREE_HEAD_HEADER_SIZE:])
+
+
+def current_timestamp():
+    """Returns the current time in milliseconds since the epoch."""
+    return int(time.time() * 1000)
+
+
+class TreeHeadPublisher(object):
+    """Publishes tree heads of a tree on a schedule.
+
+    The tree must provide tree_size, get_latest_tree_head() and
+    publish_tree_head(timestamp), as LeveldbMerkleTree does. A new head is
+    published once the tree has grown by |every_n_leaves| leaves, or once it
+    has grown at all and |interval| seconds have passed since the last head.
+    |skip_levels| is passed on to publish_tree_head().
+    """
+
+    def __init__(self, tree, every_n_leaves=None, interval=None,
+                 skip_levels=0, clock=current_timestamp):
+        if every_n_leaves is None and interval is None:
+            raise ValueError("Need every_n_leaves, interval or both")
+        self.__tree = tree
+        self.__every_n_leaves = every_n_leaves
+        self.__interval_ms = (int(interval * 1000) if interval is not None
+                              else None)
+        self.__interval = interval
+        self.__skip_levels = skip_levels
+        self.__clock = clock
+        self.__lock = threading.Lock()
+        self.__stop = threading.Event()
+        self.__thread = None
+
+    def __repr__(self):
+        return "%s(%r, every_n_leaves=%r, interval=%r)" % (
+                self.__class__.__name__, self.__tree, self.__every_n_leaves,
+                self.__interval)
+
+    def _due(self, tree_size, latest, now):
+        if latest is None:
+            return tree_size > 0
+        grown = tree_size - latest.tree_size
+        if grown <= 0:
+            return False
+        if (self.__every_n_leaves is not None and
+            grown >= self.__every_n_leaves):
+            return True
+        return (self.__interval_ms is not None and
+                now - latest.timestamp >= self.__interval_ms)
+
+    def maybe_publish(self):
+        """Publishes a new head if one is due.
+
+        Returns:
+            The new TreeHead, or None if no head was published.
+        """
+        with self.__lock:
+            now = self.__clock()
+            if not self._due(self.__tree.tree_size,
+                             self.__tree.get_latest_tree_head(), now):
+                return None
+            return self.__tree.publish_tree_head(
+                    timestamp=now, skip_levels=self.__skip_levels)
+
+    def start(self, poll_interval=None):
+        """Calls maybe_publish() periodically from a background thread."""
+        if self.__thread is not None:
+            raise RuntimeError("Publisher already started")
+        if poll_interval is None:
+            poll_interval = self.__interval if self.__interval else 1.0
+        self.__stop.clear()
+        self.__thread = threading.Thread(target=self.__run,
+                                         args=(poll_interval,),
+                                         name="tree-head-publisher")
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def __run(self, poll_interval):
+        while not self.__stop.wait(poll_interval):
+            try:
+                self.maybe_publish()
+            except Exception:
+                logging.exception("Failed to publish tree head")
+
+    def stop(self):
+        """Stops the background thread started by start()."""
+        if self.__thread is None:
+            return
+        self.__stop.set()
+        self.__thread.join()
+        self.__thread = None
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+"""Tests for tree heads and TreeHeadPublisher."""
+
+import shutil
+import tempfile
+import time
+import unittest
+
+import leveldb_merkle_tree
+import tree_head
+
+
+class FakeClock(object):
+    def __init__(self, now=0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class TreeHeadTest(unittest.TestCase):
+    """Tests for TreeHead serialisation."""
+
+    def test_encode_decode(self):
+        head = tree_head.TreeHead(12345, 1400000000000, "\x01" * 32)
+        self.assertEqual(
+                tree_head.decode_tree_head(tree_head.encode_tree_head(head)),
+                head)
+
+
+class TreeHeadPublisherTest(unittest.TestCase):
+    """Tests for TreeHeadPublisher."""
+
+    def setUp(self):
+        self.db = tempfile.mkdtemp()
+        self.tree = leveldb_merkle_tree.LeveldbMerkleTree(db=self.db)
+
+    def tearDown(self):
+        self.tree.close()
+        shutil.rmtree(self.db)
+
+    def test_needs_a_schedule(self):
+        self.assertRaises(ValueError, tree_head.TreeHeadPublisher, self.tree)
+
+    def test_every_n_leaves(self):
+        clock = FakeClock()
+        publisher = tree_head.TreeHeadPublisher(self.tree, every_n_leaves=4,
+                                                clock=clock)
+        self.assertEqual(publisher.maybe_publish(), None)
+        self.tree.add_leaf("a")
+        head = publisher.maybe_publish()
+        self.assertEqual(head.tree_size, 1)
+        self.tree.extend(["b", "c", "d"])
+        self.assertEqual(publisher.maybe_publish(), None)
+        self.tree.add_leaf("e")
+        self.assertEqual(publisher.maybe_publish().tree_size, 5)
+
+    def test_interval(self):
+        clock = FakeClock(1000)
+        publisher = tree_head.TreeHeadPublisher(self.tree, interval=10,
+                                                clock=clock)
+        self.tree.add_leaf("a")
+        self.assertEqual(publisher.maybe_publish().timestamp, 1000)
+        self.tree.add_leaf("b")
+        clock.now = 10999
+        self.assertEqual(publisher.maybe_publish(), None)
+        clock.now = 11000
+        self.assertEqual(publisher.maybe_publish().tree_size, 2)
+        # No growth, no new head.
+        clock.now = 50000
+        self.assertEqual(publisher.maybe_publish(), None)
+
+    def test_background_thread(self):
+        publisher = tree_head.TreeHeadPublisher(self.tree, every_n_leaves=1)
+        self.tree.add_leaf("a")
+        publisher.start(poll_interval=0.01)
+        try:
+            deadline = time.time() + 5
+            while (self.tree.get_latest_tree_head() is None and
+                   time.time() < deadline):
+                time.sleep(0.01)
+        finally:
+            publisher.stop()
+        self.assertEqual(self.tree.get_latest_tree_head().tree_size, 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,111 @@
+"""Immutable segment files holding every node of a perfect subtree.
+
+A segment covers 2^height consecutive leaves of a tree. The file holds a
+header followed by each level of the subtree, from the leaf hashes up to its
+root, so any node is read straight from the memory-mapped file:
+
+    magic "MTSEGMNT", version (1 byte), height (1 byte), digest size (1 byte)
+    level 0: 2^height leaf hashes
+    level 1: 2^(height - 1) node hashes
+    ...
+    level height: the subtree root
+
+Hashes are incompressible, so segments are stored uncompressed.
+"""
+
+import mmap
+import os
+
+import error
+
+
+MAGIC = "MTSEGMNT"
+VERSION = 1
+
+_HEADER_SIZE = len(MAGIC) + 3
+
+
+def write_segment(path, height, leaf_hashes, hasher):
+    """Builds the levels above |leaf_hashes| and writes a segment to |path|.
+
+    The file is written under a temporary name and renamed into place, so a
+    segment at |path| is always complete.
+
+    Returns:
+        The root hash of the segment.
+    """
+    if len(leaf_hashes) != 1 << height:
+        raise ValueError("Segment of height %d needs %d leaves, got %d" %
+                         (height, 1 << height, len(leaf_hashes)))
+    level = "".join(leaf_hashes)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC + chr(VERSION) + chr(height) + chr(hasher.digest_size))
+        f.write(level)
+        for _ in range(height):
+            level = hasher.hash_level(level)
+            f.write(level)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_path, path)
+    return level
+
+
+class TreeSegment(object):
+    """A memory-mapped segment file.
+
+    Raises:
+        EncodingError: the file is not a complete segment.
+        UnsupportedVersionError: the segment has an unknown version.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            header = f.read(_HEADER_SIZE)
+            if len(header) != _HEADER_SIZE or header[:len(MAGIC)] != MAGIC:
+                raise error.EncodingError("Not a tree segment: %s" % path)
+            if ord(header[len(MAGIC)]) != VERSION:
+                raise error.UnsupportedVersionError(
+                    "Unsupported tree segment version %d" %
+                    ord(header[len(MAGIC)]))
+            self.height = ord(header[len(MAGIC) + 1])
+            self.digest_size = ord(header[len(MAGIC) + 2])
+            size = _HEADER_SIZE + ((2 << self.height) - 1) * self.digest_size
+            if os.fstat(f.fileno()).st_size != size:
+                raise error.EncodingError("Truncated tree segment: %s" % path)
+            self.__map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __repr__(self):
+        return "%s(height=%d)" % (self.__class__.__name__, self.height)
+
+    def close(self):
+        self.__map.close()
+
+    @property
+    def size(self):
+        """The number of leaves in the segment."""
+        return 1 << self.height
+
+    def __offset(self, level, index):
+        # Levels below |level| hold 2^(height+1) - 2^(height+1-level) hashes.
+        return _HEADER_SIZE + self.digest_size * (
+                (2 << self.height) - (2 << self.height >> level) + index)
+
+    def node(self, level, index):
+        """Returns the hash of node |index| of |level| (0 for leaves)."""
+        if not 0 <= level <= self.height or not 0 <= index < (
+                self.size >> level):
+            raise IndexError("No node %d at level %d" % (index, level))
+        offset = self.__offset(level, index)
+        return self.__map[offset:offset + self.digest_size]
+
+    def leaves(self, start, stop):
+        """Returns the leaf hashes in [start, stop) of the segment."""
+        data = self.__map[self.__offset(0, start):self.__offset(0, stop)]
+        digest_size = self.digest_size
+        return [data[i:i + digest_size]
+                for i in xrange(0, len(data), digest_size)]
+
+    @property
+    def root_hash(self):
+        return self.node(self.height, 0)
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+"""Tests for tree_segment."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import error
+import merkle
+import tree_segment
+
+
+class TreeSegmentTest(unittest.TestCase):
+    """Tests for write_segment() and TreeSegment."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "0.segment")
+        self.hasher = merkle.TreeHasher()
+        self.leaf_hashes = [self.hasher.hash_leaf(str(i)) for i in range(8)]
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_nodes(self):
+        root = tree_segment.write_segment(self.path, 3, self.leaf_hashes,
+                                          self.hasher)
+        self.assertEqual(root, self.hasher.hash_full_tree(
+                [str(i) for i in range(8)]))
+        segment = tree_segment.TreeSegment(self.path)
+        self.assertEqual((segment.height, segment.size, segment.digest_size),
+                         (3, 8, 32))
+        self.assertEqual(segment.root_hash, root)
+        self.assertEqual(segment.leaves(2, 6), self.leaf_hashes[2:6])
+        level = "".join(self.leaf_hashes)
+        for height in range(4):
+            self.assertEqual(
+                    "".join(segment.node(height, i)
+                            for i in range(8 >> height)), level)
+            level = self.hasher.hash_level(level)
+        self.assertRaises(IndexError, segment.node, 1, 4)
+        self.assertRaises(IndexError, segment.node, 4, 0)
+        segment.close()
+        self.assertFalse(os.path.exists(self.path + ".tmp"))
+
+    def test_wrong_leaf_count(self):
+        self.assertRaises(ValueError, tree_segment.write_segment, self.path,
+                          2, self.leaf_hashes, self.hasher)
+
+    def test_bad_files(self):
+        tree_segment.write_segment(self.path, 3, self.leaf_hashes,
+                                   self.hasher)
+        with open(self.path, "rb") as f:
+            data = f.read()
+        for bad, exception in ((data[:-1], error.EncodingError),
+                               ("x" + data[1:], error.EncodingError),
+                               (data[:8] + "\x02" + data[9:],
+                                error.UnsupportedVersionError)):
+            with open(self.path, "wb") as f:
+                f.write(bad)
+            self.assertRaises(exception, tree_segment.TreeSegment, self.path)
+
+if __name__ == "__main__":
+    unittest.main()